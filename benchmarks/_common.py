@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+##
+## Copyright (C) 2015 João Ricardo Lourenço <jorl17.8@gmail.com>
+##
+## Github: https://github.com/Jorl17
+##
+## Project main repository: https://github.com/Jorl17/minecraft-dropbox-server
+##
+## This file is part of minecraft-dropbox-server.
+##
+## minecraft-dropbox-server is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 2 of the License, or
+## (at your option) any later version.
+##
+## minecraft-dropbox-server is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with minecraft-dropbox-server.  If not, see <http://www.gnu.org/licenses/>.
+##
+#------------------------------------------------------------------------------
+# What the benchmarks share: where the two scripts are, loading them to call
+# their functions directly, a fake java to launch instead of a real server,
+# free ports and percentiles.
+#------------------------------------------------------------------------------
+import importlib.util
+import os
+import socket
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT = os.path.join(ROOT, 'mc-dropbox-server', 'mc-dropbox-server.py')
+CENTRAL = os.path.join(ROOT, 'mc-dropbox-central-server', 'mc-dropbox-central-server.py')
+
+# Mimics a Minecraft server: prints the usual startup lines and keeps running
+# until killed (or for $FAKE_JVM_RUN seconds, if set). Every launch is appended
+# to the file in $FAKE_JVM_LAUNCHES, with the folder it ran in.
+FAKE_JAVA = '''#!{python}
+import os, sys, time
+if sys.argv[1:] == ['-version']:
+    sys.stderr.write('openjdk version "17.0.8" 2023-07-18\\n')
+    sys.exit(0)
+with open(os.environ['FAKE_JVM_LAUNCHES'], 'a') as f:
+    f.write('{{}} {{}}\\n'.format(time.time(), os.getcwd()))
+log = lambda line: print('[' + time.strftime('%H:%M:%S') + '] [Server thread/INFO]: ' + line, flush=True)
+log('Starting minecraft server version 1.20.1')
+log('Loading properties')
+log('Default game type: SURVIVAL')
+log('Preparing level "world"')
+time.sleep(float(os.environ.get('FAKE_JVM_STARTUP', '0.5')))
+log('Preparing spawn area: 100%')
+log('Done ({{}}s)! For help, type "help"'.format(os.environ.get('FAKE_JVM_STARTUP', '0.5')))
+if 'FAKE_JVM_RUN' in os.environ:
+    time.sleep(float(os.environ['FAKE_JVM_RUN']))
+else:
+    while True:
+        time.sleep(3600)
+'''
+
+def write_fake_java(bin_dir):
+    path = os.path.join(bin_dir, 'java')
+    with open(path, 'w') as f:
+        f.write(FAKE_JAVA.format(python=sys.executable))
+    os.chmod(path, 0o755)
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# The value below which the given fraction of the values are, times scale and
+# rounded to digits (if given). None if there are no values.
+def percentile(values, fraction, scale=1, digits=None):
+    if not values:
+        return None
+    values = sorted(values)
+    value = values[min(len(values) - 1, int(len(values) * fraction))] * scale
+    return value if digits is None else round(value, digits)
+
+# The scripts only run main() as __main__, so they can be imported as modules
+# (their file names are not valid module names)
+def load_script(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+    return script
+
+def load_client():
+    return load_script(CLIENT, 'mc_dropbox_server')
+
+def load_central():
+    return load_script(CENTRAL, 'mc_dropbox_central_server')
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+##
+## Copyright (C) 2015 João Ricardo Lourenço <jorl17.8@gmail.com>
+##
+## Github: https://github.com/Jorl17
+##
+## Project main repository: https://github.com/Jorl17/minecraft-dropbox-server
+##
+## This file is part of minecraft-dropbox-server.
+##
+## minecraft-dropbox-server is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 2 of the License, or
+## (at your option) any later version.
+##
+## minecraft-dropbox-server is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with minecraft-dropbox-server.  If not, see <http://www.gnu.org/licenses/>.
+##
+#------------------------------------------------------------------------------
+# Central server load test. Runs the central server with each worker model
+# (and, with -B, an older central server script, such as the single-threaded
+# one from before the worker models) and loads it with many clients sending
+# status GETs and heartbeat POSTs, reporting requests per second and latency.
+# Every model is measured twice: alone, and with a few stalled clients that
+# connect, send half a request and then wait, as a client on a bad network
+# would.
+#
+# To compare with the old server:
+#   git show <old revision>:mc-dropbox-central-server/mc-dropbox-central-server.py > /tmp/old-central.py
+#   benchmarks/central_load.py -B /tmp/old-central.py
+#------------------------------------------------------------------------------
+from optparse import OptionParser
+from threading import Thread, Event, Lock
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from _common import CENTRAL, get_free_port, percentile
+
+SECRET_KEY = 'benchmark'
+WORKER_MODES = ('single', 'threaded', 'pool')
+
+def wait_for_central(port, deadline):
+    status = '/?' + urllib.parse.urlencode({'key': SECRET_KEY})
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', status)
+            connection.getresponse().read()
+            connection.close()
+            return True
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.1)
+    return False
+
+# Connects and sends the start of a request, then waits until told to stop
+# (or until the server gives up on it).
+def stall(port, stopped):
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=1) as sock:
+            sock.sendall(b'GET /?key=' + SECRET_KEY.encode() + b' HTTP/1.1\r\n')
+            while not stopped.wait(0.1):
+                pass
+    except OSError:
+        pass
+
+def load(port, clients, duration, request_timeout):
+    status = '/?' + urllib.parse.urlencode({'key': SECRET_KEY})
+    heartbeat = urllib.parse.urlencode({'key': SECRET_KEY, 'message': 'started', 'ip': '10.0.0.1'})
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    latencies, errors, lock = [], [0], Lock()
+    deadline = time.time() + duration
+    def client():
+        # Kept alive where the server allows it; http.client reconnects when not
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=request_timeout)
+        mine, failed, i = [], 0, 0
+        while time.time() < deadline:
+            started = time.perf_counter()
+            try:
+                if i % 2:
+                    connection.request('GET', status)
+                else:
+                    connection.request('POST', '/', heartbeat, headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status == 200:
+                    mine.append(time.perf_counter() - started)
+                else:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+            i += 1
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+    threads = [Thread(target=client) for i in range(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    return {'requests_per_second': round(len(latencies) / elapsed, 1), 'p50_ms': percentile(latencies, 0.5, 1000, 3),
+            'p99_ms': percentile(latencies, 0.99, 1000, 3), 'errors': errors[0]}
+
+def measure(name, command, port, options, work_dir):
+    log = open(os.path.join(work_dir, name + '.log'), 'w')
+    central = subprocess.Popen(command, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not wait_for_central(port, time.time() + 10):
+            exit('The central server ({}) did not come up.'.format(name))
+        result = {'clean': load(port, options.clients, options.duration, options.request_timeout)}
+        stopped = Event()
+        stallers = [Thread(target=stall, args=(port, stopped), daemon=True) for i in range(options.stalled)]
+        for staller in stallers:
+            staller.start()
+        time.sleep(0.2)
+        result['stalled'] = load(port, options.clients, options.duration, options.request_timeout)
+        stopped.set()
+    finally:
+        central.terminate()
+        central.wait()
+        log.close()
+    return result
+
+def main():
+    parser = OptionParser(description='Measure central server throughput and latency for each worker model, alone and with stalled clients.')
+    parser.add_option('-w', '--workers', help='Comma separated worker models to measure (Default: {})'.format(','.join(WORKER_MODES)), dest='workers', type='string', default=','.join(WORKER_MODES))
+    parser.add_option('-B', '--baseline', help='Also measure this (older) central server script, for comparison.', dest='baseline', type='string', default=None)
+    parser.add_option('-c', '--clients', help='Number of concurrent clients (Default: 16)', dest='clients', type='int', default=16)
+    parser.add_option('-S', '--stalled', help='Number of stalled clients in the second run (Default: 1)', dest='stalled', type='int', default=1)
+    parser.add_option('-d', '--duration', help='Seconds each run lasts (Default: 5)', dest='duration', type='float', default=5)
+    parser.add_option('-q', '--request-timeout', help='Seconds a client waits for each reply before counting an error (Default: 2)', dest='request_timeout', type='float', default=2)
+    parser.add_option('-t', '--pool-size', help='Worker threads of the pool model (Default: the central server\'s own default)', dest='pool_size', type='int', default=None)
+    parser.add_option('-j', '--json', help='Print the results as JSON.', dest='json', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    workers = options.workers.split(',')
+    unknown = set(workers) - set(WORKER_MODES)
+    if unknown:
+        parser.error('Unknown worker model(s): {}'.format(', '.join(sorted(unknown))))
+    if options.baseline and not os.path.isfile(options.baseline):
+        parser.error('No such file: ' + options.baseline)
+
+    runs = []
+    if options.baseline:
+        runs.append(('baseline', [os.path.abspath(options.baseline)]))
+    for worker_mode in workers:
+        args = ['-w', worker_mode]
+        if worker_mode == 'pool' and options.pool_size:
+            args += ['-t', str(options.pool_size)]
+        runs.append((worker_mode, [CENTRAL] + args))
+
+    work_dir = tempfile.mkdtemp(prefix='mc-dbox-central-load-')
+    results = {}
+    try:
+        for name, command in runs:
+            port = get_free_port()
+            command = [sys.executable] + command + ['-p', str(port), '-k', SECRET_KEY, '-f', os.path.join(work_dir, name + '.txt')]
+            results[name] = measure(name, command, port, options, work_dir)
+            if not options.json:
+                for phase, result in results[name].items():
+                    print('{:10s} {:8s} {:10.1f} req/s   p50 {} ms   p99 {} ms   {} errors'.format(
+                        name, phase, result['requests_per_second'], result['p50_ms'], result['p99_ms'], result['errors']))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if options.json:
+        print(json.dumps({'clients': options.clients, 'stalled': options.stalled, 'duration': options.duration, 'results': results}))
+
+main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+##
+## Copyright (C) 2015 João Ricardo Lourenço <jorl17.8@gmail.com>
+##
+## Github: https://github.com/Jorl17
+##
+## Project main repository: https://github.com/Jorl17/minecraft-dropbox-server
+##
+## This file is part of minecraft-dropbox-server.
+##
+## minecraft-dropbox-server is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 2 of the License, or
+## (at your option) any later version.
+##
+## minecraft-dropbox-server is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with minecraft-dropbox-server.  If not, see <http://www.gnu.org/licenses/>.
+##
+#------------------------------------------------------------------------------
+# Metrics overhead benchmark. First times the recording calls on their own,
+# then runs two copies of the central server in this process -- one with the
+# /metrics instrumentation and one with the plain BaseHTTPRequestHandler hooks
+# and a metrics object that records nothing -- and compares the latency of
+# keep-alive status GETs and heartbeat POSTs against each.
+#------------------------------------------------------------------------------
+from http.server import BaseHTTPRequestHandler
+from optparse import OptionParser
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+import urllib.parse
+
+from _common import load_central, percentile
+
+SECRET_KEY = 'benchmark'
+
+def make_handlers(central):
+    class instrumented_handler(central.mc_dropbox_state_server):
+        def log_message(self, format, *args):
+            pass
+
+    class null_metrics(central.mc_dropbox_metrics):
+        def observe_request(self, method, code, seconds):
+            pass
+        def connection_opened(self):
+            pass
+        def connection_closed(self):
+            pass
+
+    class bare_handler(instrumented_handler):
+        setup = BaseHTTPRequestHandler.setup
+        finish = BaseHTTPRequestHandler.finish
+        parse_request = BaseHTTPRequestHandler.parse_request
+        send_response = BaseHTTPRequestHandler.send_response
+        handle_one_request = BaseHTTPRequestHandler.handle_one_request
+
+    return instrumented_handler, bare_handler, null_metrics
+
+def start_server(central, work_dir, name, handler, metrics=None):
+    registry = central.mc_dropbox_registry()
+    journal = central.mc_dropbox_journal(os.path.join(work_dir, name + '.txt'))
+    registry.add('', central.mc_dropbox_state(journal, SECRET_KEY))
+    hub = central.watch_hub()
+    server = central.create_server(('127.0.0.1', 0), 'threaded', 0, registry, hub)
+    server.RequestHandlerClass = handler
+    if metrics:
+        server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def time_requests(port, requests):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    status = '/?' + urllib.parse.urlencode({'key': SECRET_KEY})
+    heartbeat = urllib.parse.urlencode({'key': SECRET_KEY, 'message': 'started', 'ip': '10.0.0.1'})
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    gets, posts = [], []
+    for i in range(requests):
+        started = time.perf_counter()
+        connection.request('GET', status)
+        connection.getresponse().read()
+        gets.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        connection.request('POST', '/', heartbeat, headers)
+        connection.getresponse().read()
+        posts.append(time.perf_counter() - started)
+    connection.close()
+    return gets, posts
+
+def main():
+    parser = OptionParser(description='Measure the overhead of the central server /metrics instrumentation.')
+    parser.add_option('-n', '--requests', help='Number of GET/POST pairs per round (Default: 2000)', dest='requests', type='int', default=2000)
+    parser.add_option('-r', '--rounds', help='Number of rounds against each server, alternating (Default: 3)', dest='rounds', type='int', default=3)
+    parser.add_option('-j', '--json', help='Print the results as JSON.', dest='json', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    central = load_central()
+    instrumented_handler, bare_handler, null_metrics = make_handlers(central)
+
+    # The recording calls alone
+    metrics = central.mc_dropbox_metrics()
+    metrics.observe_request('GET', 200, 0.0003)
+    calls = 200000
+    observe_ns = timeit.timeit(lambda: metrics.observe_request('GET', 200, 0.0003), number=calls) / calls * 1e9
+    histogram = central.latency_histogram()
+    histogram_ns = timeit.timeit(lambda: histogram.observe(0.0003), number=calls) / calls * 1e9
+
+    work_dir = tempfile.mkdtemp(prefix='mc-dbox-metrics-')
+    try:
+        instrumented = start_server(central, work_dir, 'instrumented', instrumented_handler)
+        bare = start_server(central, work_dir, 'bare', bare_handler, null_metrics())
+        results = {'instrumented': ([], []), 'bare': ([], [])}
+        # Warm both up, then alternate so neither gets the quieter moments
+        for server in (instrumented, bare):
+            time_requests(server.server_address[1], 100)
+        for i in range(options.rounds):
+            for name, server in (('bare', bare), ('instrumented', instrumented)):
+                gets, posts = time_requests(server.server_address[1], options.requests)
+                results[name][0].extend(gets)
+                results[name][1].extend(posts)
+        scraped = http.client.HTTPConnection('127.0.0.1', instrumented.server_address[1])
+        started = time.perf_counter()
+        scraped.request('GET', '/metrics')
+        scraped.getresponse().read()
+        scrape_ms = (time.perf_counter() - started) * 1000
+        scraped.close()
+        for server in (instrumented, bare):
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = {'observe_request_ns': round(observe_ns), 'histogram_observe_ns': round(histogram_ns), 'scrape_ms': round(scrape_ms, 3)}
+    for name, (gets, posts) in results.items():
+        for kind, values in (('get', gets), ('post', posts)):
+            summary['{}_{}_median_us'.format(name, kind)] = percentile(values, 0.5, 1e6, 1)
+            summary['{}_{}_p99_us'.format(name, kind)] = percentile(values, 0.99, 1e6, 1)
+    for kind in ('get', 'post'):
+        bare_median = summary['bare_{}_median_us'.format(kind)]
+        summary['{}_overhead_percent'.format(kind)] = round((summary['instrumented_{}_median_us'.format(kind)] - bare_median) / bare_median * 100, 1)
+
+    if options.json:
+        print(json.dumps(summary))
+    else:
+        for key, value in summary.items():
+            print('{:32s}{}'.format(key, value))
+
+main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+##
+## Copyright (C) 2015 João Ricardo Lourenço <jorl17.8@gmail.com>
+##
+## Github: https://github.com/Jorl17
+##
+## Project main repository: https://github.com/Jorl17/minecraft-dropbox-server
+##
+## This file is part of minecraft-dropbox-server.
+##
+## minecraft-dropbox-server is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 2 of the License, or
+## (at your option) any later version.
+##
+## minecraft-dropbox-server is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with minecraft-dropbox-server.  If not, see <http://www.gnu.org/licenses/>.
+##
+#------------------------------------------------------------------------------
+# Failover benchmark. A simulated host writes a lease to a scratch server
+# folder and then "crashes" (never renews it), while several copies of the
+# real mc-dropbox-server.py wait in standby mode (-S). A fake java records when
+# each standby launches the server, so we can tell how long after the lease
+# expired the first one took over, and whether more than one did.
+#------------------------------------------------------------------------------
+from optparse import OptionParser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+from _common import CENTRAL, CLIENT, get_free_port, write_fake_java
+
+STATUS_FILE_NAME = 'mc_dropbox_server_status.txt'
+SECRET_KEY = 'benchmark'
+HOST_IP = '10.0.0.1'
+
+def write_host_lease(server_folder, lease_time):
+    expires = time.time() + lease_time
+    with open(os.path.join(server_folder, STATUS_FILE_NAME), 'w') as f:
+        f.write('{}\nseq=1\nhost=simulated-host\nexpires={:.3f}\n'.format(HOST_IP, expires))
+    return expires
+
+def inform_central(central, ip):
+    for fields in ({'message': 'stopped'}, {'message': 'started', 'ip': ip}):
+        data = urllib.parse.urlencode(dict(fields, key=SECRET_KEY)).encode()
+        urllib.request.urlopen(central, data, timeout=5).read()
+
+def wait_for_central(central, deadline):
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(central + '?' + urllib.parse.urlencode({'key': SECRET_KEY}), timeout=1).read()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def read_launches(path):
+    try:
+        with open(path) as f:
+            return [float(line.split()[0]) for line in f if line.strip()]
+    except OSError:
+        return []
+
+def run_round(options, work_dir, env, central):
+    server_folder = os.path.join(work_dir, 'world')
+    if os.path.exists(server_folder):
+        shutil.rmtree(server_folder)
+    os.makedirs(server_folder)
+    open(os.path.join(server_folder, 'server.jar'), 'w').close()
+    launches_path = os.path.join(work_dir, 'launches.txt')
+    if os.path.exists(launches_path):
+        os.remove(launches_path)
+    env = dict(env, FAKE_JVM_LAUNCHES=launches_path)
+
+    # The host claims the server (replacing the previous round's winner) and
+    # dies right away: its lease is never renewed
+    expires = write_host_lease(server_folder, options.lease_time)
+    if central:
+        inform_central(central, HOST_IP)
+
+    standbys = []
+    for i in range(options.standbys):
+        command = [sys.executable, CLIENT, '-p', server_folder, '-S', '-z', '-i', '10.0.1.{}'.format(i + 1),
+                   '-b', str(options.heartbeat_time), '-L', str(options.lease_time), '-X', str(options.settle)]
+        if central:
+            command += ['-s', central, '-k', SECRET_KEY]
+        log = open(os.path.join(work_dir, 'standby-{}.log'.format(i)), 'w')
+        standbys.append((subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT), log))
+
+    try:
+        deadline = expires + options.lease_time + options.settle + options.timeout
+        while time.time() < deadline and not read_launches(launches_path):
+            time.sleep(0.05)
+        # Give any other standby that also thinks it won time to show itself
+        time.sleep(options.settle + 2)
+    finally:
+        for process, log in standbys:
+            process.kill()
+            process.wait()
+            log.close()
+
+    launches = read_launches(launches_path)
+    return {'failover': min(launches) - expires if launches else None, 'launches': len(launches)}
+
+def main():
+    parser = OptionParser(description='Measure how long standbys (-S) take to take over a crashed host.')
+    parser.add_option('-n', '--standbys', help='Number of standbys (Default: 3)', dest='standbys', type='int', default=3)
+    parser.add_option('-r', '--rounds', help='Number of crashes to simulate (Default: 3)', dest='rounds', type='int', default=3)
+    parser.add_option('-b', '--heartbeat', help='Heartbeat time of every client (Default: 2)', dest='heartbeat_time', type='int', default=2)
+    parser.add_option('-L', '--lease-time', help='Lease time of every client (Default: 4)', dest='lease_time', type='int', default=4)
+    parser.add_option('-X', '--standby-settle', help='Settle time of the standbys (Default: 1)', dest='settle', type='float', default=1)
+    parser.add_option('-c', '--central', help='Also run a central server and let the standbys claim through it.', dest='central', action='store_true', default=False)
+    parser.add_option('-t', '--timeout', help='Give up on a round this many seconds after a takeover was due (Default: 20)', dest='timeout', type='float', default=20)
+    parser.add_option('-j', '--json', help='Print the results as JSON.', dest='json', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='mc-dbox-failover-')
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    write_fake_java(bin_dir)
+    # The servers exit on their own, even those left by a killed standby
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''), HOME=work_dir, PYTHONUNBUFFERED='1', FAKE_JVM_RUN='5')
+
+    central_process, central = None, None
+    try:
+        if options.central:
+            port = get_free_port()
+            central = 'http://127.0.0.1:{}'.format(port)
+            central_process = subprocess.Popen([sys.executable, CENTRAL, '-p', str(port), '-k', SECRET_KEY, '-f', os.path.join(work_dir, 'central.txt')],
+                                               cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if not wait_for_central(central, time.time() + 10):
+                exit('The central server did not come up.')
+
+        rounds = []
+        for i in range(options.rounds):
+            result = run_round(options, work_dir, env, central)
+            rounds.append(result)
+            if not options.json:
+                if result['failover'] is None:
+                    print('Round {}: nobody took over!'.format(i + 1))
+                else:
+                    print('Round {}: took over {:.2f}s after the lease expired ({} launches)'.format(i + 1, result['failover'], result['launches']))
+    finally:
+        if central_process:
+            central_process.terminate()
+            central_process.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    times = sorted(r['failover'] for r in rounds if r['failover'] is not None)
+    summary = {'standbys': options.standbys, 'rounds': options.rounds, 'central': options.central,
+               'heartbeat': options.heartbeat_time, 'lease_time': options.lease_time, 'settle': options.settle,
+               'failover_median': times[len(times) // 2] if times else None, 'failover_max': times[-1] if times else None,
+               'missed_takeovers': sum(1 for r in rounds if not r['launches']),
+               'double_hosts': sum(1 for r in rounds if r['launches'] > 1)}
+    if options.json:
+        print(json.dumps(dict(summary, results=rounds)))
+    else:
+        for key, value in summary.items():
+            print('{:18s}{}'.format(key, value))
+
+main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+##
+## Copyright (C) 2015 João Ricardo Lourenço <jorl17.8@gmail.com>
+##
+## Github: https://github.com/Jorl17
+##
+## Project main repository: https://github.com/Jorl17/minecraft-dropbox-server
+##
+## This file is part of minecraft-dropbox-server.
+##
+## minecraft-dropbox-server is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 2 of the License, or
+## (at your option) any later version.
+##
+## minecraft-dropbox-server is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with minecraft-dropbox-server.  If not, see <http://www.gnu.org/licenses/>.
+##
+#------------------------------------------------------------------------------
+# Heartbeat cost benchmark. Times the client's calls to the central server the
+# way older versions made them (a new urllib connection per call, the reply of
+# a heartbeat never read) and the way mc-dropbox-server.py makes them now
+# (inform_central_server and check_central_server over its pooled keep-alive
+# connections). Everything goes through a small proxy that counts the
+# connections opened and can add a network round trip (-r): on connecting,
+# which stands for the TCP handshake, and on every request and reply. Calls
+# can be spaced like heartbeats (-g) against a central server closing idle
+# connections sooner (-i); the pooled calls count the attempts that failed on
+# a connection the server had already closed.
+#------------------------------------------------------------------------------
+from optparse import OptionParser
+from threading import Thread
+import json
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+from _common import CENTRAL, get_free_port, load_client, percentile
+
+SECRET_KEY = 'benchmark'
+HOST_IP = '10.0.0.1'
+# The central server's default -i, which the client's CENTRAL_IDLE_TIMEOUT is
+# kept under
+CENTRAL_KEEP_ALIVE_TIMEOUT = 75
+
+class DelayProxy(Thread):
+    def __init__(self, target_port, rtt):
+        Thread.__init__(self, daemon=True)
+        self.target_port = target_port
+        self.rtt = rtt
+        self.connections = 0
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+
+    # Every chunk is delivered half a round trip after it was received, like
+    # on a real network (chunks in flight don't wait for each other)
+    def relay(self, src, dst):
+        chunks = queue.Queue()
+        def deliver():
+            try:
+                while True:
+                    due, data = chunks.get()
+                    if not data:
+                        break
+                    time.sleep(max(0, due - time.monotonic()))
+                    dst.sendall(data)
+            except OSError:
+                pass
+            finally:
+                for sock in (src, dst):
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+        Thread(target=deliver, daemon=True).start()
+        try:
+            while True:
+                data = src.recv(65536)
+                chunks.put((time.monotonic() + self.rtt / 2, data))
+                if not data:
+                    break
+        except OSError:
+            chunks.put((0, b''))
+
+    def serve(self, client):
+        if self.rtt:
+            time.sleep(self.rtt)
+        try:
+            upstream = socket.create_connection(('127.0.0.1', self.target_port))
+        except OSError:
+            client.close()
+            return
+        for sock in (client, upstream):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        Thread(target=self.relay, args=(client, upstream), daemon=True).start()
+        self.relay(upstream, client)
+
+    def run(self):
+        while True:
+            client, address = self.listener.accept()
+            self.connections += 1
+            Thread(target=self.serve, args=(client,), daemon=True).start()
+
+def wait_for_central(url, deadline):
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + '?' + urllib.parse.urlencode({'key': SECRET_KEY}), timeout=1).read()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+# As older versions did it
+def old_heartbeat(url):
+    data = urllib.parse.urlencode({'key': SECRET_KEY, 'message': 'started', 'ip': HOST_IP}).encode()
+    req = urllib.request.Request(url, data, {"Content-Type": "application/x-www-form-urlencoded"})
+    f = urllib.request.urlopen(req)
+
+def old_status(url):
+    f = urllib.request.urlopen(urllib.request.Request(url + '?key=' + SECRET_KEY))
+    return json.loads(f.read().decode('utf-8'))
+
+# Counts the connections the pool hands out: one per attempt
+class AttemptCounter:
+    def __init__(self, central_client):
+        self.attempts = 0
+        acquire = central_client.acquire
+        def counted(*args):
+            self.attempts += 1
+            return acquire(*args)
+        central_client.acquire = counted
+
+def time_calls(f, calls, proxy, gap, counter=None):
+    before = proxy.connections
+    attempts = counter.attempts if counter else 0
+    times = []
+    for i in range(calls):
+        if i and gap:
+            time.sleep(gap)
+        started = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - started)
+    # Let the proxy count the last connections
+    time.sleep(0.05)
+    result = {'median_us': percentile(times, 0.5, 1e6, 1), 'p99_us': percentile(times, 0.99, 1e6, 1), 'connections': proxy.connections - before}
+    if counter:
+        result['failed_attempts'] = counter.attempts - attempts - calls
+    return result
+
+def main():
+    parser = OptionParser(description='Measure the cost of each heartbeat and status call to the central server, the old way and the pooled way.')
+    parser.add_option('-n', '--calls', help='Calls of each kind (Default: 500)', dest='calls', type='int', default=500)
+    parser.add_option('-r', '--rtt', help='Simulated network round trip, in milliseconds (Default: 0)', dest='rtt', type='float', default=0)
+    parser.add_option('-g', '--gap', help='Seconds between calls, to space them like heartbeats (Default: 0)', dest='gap', type='float', default=0)
+    parser.add_option('-i', '--idle-timeout', help='Seconds the central server keeps idle connections open. The client pool drops them as much sooner as it does by default (Default: {})'.format(CENTRAL_KEEP_ALIVE_TIMEOUT), dest='idle_timeout', type='float', default=CENTRAL_KEEP_ALIVE_TIMEOUT)
+    parser.add_option('-j', '--json', help='Print the results as JSON.', dest='json', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='mc-dbox-heartbeat-')
+    port = get_free_port()
+    central = subprocess.Popen([sys.executable, CENTRAL, '-p', str(port), '-k', SECRET_KEY, '-f', os.path.join(work_dir, 'central.txt'), '-i', str(options.idle_timeout)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        proxy = DelayProxy(port, options.rtt / 1000)
+        proxy.start()
+        url = 'http://127.0.0.1:{}'.format(proxy.port)
+        if not wait_for_central(url, time.time() + 10):
+            exit('The central server did not come up.')
+        client = load_client()
+        central_client = client.central_client
+        central_client.idle_timeout = options.idle_timeout * client.CENTRAL_IDLE_TIMEOUT / CENTRAL_KEEP_ALIVE_TIMEOUT
+        counter = AttemptCounter(central_client)
+        # Warm both up
+        old_heartbeat(url)
+        client.inform_central_server(HOST_IP, SECRET_KEY, url)
+
+        results = {
+            'old_heartbeat': time_calls(lambda: old_heartbeat(url), options.calls, proxy, options.gap),
+            'pooled_heartbeat': time_calls(lambda: client.inform_central_server(HOST_IP, SECRET_KEY, url), options.calls, proxy, options.gap, counter),
+            'old_status': time_calls(lambda: old_status(url), options.calls, proxy, options.gap),
+            'pooled_status': time_calls(lambda: client.check_central_server(SECRET_KEY, url), options.calls, proxy, options.gap, counter),
+        }
+        client.central_client.close()
+    finally:
+        central.terminate()
+        central.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = {'calls': options.calls, 'rtt_ms': options.rtt, 'gap_s': options.gap, 'idle_timeout_s': options.idle_timeout}
+    for name, result in results.items():
+        for key, value in result.items():
+            summary['{}_{}'.format(name, key)] = value
+    for kind in ('heartbeat', 'status'):
+        summary['{}_speedup'.format(kind)] = round(results['old_' + kind]['median_us'] / results['pooled_' + kind]['median_us'], 2)
+    if options.json:
+        print(json.dumps(summary))
+    else:
+        for key, value in summary.items():
+            print('{:36s}{}'.format(key, value))
+
+main()
@@ -0,0 +1,601 @@
+#!/usr/bin/env python3
+##
+## Copyright (C) 2015 João Ricardo Lourenço <jorl17.8@gmail.com>
+##
+## Github: https://github.com/Jorl17
+##
+## Project main repository: https://github.com/Jorl17/minecraft-dropbox-server
+##
+## This file is part of minecraft-dropbox-server.
+##
+## minecraft-dropbox-server is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 2 of the License, or
+## (at your option) any later version.
+##
+## minecraft-dropbox-server is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with minecraft-dropbox-server.  If not, see <http://www.gnu.org/licenses/>.
+##
+#------------------------------------------------------------------------------
+# End-to-end simulation. Every simulated player gets its own copy of the
+# server folder, kept in sync by a fake Dropbox with upload/download delays
+# that turns concurrent edits (and, at random, some others) into conflicted
+# copies. Players run the real mc-dropbox-server.py against it, with their
+# public IP served by a local stand-in and a fake java that prints what a
+# Minecraft server prints. Every scenario also counts the bytes the players
+# write to Dropbox (uploads, conflicted copies included). Measured, one
+# scenario after the other:
+#
+#  - detect:   how long the host's lease takes to reach every copy, and how
+#              long a status query (-q) takes and whether it is right.
+#  - takeover: the host is killed (-9) while the others wait with -S; how long
+#              until one of them launches the server, and whether several do
+#              (or one does before the host was even killed).
+#  - race:     everyone starts the stopped server at the same time; whether
+#              more than one of them ends up hosting.
+#  - lease:    one player hosts for a while with the default lease, then
+#              another with a long one (-L); how many status file writes and
+#              bytes each makes Dropbox upload, per hour.
+#  - central:  requests per second the central server answers with many
+#              connections sending heartbeats and status requests.
+#------------------------------------------------------------------------------
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from optparse import OptionParser
+from threading import Thread, Event, Lock
+import heapq
+import http.client
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+from _common import CENTRAL, CLIENT, get_free_port, percentile, write_fake_java
+
+STATUS_FILE_NAME = 'mc_dropbox_server_status.txt'
+STATUS_DIR_NAME = 'mc_dropbox_server_status'
+WORLD_NAME = 'sim'
+SECRET_KEY = 'simulation'
+DROPBOX_POLL_INTERVAL = 0.02
+
+#------------------------------------------------------------------------------
+# Fake Dropbox. Each replica is one player's copy of the server folder. Local
+# changes are uploaded after a delay; if the cloud copy changed since the
+# replica last had it, the upload becomes a conflicted copy instead and the
+# replica gets the cloud version back, as Dropbox does. Uploads that did not
+# conflict can also be turned into conflicted copies at random. Downloads to
+# the other replicas come after another delay. Like the client, temporary
+# files named ~*.tmp are never synced.
+#------------------------------------------------------------------------------
+class FakeDropbox(Thread):
+    def __init__(self, replicas, delay, jitter, conflict_rate, rng):
+        Thread.__init__(self, daemon=True)
+        self.replicas = replicas
+        self.delay = delay
+        self.jitter = jitter
+        self.conflict_rate = conflict_rate
+        self.rng = rng
+        self.cloud = {}
+        # Per replica: name -> ((mtime_ns, size), revision it was based on)
+        self.seen = [{} for replica in replicas]
+        # Per replica: name -> revision of its last upload
+        self.uploaded = [{} for replica in replicas]
+        self.pending = []
+        self.counter = 0
+        self.revision = 0
+        self.stats = {'uploads': 0, 'downloads': 0, 'conflicts': 0, 'injected_conflicts': 0, 'bytes_uploaded': 0}
+        # Per file: name -> [uploads, bytes]
+        self.uploads_by_file = {}
+        self.stopped = Event()
+
+    def get_delay(self):
+        return max(0.0, self.delay * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def schedule(self, delay, action):
+        self.counter += 1
+        heapq.heappush(self.pending, (time.monotonic() + delay, self.counter, action))
+
+    def list_files(self, folder):
+        for dirpath, dirnames, filenames in os.walk(folder):
+            for name in filenames:
+                if not (name.startswith('~') and name.endswith('.tmp')):
+                    yield os.path.relpath(os.path.join(dirpath, name), folder)
+
+    def scan(self, index):
+        folder = self.replicas[index]
+        for name in self.list_files(folder):
+            path = os.path.join(folder, name)
+            try:
+                st = os.stat(path)
+                key = (st.st_mtime_ns, st.st_size)
+                known = self.seen[index].get(name)
+                if known and known[0] == key:
+                    continue
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            base = known[1] if known else 0
+            self.seen[index][name] = (key, base)
+            self.schedule(self.get_delay(), ('upload', index, name, data, base))
+
+    def upload(self, index, name, data, base):
+        current, cloud_data = self.cloud.get(name, (0, None))
+        if cloud_data == data:
+            # Same content: nothing to upload, and nothing to conflict with
+            known = self.seen[index].get(name)
+            if known:
+                self.seen[index][name] = (known[0], current)
+            return
+        # A replica's own edits follow each other: the cloud version being its
+        # previous upload is no conflict
+        conflict = current != base and current != self.uploaded[index].get(name)
+        injected = not conflict and name in self.cloud and self.rng.random() < self.conflict_rate
+        self.revision += 1
+        self.stats['bytes_uploaded'] += len(data)
+        counts = self.uploads_by_file.setdefault(name, [0, 0])
+        counts[0] += 1
+        counts[1] += len(data)
+        if conflict or injected:
+            self.stats['conflicts' if conflict else 'injected_conflicts'] += 1
+            stem, ext = os.path.splitext(name)
+            copy_name = '{} (replica-{}\'s conflicted copy {}){}'.format(stem, index, self.revision, ext)
+            self.cloud[copy_name] = (self.revision, data)
+            for j in range(len(self.replicas)):
+                self.schedule(self.get_delay(), ('download', j, copy_name, self.revision))
+            # The replica's own edit is lost: it gets the cloud version back
+            self.schedule(self.get_delay(), ('download', index, name, current))
+            return
+        self.stats['uploads'] += 1
+        self.cloud[name] = (self.revision, data)
+        self.uploaded[index][name] = self.revision
+        known = self.seen[index].get(name)
+        if known:
+            self.seen[index][name] = (known[0], self.revision)
+        for j in range(len(self.replicas)):
+            if j != index:
+                self.schedule(self.get_delay(), ('download', j, name, self.revision))
+
+    def download(self, index, name, revision):
+        current, data = self.cloud.get(name, (0, None))
+        if current != revision or data is None:
+            # A newer version is on its way
+            return
+        path = os.path.join(self.replicas[index], name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(path), '~dropbox-{}.tmp'.format(self.counter))
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        st = os.stat(path)
+        self.seen[index][name] = ((st.st_mtime_ns, st.st_size), revision)
+        self.stats['downloads'] += 1
+
+    def run(self):
+        while not self.stopped.is_set():
+            for index in range(len(self.replicas)):
+                self.scan(index)
+            now = time.monotonic()
+            while self.pending and self.pending[0][0] <= now:
+                action = heapq.heappop(self.pending)[2]
+                getattr(self, action[0])(*action[1:])
+            self.stopped.wait(DROPBOX_POLL_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def conflicted_copies(self):
+        return sum(1 for name in self.cloud if 'conflicted copy' in name)
+
+#------------------------------------------------------------------------------
+# Stand-in for the public IP websites: GET /<ip> answers <ip>, so every
+# simulated player can be given its own address with -e.
+#------------------------------------------------------------------------------
+class ip_handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.path.strip('/').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_ip_server():
+    server = HTTPServer(('127.0.0.1', 0), ip_handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+#------------------------------------------------------------------------------
+# One simulated world: a replica of the server folder per player, the fake
+# Dropbox between them and the players' processes.
+#------------------------------------------------------------------------------
+class Simulation:
+    def __init__(self, options, work_dir, name, env, ip_base, central, rng):
+        self.options = options
+        self.dir = os.path.join(work_dir, name)
+        self.env = env
+        self.ip_base = ip_base
+        self.central = central
+        self.launches_path = os.path.join(self.dir, 'launches.txt')
+        self.replicas = []
+        for i in range(options.clients):
+            replica = os.path.join(self.dir, 'replica-{}'.format(i), WORLD_NAME)
+            os.makedirs(replica)
+            open(os.path.join(replica, 'server.jar'), 'w').close()
+            os.makedirs(os.path.join(self.dir, 'home-{}'.format(i)))
+            self.replicas.append(replica)
+        self.dropbox = FakeDropbox(self.replicas, options.sync_delay, options.sync_jitter, options.conflict_rate, rng)
+        self.processes = []
+        self.log_files = []
+        self.dropbox.start()
+        if central:
+            reset_central(central)
+
+    def get_ip(self, index):
+        return '10.0.{}.{}'.format(index // 250, index % 250 + 1)
+
+    def command(self, index, *args):
+        command = [sys.executable, CLIENT, '-p', self.replicas[index], '-z', '-x', '-e', '{}/{}'.format(self.ip_base, self.get_ip(index)),
+                   '-b', str(self.options.heartbeat_time), '-L', str(self.options.lease_time)]
+        if self.central:
+            command += ['-s', self.central, '-k', SECRET_KEY]
+        return command + list(args)
+
+    def get_env(self, index):
+        return dict(self.env, HOME=os.path.join(self.dir, 'home-{}'.format(index)), FAKE_JVM_LAUNCHES=self.launches_path)
+
+    def spawn(self, index, *args):
+        log = open(os.path.join(self.dir, 'client-{}.log'.format(index)), 'a')
+        process = subprocess.Popen(self.command(index, *args), env=self.get_env(index), stdout=log, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL, start_new_session=True)
+        self.processes.append(process)
+        self.log_files.append(log)
+        return process
+
+    def run(self, index, *args):
+        return subprocess.run(self.command(index, *args), env=self.get_env(index), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              stdin=subprocess.DEVNULL, timeout=60).stdout.decode('utf-8', 'replace')
+
+    # The client, its shell and its java all go
+    def kill(self, process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        process.wait()
+
+    def launches(self):
+        try:
+            with open(self.launches_path) as f:
+                return [(float(line.split(' ', 1)[0]), line.split(' ', 1)[1].strip()) for line in f if line.strip()]
+        except OSError:
+            return []
+
+    def wait_for_launches(self, count, deadline, after=0):
+        while time.time() < deadline:
+            launches = [launch for launch in self.launches() if launch[0] >= after]
+            if len(launches) >= count:
+                return launches
+            time.sleep(0.02)
+        return [launch for launch in self.launches() if launch[0] >= after]
+
+    # (uploads, bytes) of the status files so far
+    def status_uploads(self):
+        uploads, size = 0, 0
+        for name, counts in self.dropbox.uploads_by_file.copy().items():
+            if name == STATUS_FILE_NAME or name.startswith(STATUS_DIR_NAME + os.sep):
+                uploads += counts[0]
+                size += counts[1]
+        return uploads, size
+
+    # Whether each replica has a status file (per-host or the old single one)
+    # naming this host
+    def sees_host(self, ip):
+        seen = []
+        for replica in self.replicas:
+            paths = [os.path.join(replica, STATUS_FILE_NAME)]
+            status_dir = os.path.join(replica, STATUS_DIR_NAME)
+            if os.path.isdir(status_dir):
+                paths += [os.path.join(status_dir, name) for name in os.listdir(status_dir) if name.endswith('.txt')]
+            found = False
+            for path in paths:
+                try:
+                    with open(path) as f:
+                        found = found or f.readline().strip() == ip
+                except OSError:
+                    pass
+            seen.append(found)
+        return all(seen)
+
+    def close(self):
+        for process in self.processes:
+            self.kill(process)
+        for log in self.log_files:
+            log.close()
+        self.dropbox.stop()
+
+def reset_central(central):
+    body = json.dumps({'updates': [{'server': WORLD_NAME, 'key': SECRET_KEY, 'message': 'stopped'}]}).encode()
+    base = central.rsplit('/worlds/', 1)[0]
+    request = urllib.request.Request(base + '/v2/updates', body, {'Content-Type': 'application/json'})
+    urllib.request.urlopen(request, timeout=5).read()
+
+def wait_for_central(central, deadline):
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(central + '?' + urllib.parse.urlencode({'key': SECRET_KEY}), timeout=1).read()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+#------------------------------------------------------------------------------
+# Scenarios
+#------------------------------------------------------------------------------
+def run_detect(simulation, options):
+    host = simulation.get_ip(0)
+    simulation.spawn(0)
+    launch = simulation.wait_for_launches(1, time.time() + options.timeout)
+    if not launch:
+        return {'propagation': None, 'queries': [], 'wrong_answers': 0}
+    launched_at = launch[0][0]
+    propagation = None
+    while time.time() < launched_at + options.timeout:
+        if simulation.sees_host(host):
+            propagation = time.time() - launched_at
+            break
+        time.sleep(0.02)
+
+    # Everyone else asks at the same time
+    results = [None] * (options.clients - 1)
+    def query(i):
+        started = time.time()
+        output = simulation.run(i + 1, '-q')
+        results[i] = (time.time() - started, 'Server is running at ' + host in output)
+    threads = [Thread(target=query, args=(i,)) for i in range(options.clients - 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'propagation': propagation, 'queries': [elapsed for elapsed, right in results], 'wrong_answers': sum(1 for elapsed, right in results if not right)}
+
+def run_takeover(simulation, options):
+    host = simulation.spawn(0)
+    if not simulation.wait_for_launches(1, time.time() + options.timeout):
+        return {'takeover': None, 'launches': 0, 'early_launches': 0}
+    # Every launch from here on is a standby's: one that launches before the
+    # host is killed is hosting next to it
+    spawned_at = time.time()
+    for i in range(1, options.clients):
+        simulation.spawn(i, '-S', '-X', str(options.settle))
+    # Let the standbys get ready and the host's lease reach them
+    time.sleep(2 * options.sync_delay + 2)
+    crashed_at = time.time()
+    simulation.kill(host)
+    launches = simulation.wait_for_launches(1, crashed_at + options.lease_time + options.settle + 4 * options.sync_delay + options.timeout, spawned_at)
+    if launches:
+        # Whoever else thinks it won shows up within the settle time and a sync
+        time.sleep(options.settle + 4 * options.sync_delay + 2)
+        launches = [launch for launch in simulation.launches() if launch[0] >= spawned_at]
+    # Negative if a standby launched before the crash
+    return {'takeover': min(launch[0] for launch in launches) - crashed_at if launches else None, 'launches': len(launches),
+            'early_launches': sum(1 for launch in launches if launch[0] < crashed_at)}
+
+def run_race(simulation, options):
+    started_at = time.time()
+    for i in range(options.clients):
+        simulation.spawn(i)
+    simulation.wait_for_launches(options.clients, started_at + options.timeout)
+    # Nobody launches after a first heartbeat has synced everywhere
+    time.sleep(2 * options.sync_delay + options.heartbeat_time + 2)
+    return {'launches': len(simulation.launches())}
+
+# What hosting for options.lease_duration seconds costs in status file uploads
+def measure_lease(simulation, index, lease_time, options):
+    started_at = time.time()
+    process = simulation.spawn(index, '-L', str(lease_time))
+    if not simulation.wait_for_launches(1, started_at + options.timeout, started_at):
+        simulation.kill(process)
+        return None
+    # Only the renewals count, not the claim
+    time.sleep(2 * options.sync_delay + 1)
+    uploads, size = simulation.status_uploads()
+    started = time.time()
+    time.sleep(options.lease_duration)
+    elapsed = time.time() - started
+    new_uploads, new_size = simulation.status_uploads()
+    simulation.kill(process)
+    return {'lease_time': lease_time, 'writes_per_hour': round((new_uploads - uploads) * 3600 / elapsed),
+            'bytes_per_hour': round((new_size - size) * 3600 / elapsed)}
+
+def run_lease(simulation, options):
+    # The default lease is twice the heartbeat time
+    result = {'default': measure_lease(simulation, 0, 2 * options.heartbeat_time, options)}
+    # Until the first host's lease (killed, not stopped) has lapsed everywhere.
+    # The central server also hands the server over only once it hasn't heard
+    # from that host for the lease time of whoever asks.
+    time.sleep(max(2 * options.heartbeat_time, options.long_lease if simulation.central else 0) + 4 * options.sync_delay + 1)
+    result['long'] = measure_lease(simulation, 1, options.long_lease, options)
+    return result
+
+def run_central_load(base, options):
+    worlds = ['bench-{}'.format(i) for i in range(options.central_worlds)]
+    deadline = time.time() + options.central_duration
+    latencies, errors, lock = [], [0], Lock()
+    def load(index):
+        connection = http.client.HTTPConnection(base.split('://', 1)[1], timeout=10)
+        mine, failed = [], 0
+        world = worlds[index % len(worlds)]
+        update = json.dumps({'updates': [{'server': world, 'key': SECRET_KEY, 'message': 'started', 'ip': '10.1.0.{}'.format(index % 250 + 1),
+                                          'telemetry': [50.0, 2048.0, 0, 1024, 40, 20.0, 3, 0]}]})
+        status = '/worlds/{}?{}'.format(world, urllib.parse.urlencode({'key': SECRET_KEY}))
+        i = 0
+        while time.time() < deadline:
+            started = time.perf_counter()
+            try:
+                if i % 2:
+                    connection.request('GET', status)
+                else:
+                    connection.request('POST', '/v2/updates', update, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+                mine.append(time.perf_counter() - started)
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                connection = http.client.HTTPConnection(base.split('://', 1)[1], timeout=10)
+            i += 1
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+    threads = [Thread(target=load, args=(i,)) for i in range(options.central_connections)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    return {'central_requests_per_second': round(len(latencies) / elapsed, 1), 'central_p50': percentile(latencies, 0.5, 1, 4),
+            'central_p99': percentile(latencies, 0.99, 1, 4), 'central_errors': errors[0]}
+
+#------------------------------------------------------------------------------
+def main():
+    parser = OptionParser(description='Simulate many players sharing a server through a fake Dropbox (and optionally a central server), and measure detection, takeover, double hosting and central server throughput.')
+    parser.add_option('-n', '--clients', help='Number of simulated players (Default: 4)', dest='clients', type='int', default=4)
+    parser.add_option('-r', '--rounds', help='Rounds of each scenario (Default: 2)', dest='rounds', type='int', default=2)
+    parser.add_option('-D', '--sync-delay', help='Mean delay, in seconds, of each Dropbox upload and download (Default: 0.5)', dest='sync_delay', type='float', default=0.5)
+    parser.add_option('-J', '--sync-jitter', help='Each delay is the mean plus or minus this fraction of it (Default: 0.5)', dest='sync_jitter', type='float', default=0.5)
+    parser.add_option('-C', '--conflict-rate', help='Fraction of uploads turned into conflicted copies even though nothing conflicted (Default: 0.05)', dest='conflict_rate', type='float', default=0.05)
+    parser.add_option('-b', '--heartbeat', help='Heartbeat time of every client (Default: 1)', dest='heartbeat_time', type='int', default=1)
+    parser.add_option('-L', '--lease-time', help='Lease time of every client (Default: 3)', dest='lease_time', type='int', default=3)
+    parser.add_option('-X', '--standby-settle', help='Settle time of the standbys (Default: 2)', dest='settle', type='float', default=2)
+    parser.add_option('-g', '--long-lease', help='Lease time of the second host of the lease scenario (Default: 20)', dest='long_lease', type='int', default=20)
+    parser.add_option('-u', '--lease-duration', help='Seconds each host of the lease scenario is measured for (Default: 60)', dest='lease_duration', type='float', default=60)
+    parser.add_option('-c', '--central', help='Also run the players against a central server.', dest='central', action='store_true', default=False)
+    parser.add_option('-s', '--scenarios', help='Comma separated scenarios to run (Default: detect,takeover,race,lease,central)', dest='scenarios', type='string', default='detect,takeover,race,lease,central')
+    parser.add_option('-T', '--central-connections', help='Connections loading the central server (Default: 16)', dest='central_connections', type='int', default=16)
+    parser.add_option('-W', '--central-worlds', help='Worlds registered on the central server for the load test (Default: 50)', dest='central_worlds', type='int', default=50)
+    parser.add_option('-d', '--central-duration', help='Seconds to load the central server for (Default: 5)', dest='central_duration', type='float', default=5)
+    parser.add_option('-t', '--timeout', help='Give up waiting for something after this many seconds (Default: 20)', dest='timeout', type='float', default=20)
+    parser.add_option('-e', '--seed', help='Random seed for the fake Dropbox (Default: 1)', dest='seed', type='int', default=1)
+    parser.add_option('-k', '--keep', help='Keep the scratch folder (with every client log) and print where it is.', dest='keep', action='store_true', default=False)
+    parser.add_option('-j', '--json', help='Print the results as JSON.', dest='json', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    scenarios = options.scenarios.split(',')
+    unknown = set(scenarios) - {'detect', 'takeover', 'race', 'lease', 'central'}
+    if unknown:
+        parser.error('Unknown scenario(s): {}'.format(', '.join(sorted(unknown))))
+    if options.clients < 2:
+        parser.error('At least two clients are needed.')
+    if options.lease_time < 2 * options.heartbeat_time:
+        parser.error('The lease time must be at least twice the heartbeat time.')
+
+    rng = random.Random(options.seed)
+    work_dir = tempfile.mkdtemp(prefix='mc-dbox-simulate-')
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    write_fake_java(bin_dir)
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''), PYTHONUNBUFFERED='1')
+
+    ip_server = start_ip_server()
+    ip_base = 'http://127.0.0.1:{}'.format(ip_server.server_address[1])
+    central_process, central, central_base = None, None, None
+    summary = {'clients': options.clients, 'rounds': options.rounds, 'central': options.central, 'sync_delay': options.sync_delay,
+               'conflict_rate': options.conflict_rate, 'heartbeat': options.heartbeat_time, 'lease_time': options.lease_time, 'settle': options.settle}
+    results = {}
+    conflicts = 0
+    try:
+        if options.central or 'central' in scenarios:
+            port = get_free_port()
+            central_base = 'http://127.0.0.1:{}'.format(port)
+            registry = {WORLD_NAME: SECRET_KEY}
+            registry.update(('bench-{}'.format(i), SECRET_KEY) for i in range(options.central_worlds))
+            with open(os.path.join(work_dir, 'registry.json'), 'w') as f:
+                json.dump(registry, f)
+            os.makedirs(os.path.join(work_dir, 'central'))
+            central_log = open(os.path.join(work_dir, 'central.log'), 'w')
+            central_process = subprocess.Popen([sys.executable, CENTRAL, '-p', str(port), '-r', os.path.join(work_dir, 'registry.json'), '-d', os.path.join(work_dir, 'central')],
+                                               stdout=central_log, stderr=subprocess.STDOUT)
+            if not wait_for_central(central_base + '/worlds/' + WORLD_NAME, time.time() + 10):
+                exit('The central server did not come up.')
+            if options.central:
+                central = central_base + '/worlds/' + WORLD_NAME
+
+        for scenario, run in (('detect', run_detect), ('takeover', run_takeover), ('race', run_race), ('lease', run_lease)):
+            if scenario not in scenarios:
+                continue
+            results[scenario] = []
+            for i in range(options.rounds):
+                simulation = Simulation(options, work_dir, '{}-{}'.format(scenario, i), env, ip_base, central, rng)
+                try:
+                    result = run(simulation, options)
+                finally:
+                    simulation.close()
+                result['bytes_uploaded'] = simulation.dropbox.stats['bytes_uploaded']
+                conflicts += simulation.dropbox.conflicted_copies()
+                results[scenario].append(result)
+                if not options.json:
+                    print('{} round {}: {}'.format(scenario, i + 1, json.dumps(result)))
+
+        if 'detect' in results:
+            propagation = [r['propagation'] for r in results['detect'] if r['propagation'] is not None]
+            queries = [elapsed for r in results['detect'] for elapsed in r['queries']]
+            summary.update(detect_propagation_median=percentile(propagation, 0.5, 1, 4), detect_query_median=percentile(queries, 0.5, 1, 4),
+                           detect_query_p95=percentile(queries, 0.95, 1, 4), detect_wrong_answers=sum(r['wrong_answers'] for r in results['detect']))
+        if 'takeover' in results:
+            times = [r['takeover'] for r in results['takeover'] if r['takeover'] is not None]
+            summary.update(takeover_median=percentile(times, 0.5, 1, 4), takeover_max=percentile(times, 1, 1, 4),
+                           takeover_missed=sum(1 for r in results['takeover'] if not r['launches']),
+                           takeover_early_launches=sum(r['early_launches'] for r in results['takeover']),
+                           takeover_double_hosts=sum(1 for r in results['takeover'] if r['launches'] > 1 or r['early_launches']))
+        if 'race' in results:
+            summary.update(race_double_hosts=sum(1 for r in results['race'] if r['launches'] > 1),
+                           race_missed=sum(1 for r in results['race'] if not r['launches']))
+        if 'lease' in results:
+            for mode in ('default', 'long'):
+                measured = [r[mode] for r in results['lease'] if r[mode]]
+                summary['lease_{}_time'.format(mode)] = measured[0]['lease_time'] if measured else None
+                for key in ('writes_per_hour', 'bytes_per_hour'):
+                    summary['lease_{}_{}'.format(mode, key)] = percentile([m[key] for m in measured], 0.5, 1, 4)
+        summary['double_host_incidents'] = summary.get('takeover_double_hosts', 0) + summary.get('race_double_hosts', 0)
+        summary['conflicted_copies'] = conflicts
+        summary['dropbox_bytes_uploaded'] = sum(r['bytes_uploaded'] for rounds in results.values() for r in rounds)
+        if 'central' in scenarios:
+            summary.update(run_central_load(central_base, options))
+    finally:
+        if central_process:
+            central_process.terminate()
+            central_process.wait()
+            central_log.close()
+        ip_server.shutdown()
+        if options.keep:
+            print('Scratch folder kept at ' + work_dir, file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if options.json:
+        print(json.dumps(dict(summary, results=results)))
+    else:
+        for key, value in summary.items():
+            print('{:30s}{}'.format(key, value))
+
+main()
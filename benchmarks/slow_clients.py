@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+##
+## Copyright (C) 2015 João Ricardo Lourenço <jorl17.8@gmail.com>
+##
+## Github: https://github.com/Jorl17
+##
+## Project main repository: https://github.com/Jorl17/minecraft-dropbox-server
+##
+## This file is part of minecraft-dropbox-server.
+##
+## minecraft-dropbox-server is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 2 of the License, or
+## (at your option) any later version.
+##
+## minecraft-dropbox-server is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with minecraft-dropbox-server.  If not, see <http://www.gnu.org/licenses/>.
+##
+#------------------------------------------------------------------------------
+# Slow client test. Measures the latency of well-behaved clients (each
+# request on a new connection, like a heartbeat after a long pause) against a
+# central server, first alone and then with many misbehaving clients attached:
+# some connect and send nothing, some trickle a request in a byte at a time,
+# some announce a body and trickle that. Slow clients that get cut off connect
+# again straight away. Exits with 1 if the latency under attack isn't flat
+# (p99 within twice the baseline's, or 20ms of it), so it can be run as a
+# test. Try it with -w single to see what happens without the protections
+# of the threaded workers.
+#------------------------------------------------------------------------------
+from optparse import OptionParser
+from threading import Thread, Event, Lock
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from _common import CENTRAL, get_free_port, percentile
+
+SECRET_KEY = 'slow-clients'
+SLOW_KINDS = ('silent', 'trickle', 'slow-body')
+
+def wait_for_central(port, deadline):
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+class SlowClient(Thread):
+    def __init__(self, port, kind, stopped, stats):
+        Thread.__init__(self, daemon=True)
+        self.port = port
+        self.kind = kind
+        self.stopped = stopped
+        self.stats = stats
+
+    def attack(self, sock):
+        if self.kind == 'silent':
+            # Blocks until the server gives up on us
+            sock.recv(1)
+            return
+        if self.kind == 'trickle':
+            sock.sendall(b'GET /?key=' + SECRET_KEY.encode() + b' HTTP/1.1\r\n')
+            chunk = b'X-Padding: ' + b'x' * 1000
+        else:
+            sock.sendall(b'POST /v2/updates HTTP/1.1\r\nContent-Type: application/json\r\nContent-Length: 100000\r\n\r\n')
+            chunk = b' ' * 100000
+        for byte in chunk:
+            if self.stopped.is_set():
+                return
+            sock.sendall(bytes([byte]))
+            self.stopped.wait(0.5)
+
+    def run(self):
+        while not self.stopped.is_set():
+            started = time.time()
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), timeout=120) as sock:
+                    self.stats.add('connections')
+                    self.attack(sock)
+            except OSError:
+                pass
+            if not self.stopped.is_set():
+                self.stats.add('cut_off')
+                self.stats.record('cut_off_after', time.time() - started)
+                # Don't spin if the server refuses us outright
+                self.stopped.wait(0.05)
+
+class Stats:
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = {}
+        self.values = {}
+
+    def add(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def record(self, name, value):
+        with self.lock:
+            self.values.setdefault(name, []).append(value)
+
+def measure(port, clients, duration):
+    status = '/?' + urllib.parse.urlencode({'key': SECRET_KEY})
+    heartbeat = json.dumps({'updates': [{'server': '', 'key': SECRET_KEY, 'message': 'started', 'ip': '10.0.0.1'}]})
+    latencies, failures, lock = [], [0], Lock()
+    deadline = time.time() + duration
+    def client(index):
+        mine, failed = [], 0
+        i = 0
+        while time.time() < deadline:
+            started = time.perf_counter()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            try:
+                if i % 2:
+                    connection.request('GET', status)
+                else:
+                    connection.request('POST', '/v2/updates', heartbeat, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                if response.status == 200:
+                    mine.append(time.perf_counter() - started)
+                else:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+            finally:
+                connection.close()
+            i += 1
+            time.sleep(0.01)
+        with lock:
+            latencies.extend(mine)
+            failures[0] += failed
+    threads = [Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'requests': len(latencies), 'failures': failures[0], 'p50': percentile(latencies, 0.5, 1, 5),
+            'p99': percentile(latencies, 0.99, 1, 5), 'max': percentile(latencies, 1, 1, 5)}
+
+def main():
+    parser = OptionParser(description='Check that well-behaved clients of the central server keep their latency while many slow clients are attached.')
+    parser.add_option('-n', '--slow-clients', help='Number of slow clients (Default: 100)', dest='slow_clients', type='int', default=100)
+    parser.add_option('-g', '--good-clients', help='Number of well-behaved clients (Default: 4)', dest='good_clients', type='int', default=4)
+    parser.add_option('-d', '--duration', help='Seconds to measure for, alone and under attack (Default: 10)', dest='duration', type='float', default=10)
+    parser.add_option('-w', '--workers', help='Worker model of the central server (Default: its own default)', dest='worker_mode', type='string', default=None)
+    parser.add_option('-q', '--request-timeout', help='Request timeout of the central server (Default: 2)', dest='request_timeout', type='float', default=2)
+    parser.add_option('-i', '--idle-timeout', help='Idle timeout of the central server (Default: 5)', dest='idle_timeout', type='float', default=5)
+    parser.add_option('-m', '--max-connections', help='Connection limit of the central server (Default: its own default)', dest='max_connections', type='int', default=None)
+    parser.add_option('-j', '--json', help='Print the results as JSON.', dest='json', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='mc-dbox-slow-clients-')
+    port = get_free_port()
+    command = [sys.executable, CENTRAL, '-p', str(port), '-k', SECRET_KEY, '-f', os.path.join(work_dir, 'central.txt'),
+               '-q', str(options.request_timeout), '-i', str(options.idle_timeout)]
+    if options.worker_mode:
+        command += ['-w', options.worker_mode]
+    if options.max_connections:
+        command += ['-m', str(options.max_connections)]
+    central = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    stopped, stats = Event(), Stats()
+    try:
+        if not wait_for_central(port, time.time() + 10):
+            exit('The central server did not come up.')
+        baseline = measure(port, options.good_clients, options.duration)
+        slow = [SlowClient(port, SLOW_KINDS[i % len(SLOW_KINDS)], stopped, stats) for i in range(options.slow_clients)]
+        for client in slow:
+            client.start()
+        # Let them all get attached first
+        time.sleep(1)
+        attacked = measure(port, options.good_clients, options.duration)
+        stopped.set()
+    finally:
+        stopped.set()
+        central.terminate()
+        central.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    flat = attacked['p99'] is not None and baseline['p99'] is not None and attacked['failures'] == 0 and \
+           attacked['p99'] <= max(2 * baseline['p99'], baseline['p99'] + 0.02)
+    cut_off = stats.values.get('cut_off_after', [])
+    summary = {'slow_clients': options.slow_clients, 'good_clients': options.good_clients, 'worker_mode': options.worker_mode or 'default',
+               'request_timeout': options.request_timeout, 'idle_timeout': options.idle_timeout,
+               'baseline': baseline, 'attacked': attacked,
+               'slow_connections': stats.counts.get('connections', 0), 'slow_cut_off': stats.counts.get('cut_off', 0),
+               'slow_cut_off_median': percentile(cut_off, 0.5, 1, 5), 'flat': flat}
+    if options.json:
+        print(json.dumps(summary))
+    else:
+        for key, value in summary.items():
+            print('{:24s}{}'.format(key, value))
+    sys.exit(0 if flat else 1)
+
+main()
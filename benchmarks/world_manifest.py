@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+##
+## Copyright (C) 2015 João Ricardo Lourenço <jorl17.8@gmail.com>
+##
+## Github: https://github.com/Jorl17
+##
+## Project main repository: https://github.com/Jorl17/minecraft-dropbox-server
+##
+## This file is part of minecraft-dropbox-server.
+##
+## minecraft-dropbox-server is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 2 of the License, or
+## (at your option) any later version.
+##
+## minecraft-dropbox-server is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with minecraft-dropbox-server.  If not, see <http://www.gnu.org/licenses/>.
+##
+#------------------------------------------------------------------------------
+# World manifest benchmark. Generates a multi-GB world of region-sized files
+# and times what the client does with it (write_world_manifest when a host
+# stops, find_unsynced_files when the next one starts): without a hash index,
+# with a warm one, and with a few region files changed since the last manifest.
+# Hashing the whole world one file at a time, as a single-threaded check with
+# no index would, is timed as the baseline. With -D the page cache is dropped
+# before the cold runs (needs root), so they read from disk as after a reboot.
+#------------------------------------------------------------------------------
+from optparse import OptionParser
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from _common import load_client
+
+MAX_REGION_MB = 12
+
+# Region files of 1 to MAX_REGION_MB MB, in the folders a world has them
+def generate_world(path, size_mb, seed):
+    rng = random.Random(seed)
+    written, i = 0, 0
+    chunk = os.urandom(1 << 20)
+    while written < size_mb:
+        folder = ('world/region', 'world/DIM-1/region', 'world/DIM1/region')[i % 3]
+        os.makedirs(os.path.join(path, folder), exist_ok=True)
+        size = min(rng.randint(1, MAX_REGION_MB), size_mb - written)
+        with open(os.path.join(path, folder, 'r.{}.{}.mca'.format(i // 32, i % 32)), 'wb') as f:
+            for j in range(size):
+                # Every MB differs, so nothing hashes the same by accident
+                f.write(j.to_bytes(8, 'little') + i.to_bytes(8, 'little') + chunk[16:])
+        written += size
+        i += 1
+    return i
+
+def change_files(path, count, seed):
+    rng = random.Random(seed)
+    regions = sorted(os.path.join(dirpath, name) for dirpath, dirnames, filenames in os.walk(path) for name in filenames if name.endswith('.mca'))
+    for region in rng.sample(regions, min(count, len(regions))):
+        with open(region, 'r+b') as f:
+            f.seek(rng.randrange(os.path.getsize(region)))
+            f.write(os.urandom(4096))
+
+def drop_caches():
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except OSError:
+        return False
+
+def timed(f):
+    started = time.monotonic()
+    result = f()
+    return round(time.monotonic() - started, 3), result
+
+def main():
+    parser = OptionParser(description='Time writing and checking the world manifest of a generated multi-GB world.')
+    parser.add_option('-s', '--size', help='Size of the generated world, in MB (Default: 4096)', dest='size', type='int', default=4096)
+    parser.add_option('-c', '--changed', help='Region files changed before the last check (Default: 5)', dest='changed', type='int', default=5)
+    parser.add_option('-d', '--dir', help='Folder to generate the world in (Default: a temporary folder)', dest='dir', type='string', default=None)
+    parser.add_option('-D', '--drop-caches', help='Drop the page cache before the cold runs (needs root).', dest='drop_caches', action='store_true', default=False)
+    parser.add_option('-r', '--seed', help='Random seed (Default: 1)', dest='seed', type='int', default=1)
+    parser.add_option('-j', '--json', help='Print the results as JSON.', dest='json', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='mc-dbox-manifest-', dir=options.dir)
+    # Keep the hash index out of the real home folder
+    os.environ['HOME'] = os.path.join(work_dir, 'home')
+    world = os.path.join(work_dir, 'server')
+    results = {'size_mb': options.size, 'changed': options.changed}
+    quiet = open(os.devnull, 'w')
+    try:
+        results['generate_s'], results['files'] = timed(lambda: generate_world(world, options.size, options.seed))
+        client = load_client()
+        index_path = client.get_hash_index_path(world)
+        def check():
+            # The client prints its progress; only the timings matter here
+            stdout, sys.stdout = sys.stdout, quiet
+            try:
+                return client.find_unsynced_files(world, client.read_world_manifest(world))
+            finally:
+                sys.stdout = stdout
+        def cold():
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            if options.drop_caches:
+                results['caches_dropped'] = drop_caches()
+
+        cold()
+        results['serial_hash_s'], digests = timed(lambda: [client.hash_file(os.path.join(world, path)) for path in client.scan_tree(world)])
+        cold()
+        stdout, sys.stdout = sys.stdout, quiet
+        try:
+            results['write_cold_s'], unused = timed(lambda: client.write_world_manifest(world))
+        finally:
+            sys.stdout = stdout
+        results['check_warm_s'], unsynced = timed(check)
+        assert not unsynced, unsynced
+        cold()
+        results['check_cold_s'], unsynced = timed(check)
+        assert not unsynced, unsynced
+        change_files(world, options.changed, options.seed)
+        results['check_changed_s'], unsynced = timed(check)
+        results['unsynced'] = len(unsynced)
+        results['speedup_warm'] = round(results['serial_hash_s'] / max(results['check_warm_s'], 1e-3), 1)
+        results['throughput_cold_mb_s'] = round(options.size / max(results['check_cold_s'], 1e-3), 1)
+    finally:
+        quiet.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if options.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print('{:24s}{}'.format(key, value))
+
+main()
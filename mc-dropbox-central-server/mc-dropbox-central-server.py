@@ -21,87 +21,768 @@
 ## You should have received a copy of the GNU General Public License
 ## along with minecraft-dropbox-server.  If not, see <http://www.gnu.org/licenses/>.
 ##
-import cgi
 from optparse import OptionParser
 import urllib.parse
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
+import selectors
+import socket
+import socketserver
+import threading
+import heapq
+import bisect
+import io
+from collections import deque
 import os
 import time
 import json
+import math
 
 HOST_NAME = "0.0.0.0"
 HOST_PORT = 9000
 DEFAULT_FILE_NAME = 'mc_dropbox_server_status_central.txt'
+DEFAULT_REGISTRY_FILE_NAME = 'mc_dropbox_server_status_central_{}.txt'
+WORLDS_PATH = '/worlds/'
+BULK_PATH = '/bulk'
+V2_UPDATES_PATH = '/v2/updates'
+TELEMETRY_PATH = '/telemetry'
+METRICS_PATH = '/metrics'
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+TELEMETRY_RING_SIZE = 1440
+# What clients send with each heartbeat; we add the time and the host's IP
+TELEMETRY_FIELDS = ('cpu', 'rss', 'read', 'write', 'threads', 'tps', 'players', 'behind')
+MAX_REQUEST_BODY = 1024 * 1024
+DEFAULT_WATCH_TIMEOUT = 30
+MAX_WATCH_TIMEOUT = 300
+KEEP_ALIVE_TIMEOUT = 75
+DEFAULT_REQUEST_TIMEOUT = 10
+DEFAULT_MAX_CONNECTIONS = 256
+DEFAULT_BACKLOG = 128
+SHED_RESPONSE = b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+WORKER_MODES = ('single', 'threaded', 'pool')
+DEFAULT_WORKER_MODE = 'threaded'
+DEFAULT_POOL_SIZE = 16
+JOURNAL_SUFFIX = '.journal'
+DEFAULT_FSYNC_INTERVAL = 1.0
+DEFAULT_COMPACT_EVERY = 1000
 
-# This is fugly
-global_key = None
-global_filepath = None
-def get_key():
-    return global_key
+#------------------------------------------------------------------------------
+# Metrics, exposed in the Prometheus text format at /metrics. Recording is
+# meant to be cheap enough for every request: a bisect and two additions
+# under a lock nobody holds for longer than that. All the formatting happens
+# when /metrics is scraped.
+#------------------------------------------------------------------------------
+class latency_histogram(object):
 
-def get_filepath():
-    return global_filepath
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
 
-class mc_dropbox_state_server(BaseHTTPRequestHandler):
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
 
-    def __init__(self, request, client_address, server):
-        self.state = None
-        super().__init__(request, client_address, server)
-        key = get_key()
+    def render(self, name, labels=''):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines, cumulative = [], 0
+        prefix = labels + ',' if labels else ''
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, prefix, bound, cumulative))
+        suffix = '{' + labels + '}' if labels else ''
+        lines.append('{}_sum{} {}'.format(name, suffix, total))
+        lines.append('{}_count{} {}'.format(name, suffix, cumulative))
+        return lines
 
-    def save_state(self):
-        if self.state:
-            with open(get_filepath(), 'w') as f:
-                f.write(self.state)
-        else:
-            try:
-                os.remove(get_filepath())
-            except:
+class mc_dropbox_metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.connections = 0
+        self.shed = 0
+
+    def observe_request(self, method, code, seconds):
+        key = (method if method in ('GET', 'POST') else 'OTHER', code)
+        histogram = self.requests.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.requests.setdefault(key, latency_histogram())
+        histogram.observe(seconds)
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def connection_shed(self):
+        with self.lock:
+            self.shed += 1
+
+    def render(self, registry, hub):
+        lines = ['# HELP mc_dropbox_request_duration_seconds Time taken to answer requests, by method and response code.',
+                 '# TYPE mc_dropbox_request_duration_seconds histogram']
+        for (method, code), histogram in sorted(self.requests.items()):
+            lines += histogram.render('mc_dropbox_request_duration_seconds', 'method="{}",code="{}"'.format(method, code))
+        lines += ['# HELP mc_dropbox_active_connections Connections currently being served.',
+                  '# TYPE mc_dropbox_active_connections gauge',
+                  'mc_dropbox_active_connections {}'.format(self.connections),
+                  '# HELP mc_dropbox_parked_watchers Long-poll watchers waiting for a state change.',
+                  '# TYPE mc_dropbox_parked_watchers gauge',
+                  'mc_dropbox_parked_watchers {}'.format(hub.count() if hub else 0),
+                  '# HELP mc_dropbox_shed_connections_total Connections turned away because too many were open.',
+                  '# TYPE mc_dropbox_shed_connections_total counter',
+                  'mc_dropbox_shed_connections_total {}'.format(self.shed)]
+
+        now = time.time()
+        online, heartbeats, transitions, writes, fsyncs = [], [], [], [], []
+        for name, state in sorted(registry.states.items()):
+            label = 'server="{}"'.format(name)
+            online.append('mc_dropbox_server_online{{{}}} {}'.format(label, 1 if state.get() else 0))
+            if state.last_heartbeat:
+                heartbeats.append('mc_dropbox_seconds_since_heartbeat{{{}}} {:.3f}'.format(label, now - state.last_heartbeat))
+            for transition, count in sorted(state.transitions.items()):
+                transitions.append('mc_dropbox_state_transitions_total{{{},transition="{}"}} {}'.format(label, transition, count))
+            writes += state.journal.write_latency.render('mc_dropbox_journal_write_seconds', label)
+            fsyncs += state.journal.fsync_latency.render('mc_dropbox_journal_fsync_seconds', label)
+        lines += ['# HELP mc_dropbox_server_online Whether someone is hosting the server.', '# TYPE mc_dropbox_server_online gauge'] + online
+        lines += ['# HELP mc_dropbox_seconds_since_heartbeat Time since the host last reported in.', '# TYPE mc_dropbox_seconds_since_heartbeat gauge'] + heartbeats
+        lines += ['# HELP mc_dropbox_state_transitions_total State changes, by kind.', '# TYPE mc_dropbox_state_transitions_total counter'] + transitions
+        lines += ['# HELP mc_dropbox_journal_write_seconds Time taken to append a state change to the journal.', '# TYPE mc_dropbox_journal_write_seconds histogram'] + writes
+        lines += ['# HELP mc_dropbox_journal_fsync_seconds Time taken by batched journal fsyncs.', '# TYPE mc_dropbox_journal_fsync_seconds histogram'] + fsyncs
+        return '\n'.join(lines) + '\n'
+
+#------------------------------------------------------------------------------
+# Persistence. The status file is a snapshot (IP of the host on the first line,
+# empty if nobody is hosting, and the sequence number of the last transition on
+# the second line). Every transition after the snapshot is appended to a
+# journal next to it, one JSON record per line. Appends are flushed straight
+# away but fsynced in batches by the flusher thread, which also compacts the
+# journal into a fresh snapshot once it grows past compact_every records.
+#------------------------------------------------------------------------------
+class mc_dropbox_journal(object):
+
+    def __init__(self, filepath, fsync_interval=DEFAULT_FSYNC_INTERVAL, compact_every=DEFAULT_COMPACT_EVERY):
+        self.filepath = filepath
+        self.journal_path = filepath + JOURNAL_SUFFIX
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.file = None
+        self.records = 0
+        self.unsynced = 0
+        self.seq = 0
+        self.ip = None
+        self.write_latency = latency_histogram()
+        self.fsync_latency = latency_histogram()
+
+    # Rebuild the state from the snapshot plus whatever is in the journal, then
+    # compact right away so the next restart only has to read the snapshot.
+    def load(self):
+        try:
+            with open(self.filepath) as f:
+                lines = f.read().split('\n')
+                self.ip = lines[0].strip() or None
+                if len(lines) > 1 and lines[1].strip():
+                    self.seq = int(lines[1])
+        except:
+            pass
+
+        try:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn write from a crash. Nothing after it was acknowledged.
+                        break
+                    if record['seq'] > self.seq:
+                        self.seq = record['seq']
+                        self.ip = record['ip']
+        except FileNotFoundError:
+            pass
+
+        self.compact()
+        return self.ip
+
+    def open(self):
+        if not self.file:
+            self.file = open(self.journal_path, 'a')
+        return self.file
+
+    def append(self, ip):
+        started = time.perf_counter()
+        with self.lock:
+            self.seq += 1
+            self.ip = ip
+            f = self.open()
+            f.write(json.dumps({'seq': self.seq, 'ip': ip, 'time': time.time()}) + '\n')
+            f.flush()
+            self.records += 1
+            self.unsynced += 1
+            if not self.fsync_interval:
+                os.fsync(f.fileno())
+                self.unsynced = 0
+        self.write_latency.observe(time.perf_counter() - started)
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced and self.file:
+                started = time.perf_counter()
+                os.fsync(self.file.fileno())
+                self.unsynced = 0
+                self.fsync_latency.observe(time.perf_counter() - started)
+        if self.records >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        with self.lock:
+            tmp_path = self.filepath + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write('{}\n{}\n'.format(self.ip or '', self.seq))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.filepath)
+            if self.file:
+                self.file.close()
+                self.file = None
+            with open(self.journal_path, 'w'):
                 pass
+            self.records = 0
+            self.unsynced = 0
+
+    def close(self):
+        self.compact()
+
+class journal_flusher(threading.Thread):
+
+    def __init__(self, journals, interval):
+        super().__init__(daemon=True)
+        self.journals = journals
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for journal in self.journals:
+                try:
+                    journal.sync()
+                except Exception as e:
+                    print(time.asctime(), 'Could not sync journal {}: {}'.format(journal.journal_path, e))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        for journal in self.journals:
+            journal.close()
+
+#------------------------------------------------------------------------------
+# The state of the Minecraft server (who is hosting it, if anyone). It is
+# loaded once when the central server starts and then shared by every request,
+# so all access goes through the lock. Reads never touch the disk; only actual
+# transitions are written to the journal.
+#------------------------------------------------------------------------------
+class mc_dropbox_state(object):
+
+    def __init__(self, journal, key):
+        self.journal = journal
+        self.key = key
+        self.lock = threading.Lock()
+        self.ip = journal.load()
+        self.version = journal.seq
+        self.listeners = []
+        self.telemetry = deque(maxlen=TELEMETRY_RING_SIZE)
+        # A host loaded from the journal may still be alive: it gets a full
+        # lease from our start before anyone may take over from it
+        self.last_heartbeat = time.time() if self.ip else None
+        self.transitions = {'started': 0, 'stopped': 0, 'taken_over': 0}
+        self.refresh()
+
+    def get(self):
+        with self.lock:
+            return self.ip
+
+    # Status replies are built once per change instead of once per request:
+    # (JSON body, ETag, complete response for parked watchers). The version is
+    # the ETag, so pollers that send If-None-Match get a bodyless 304.
+    def refresh(self):
+        if not self.ip:
+            d = {'online': False, 'version': self.version}
+        else:
+            d = {'online': True, 'ip': self.ip, 'version': self.version}
+        body = bytes(json.dumps(d), "utf-8")
+        etag = '"{}"'.format(self.version)
+        response = b'HTTP/1.1 200 OK\r\nContent-type: application/json\r\nContent-Length: ' + \
+                   bytes(str(len(body)), "utf-8") + b'\r\nETag: ' + bytes(etag, "utf-8") + b'\r\nConnection: close\r\n\r\n' + body
+        self.reply = (body, etag, response)
+
+    def changed(self):
+        self.version = self.journal.seq
+        self.refresh()
+        for listener in self.listeners:
+            listener(self)
+
+    # Returns None if the state was changed, or the IP of the current host if
+    # someone else is already running the server.
+    def start(self, ip):
+        with self.lock:
+            if self.ip and self.ip != ip:
+                return self.ip
+            self.last_heartbeat = time.time()
+            if self.ip != ip:
+                self.ip = ip
+                self.journal.append(ip)
+                self.transitions['started'] += 1
+                self.changed()
+            return None
+
+    # Like start, but also replaces the given previous host (whose lease has
+    # lapsed). Standbys race for a dead host through this, and since it is
+    # decided under the lock only the first one gets it. A previous host that
+    # sent us a heartbeat within the lease time is not dead, whatever the
+    # standby's copy of the lease says, so it is not replaced.
+    def take_over(self, ip, previous_ip, lease_time=0):
+        with self.lock:
+            if self.ip and self.ip not in (ip, previous_ip):
+                return self.ip
+            if self.ip and self.ip != ip and self.last_heartbeat and time.time() - self.last_heartbeat < lease_time:
+                return self.ip
+            self.last_heartbeat = time.time()
+            if self.ip != ip:
+                self.transitions['taken_over' if self.ip else 'started'] += 1
+                self.ip = ip
+                self.journal.append(ip)
+                self.changed()
+            return None
+
+    # Telemetry only lives in memory, in a fixed-size ring: the last
+    # TELEMETRY_RING_SIZE samples (a day, with the default heartbeat).
+    def record(self, ip, sample):
+        with self.lock:
+            self.telemetry.append((round(time.time(), 1), ip) + tuple(sample))
+
+    def get_telemetry(self, since=0):
+        with self.lock:
+            return [sample for sample in self.telemetry if sample[0] > since]
+
+    # Given the IP of the host that stopped, a stop from a host that has since
+    # been replaced is refused (returning the IP of the current one). Without
+    # one (a clear, or an older client) it always goes through.
+    def stop(self, ip=''):
+        with self.lock:
+            if self.ip and ip and ip != self.ip:
+                return self.ip
+            if self.ip:
+                self.ip = None
+                self.journal.append(None)
+                self.transitions['stopped'] += 1
+                self.changed()
+            return None
+
+    def to_dict(self):
+        with self.lock:
+            ip, version = self.ip, self.version
+        if not ip:
+            return {'online': False, 'version': version}
+        else:
+            return {'online': True, 'ip': ip, 'version': version}
+
+    def to_json(self):
+        return self.reply[0].decode("utf-8")
+
+#------------------------------------------------------------------------------
+# Long-poll watchers. A GET with watch=<version> whose version is still the
+# current one is parked here instead of being answered: the handler thread
+# hands the socket over and returns, and this single thread answers every
+# parked watcher as soon as the state changes (or its timeout expires). Idle
+# watchers therefore cost a file descriptor, not a thread.
+#------------------------------------------------------------------------------
+class watch_hub(threading.Thread):
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.changed_states = set()
+        self.watchers = {}
+        self.deadlines = []
+        self.detached = set()
+        self.stopped = False
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+    def wake(self):
+        try:
+            self.wake_w.send(b'x')
+        except OSError:
+            pass
+
+    def watch(self, state):
+        state.listeners.append(self.notify)
+
+    def notify(self, state):
+        with self.lock:
+            self.changed_states.add(state)
+        self.wake()
+
+    # Called from a handler thread. From now on the socket belongs to the hub.
+    def park(self, sock, state, version, timeout):
+        with self.lock:
+            self.detached.add(sock)
+            self.pending.append((sock, state, version, time.monotonic() + timeout))
+        self.wake()
+
+    def is_detached(self, sock):
+        with self.lock:
+            return sock in self.detached
+
+    def count(self):
+        return len(self.watchers)
+
+    def reply(self, sock, state):
+        response = state.reply[2]
+        try:
+            sock.settimeout(1)
+            sock.sendall(response)
+        except OSError:
+            pass
+        self.close(sock)
+
+    def close(self, sock):
+        if sock in self.watchers:
+            del self.watchers[sock]
+            self.selector.unregister(sock)
+        with self.lock:
+            self.detached.discard(sock)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def run(self):
+        while not self.stopped:
+            timeout = max(0, self.deadlines[0][0] - time.monotonic()) if self.deadlines else None
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    # A parked client should not send anything; if it does
+                    # (or hangs up), it is no longer waiting for us.
+                    self.close(key.fileobj)
+
+            with self.lock:
+                pending, self.pending = self.pending, []
+                changed, self.changed_states = self.changed_states, set()
+
+            for sock, state, version, deadline in pending:
+                if state.version != version:
+                    self.reply(sock, state)
+                else:
+                    self.watchers[sock] = (state, deadline)
+                    self.selector.register(sock, selectors.EVENT_READ)
+                    heapq.heappush(self.deadlines, (deadline, id(sock), sock))
+
+            if changed:
+                for sock, (state, deadline) in list(self.watchers.items()):
+                    if state in changed:
+                        self.reply(sock, state)
+
+            now = time.monotonic()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, _, sock = heapq.heappop(self.deadlines)
+                if sock in self.watchers and self.watchers[sock][1] == deadline:
+                    self.reply(sock, self.watchers[sock][0])
+
+        for sock in list(self.watchers):
+            self.close(sock)
+
+    def stop(self):
+        self.stopped = True
+        self.wake()
+        self.join()
+
+#------------------------------------------------------------------------------
+# Registry of all the Minecraft servers hosted by this process, indexed by
+# name. The server given with -k/-f is registered under the empty name, which
+# is what requests to the root path get. Named servers are reached at
+# /worlds/<name> (so a client just uses http://host:port/worlds/<name> as its
+# central server address).
+#------------------------------------------------------------------------------
+class mc_dropbox_registry(object):
+
+    def __init__(self):
+        self.states = {}
+
+    def add(self, name, state):
+        self.states[name] = state
+
+    def get(self, name):
+        return self.states.get(name)
+
+    def journals(self):
+        return [state.journal for state in self.states.values()]
+
+def is_valid_server_name(name):
+    return bool(name) and all(c.isalnum() or c in '-_.' for c in name) and name not in ('.', '..')
+
+def load_registry(registry_file, state_dir, fsync_interval, compact_every):
+    with open(registry_file) as f:
+        servers = json.load(f)
+
+    registry = mc_dropbox_registry()
+    for name, key in servers.items():
+        if not is_valid_server_name(name):
+            raise ValueError('Invalid server name {!r} (use letters, digits, "-", "_" and ".")'.format(name))
+        filepath = os.path.join(state_dir, DEFAULT_REGISTRY_FILE_NAME.format(name))
+        registry.add(name, mc_dropbox_state(mc_dropbox_journal(filepath, fsync_interval, compact_every), key))
+    return registry
+
+# Reads from a client's socket, but never past a deadline: while waiting for a
+# request, the end of the keep-alive idle time; while reading one, the time
+# it has to arrive in full. A client trickling in a byte at a time gets cut
+# off just like one that sends nothing.
+class deadline_reader(io.RawIOBase):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.deadline = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('deadline passed')
+            self.sock.settimeout(remaining)
+        return self.sock.recv_into(buffer)
+
+# Form fields as a plain dict of strings (first value of each). Multipart
+# forms are already decoded.
+def decode_form(variables):
+    decode = lambda value: value.decode('utf-8') if isinstance(value, bytes) else value
+    return {decode(key): decode(values[0]) for key, values in variables.items() if values}
+
+def is_valid_telemetry(sample):
+    return isinstance(sample, list) and len(sample) == len(TELEMETRY_FIELDS) and \
+           all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)) for value in sample)
+
+# Per host: how many samples, the average of each field and the peak RSS
+def summarize_telemetry(samples):
+    hosts = {}
+    for sample in samples:
+        hosts.setdefault(sample[1], []).append(sample[2:])
+    summary = {}
+    for ip, rows in hosts.items():
+        d = {'samples': len(rows)}
+        for i, field in enumerate(TELEMETRY_FIELDS):
+            values = [row[i] for row in rows if row[i] is not None]
+            d[field] = round(sum(values) / len(values), 2) if values else None
+        rss = [row[TELEMETRY_FIELDS.index('rss')] for row in rows if row[TELEMETRY_FIELDS.index('rss')] is not None]
+        d['rss_max'] = max(rss) if rss else None
+        summary[ip] = d
+    return summary
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+class mc_dropbox_state_server(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep their connection open between heartbeats.
+    # Idle connections are dropped after the server's idle timeout, and a
+    # request (and its reply) gets the request timeout to get through.
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+    # Headers and body go out in separate writes; with Nagle on, the body of
+    # every reply on a kept-alive connection waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+    request_started = None
+    reply_code = None
+
+    # Instrumentation: connections are counted while open, and each request is
+    # timed from when its request line has been read until its reply is out.
+    def setup(self):
+        super().setup()
+        self.rfile.close()
+        self.reader = deadline_reader(self.connection)
+        self.rfile = io.BufferedReader(self.reader)
+        self.server.metrics.connection_opened()
+
+    def finish(self):
+        super().finish()
+        self.server.metrics.connection_closed()
+
+    # The request line is in; the rest of the request must follow promptly,
+    # and its body may not be larger than we are willing to read.
+    def parse_request(self):
+        self.request_started = time.perf_counter()
+        self.reply_code = None
+        self.reader.deadline = time.monotonic() + self.server.request_timeout
+        if not super().parse_request():
+            return False
+        try:
+            length = int(self.headers['content-length'] or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400, 'Invalid Content-Length')
+            return False
+        if length > MAX_REQUEST_BODY:
+            self.send_error(413, 'Request too large')
+            return False
+        return True
+
+    def send_response(self, code, message=None):
+        self.reply_code = code
+        self.connection.settimeout(self.server.request_timeout)
+        super().send_response(code, message)
+
+    def handle_one_request(self):
+        self.reader.deadline = time.monotonic() + self.server.idle_timeout
+        super().handle_one_request()
+        if self.reply_code is not None:
+            self.server.metrics.observe_request(self.command, self.reply_code, time.perf_counter() - self.request_started)
+            self.reply_code = None
+
+    def get_path(self):
+        return urllib.parse.urlparse(self.path).path
 
     def get_state(self):
-        if not self.state:
-            try:
-                with open(get_filepath()) as f:
-                    lines = f.readlines()
-                    if lines:
-                        ip = lines[0].strip()
-                        self.state = ip
-                    else:
-                        self.state = False
-            except:
-                self.state = False
-        return self.state
+        path = self.get_path()
+        if path.startswith(WORLDS_PATH):
+            return self.server.registry.get(urllib.parse.unquote(path[len(WORLDS_PATH):]).strip('/'))
+        return self.server.registry.get('')
 
-    def state_to_json(self):
+    def send_reply(self, code, body, content_type="application/json", headers=()):
+        if isinstance(body, str):
+            body = bytes(body, "utf-8")
+        if not self.server.keep_alive:
+            self.close_connection = True
+        self.send_response(code)
+        self.send_header("Content-type", content_type)
+        # A 304 has no body, and its length would be taken as the cached one's
+        if code != 304:
+            self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.get_path() == BULK_PATH:
+            self.do_bulk_GET()
+            return
+        if self.get_path() == TELEMETRY_PATH:
+            self.do_telemetry_GET()
+            return
+        if self.get_path() == METRICS_PATH:
+            self.send_reply(200, self.server.metrics.render(self.server.registry, self.server.watch_hub), "text/plain; version=0.0.4")
+            return
+
+        variables = self.get_passed_variables()
+        key = variables.get(b'key', [b''])[0].decode('utf-8')
         state = self.get_state()
         if not state:
-            d =  {'online': False}
+            self.send_reply(404, 'Unknown server.')
+        elif not key or key != state.key:
+            self.send_reply(503, 'Invalid key.')
+        elif b'watch' in variables:
+            self.do_watch(state, variables)
         else:
-            d = {'online': True, 'ip': state }
+            self.send_state(state)
 
-        return json.dumps(d)
+    def send_state(self, state):
+        body, etag, response = state.reply
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_reply(304, b'', headers=[('ETag', etag)])
+        else:
+            self.send_reply(200, body, headers=[('ETag', etag)])
 
+    # Long-poll: answer straight away if the client's version is outdated,
+    # otherwise park the connection in the watch hub until the state changes.
+    def do_watch(self, state, variables):
+        try:
+            version = int(variables[b'watch'][0])
+            timeout = float(variables.get(b'timeout', [DEFAULT_WATCH_TIMEOUT])[0])
+        except ValueError:
+            self.send_reply(400, 'Invalid watch version or timeout.')
+            return
+        # nan would get through the clamp below (it compares false to anything)
+        if not math.isfinite(timeout):
+            timeout = DEFAULT_WATCH_TIMEOUT
+        timeout = min(max(timeout, 0), MAX_WATCH_TIMEOUT)
+        if version != state.version or not timeout:
+            body, etag, response = state.reply
+            self.send_reply(200, body, headers=[('ETag', etag)])
+        else:
+            self.wfile.flush()
+            self.close_connection = True
+            self.server.watch_hub.park(self.connection, state, version, timeout)
 
-    def do_GET(self):
+    # Status of many servers in one round trip. Each server is given as
+    # server=<name>:<key> and the reply maps every name to its status (or to
+    # an error if the name or key is wrong).
+    def do_bulk_GET(self):
         variables = self.get_passed_variables()
-        key = variables.get(b'key')[0].decode('utf-8')
-        if not key or key != get_key():
-            self.send_response(503)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes('Invalid key.', "utf-8"))
-        else:
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(self.state_to_json(), "utf-8"))
+        d = {}
+        for server in variables.get(b'server', []):
+            name, _, key = server.decode('utf-8').partition(':')
+            state = self.server.registry.get(name)
+            if not state:
+                d[name] = {'error': 'Unknown server.'}
+            elif not key or key != state.key:
+                d[name] = {'error': 'Invalid key.'}
+            else:
+                d[name] = state.to_dict()
+        self.send_reply(200, json.dumps(d))
+
+    # Telemetry history of the servers given as server=<name>:<key> (samples
+    # newer than since=<epoch>, if given), plus a summary per host.
+    def do_telemetry_GET(self):
+        variables = self.get_passed_variables()
+        try:
+            since = float(variables.get(b'since', [b'0'])[0])
+        except ValueError:
+            self.send_reply(400, 'Invalid since.')
+            return
+        d = {'fields': ('time', 'ip') + TELEMETRY_FIELDS, 'servers': {}}
+        for server in variables.get(b'server', []):
+            name, _, key = server.decode('utf-8').partition(':')
+            state = self.server.registry.get(name)
+            if not state:
+                d['servers'][name] = {'error': 'Unknown server.'}
+            elif not key or key != state.key:
+                d['servers'][name] = {'error': 'Invalid key.'}
+            else:
+                samples = state.get_telemetry(since)
+                d['servers'][name] = {'samples': samples, 'hosts': summarize_telemetry(samples)}
+        self.send_reply(200, json.dumps(d))
 
     # This is soooo ugly.
     def get_passed_variables(self):
-        try:
-            ctype, pdict = cgi.parse_header(self.headers['content-type'])
-        except:
+        content_type = self.headers['content-type']
+        if not content_type:
             try:
                 d = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
                 d_out = {}
@@ -110,81 +791,263 @@ class mc_dropbox_state_server(BaseHTTPRequestHandler):
                 return d_out
             except:
                 return {}
+        ctype = content_type.split(';')[0].strip().lower()
         if ctype == 'multipart/form-data':
+            # Only old clients send these; cgi is deprecated, so only load it for them
+            import cgi
+            ctype, pdict = cgi.parse_header(content_type)
+            pdict['boundary'] = bytes(pdict['boundary'], 'utf-8')
+            pdict['CONTENT-LENGTH'] = int(self.headers['content-length'])
             return cgi.parse_multipart(self.rfile, pdict)
         elif ctype == 'application/x-www-form-urlencoded':
             length = int(self.headers['content-length'])
-            return cgi.urllib.parse.parse_qs(self.rfile.read(length), keep_blank_values=1)
+            return urllib.parse.parse_qs(self.rfile.read(length), keep_blank_values=1)
         else:
+            # Consume the body anyway, or it would be read as the next request
+            # on a kept-alive connection.
+            self.rfile.read(int(self.headers['content-length'] or 0))
             return {}
 
+    # Applies a state update (a dict with message, key, ip (for stops, that of
+    # the host that stopped, if given) and, for takeovers, previous and lease) and returns the reply to it as (code, body, content type).
+    def apply_update(self, state, update):
+        message = str(update.get('message') or '')
+        key = str(update.get('key') or '')
+        if not state:
+            return 404, 'Unknown server.', "application/json"
+        elif not key or key != state.key:
+            return 503, 'Invalid key.', "application/json"
+        elif not message or message not in ('stopped', 'started', 'takeover'):
+            return 503, 'No message supplied.', "application/json"
+        elif message == 'stopped':
+            current_host = state.stop(str(update.get('ip') or ''))
+            if current_host:
+                return 503, 'Server already running at ' + current_host + '!', "text/plain"
+            return 200, '', "text/plain"
+
+        ip = str(update.get('ip') or '')
+        if not ip:
+            return 503, 'No IP supplied!', "application/json"
+        if message == 'takeover':
+            try:
+                lease_time = max(0.0, float(update.get('lease') or 0))
+            except (TypeError, ValueError):
+                lease_time = 0.0
+            current_host = state.take_over(ip, str(update.get('previous') or ''), lease_time)
+        else:
+            # Heartbeats from the current host simply re-send its IP,
+            # so only a different IP is refused.
+            current_host = state.start(ip)
+        if current_host:
+            return 503, 'Server already running at ' + current_host + '!', "text/plain"
+        if is_valid_telemetry(update.get('telemetry')):
+            state.record(ip, update['telemetry'])
+        return 200, '', "text/plain"
+
     def do_POST(self):
+        if self.get_path() == V2_UPDATES_PATH:
+            self.do_v2_updates()
+            return
         variables = self.get_passed_variables()
-        message = variables.get(b'message')[0].decode('utf-8')
-        key = variables.get(b'key')[0].decode('utf-8')
-        if not key or key != get_key():
-            self.send_response(503)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes('Invalid key.', "utf-8"))
-        elif not message or message not in ('stopped', 'started'):
-            self.send_response(503)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes('No message supplied.', "utf-8"))
-        else:
-            if message == 'stopped':
-                self.state = None
-                self.save_state()
-                self.send_response(200)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-            else:
-                state = variables.get(b'ip')[0].decode('utf-8')
-                if not state:
-                    self.send_response(503)
-                    self.send_header("Content-type", "application/json")
-                    self.end_headers()
-                    self.wfile.write(bytes('No IP supplied!', "utf-8"))
-                else:
-                    if self.state:
-                        self.send_response(503)
-                        self.send_header("Content-type", "text/plain")
-                        self.end_headers()
-                        self.wfile.write(bytes('Server already running at ' + self.state + '!', "utf-8"))
-                    else:
-                        self.state = state
-                        self.save_state()
-                        self.send_response(200)
-                        self.send_header("Content-type", "text/plain")
-                        self.end_headers()
+        if self.get_path() == BULK_PATH:
+            self.do_bulk_POST(variables)
+            return
+        code, body, content_type = self.apply_update(self.get_state(), decode_form(variables))
+        self.send_reply(code, body, content_type)
+
+    # Many updates in one request (e.g. the heartbeats of every world a
+    # supervisor runs). Each update=... field is itself a form-encoded update
+    # like a single POST, plus server=<name>.
+    def do_bulk_POST(self, variables):
+        d = {}
+        for update in variables.get(b'update', []):
+            update = decode_form(urllib.parse.parse_qs(update, keep_blank_values=1))
+            name = update.get('server', '')
+            code, body, content_type = self.apply_update(self.server.registry.get(name), update)
+            d[name] = {'code': code, 'message': body}
+        self.send_reply(200, json.dumps(d))
+
+    # v2 updates: a JSON body {"updates": [{"server": <name>, "key": ...,
+    # "message": ..., "ip": ...}, ...]} read straight off the socket, answered
+    # with {"results": [{"server": ..., "code": ..., "message": ...}, ...]} in
+    # the same order.
+    def do_v2_updates(self):
+        length = int(self.headers['content-length'] or 0)
+        try:
+            updates = json.loads(self.rfile.read(length).decode('utf-8'))['updates']
+            if not isinstance(updates, list) or not all(isinstance(update, dict) for update in updates):
+                raise ValueError('updates must be a list of objects')
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_reply(400, 'Invalid updates: {}'.format(e))
+            return
+        results = []
+        for update in updates:
+            name = str(update.get('server') or '')
+            code, body, content_type = self.apply_update(self.server.registry.get(name), update)
+            results.append({'server': name, 'code': code, 'message': body})
+        self.send_reply(200, json.dumps({'results': results}))
 
+#------------------------------------------------------------------------------
+# Worker models. 'single' is the plain HTTPServer (one request at a time),
+# 'threaded' spawns a thread per connection and 'pool' hands connections to a
+# fixed-size pool of worker threads (a kept-alive connection holds on to its
+# worker while open, so size the pool for the number of clients). All of them
+# leave the connections parked in the watch hub alone once their handler
+# returns.
+#
+# Connections being handled are capped at max_connections (parked watchers
+# don't count: they no longer hold a worker). Past that, new connections are
+# answered 503 straight from the accept loop and closed, so a flood of slow or
+# stuck clients can't queue up in front of everybody else. The accept backlog
+# is bounded too, so what doesn't fit is refused by the kernel.
+#------------------------------------------------------------------------------
+class watch_server_mixin:
+    # Room for a burst of watchers reconnecting at once
+    request_queue_size = DEFAULT_BACKLOG
+    keep_alive = True
+    idle_timeout = KEEP_ALIVE_TIMEOUT
+    request_timeout = DEFAULT_REQUEST_TIMEOUT
+    max_connections = DEFAULT_MAX_CONNECTIONS
+
+    def verify_request(self, request, client_address):
+        with self.admitted_lock:
+            if len(self.admitted) < self.max_connections:
+                self.admitted.add(request)
+                return True
+        self.metrics.connection_shed()
+        try:
+            request.settimeout(0)
+            request.send(SHED_RESPONSE)
+        except OSError:
+            pass
+        return False
+
+    def shutdown_request(self, request):
+        with self.admitted_lock:
+            self.admitted.discard(request)
+        if not self.watch_hub.is_detached(request):
+            super().shutdown_request(request)
+
+class single_state_server(watch_server_mixin, HTTPServer):
+    # An idle kept-alive client would block everybody else
+    keep_alive = False
+
+class threaded_state_server(watch_server_mixin, socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class pooled_state_server(watch_server_mixin, HTTPServer):
+
+    def __init__(self, server_address, handler_class, pool_size=DEFAULT_POOL_SIZE, bind_and_activate=True):
+        super().__init__(server_address, handler_class, bind_and_activate)
+        self.pool = ThreadPoolExecutor(max_workers=pool_size)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+def create_server(address, worker_mode, pool_size, registry, hub, limits=None):
+    if worker_mode == 'pool':
+        server = pooled_state_server(address, mc_dropbox_state_server, pool_size, bind_and_activate=False)
+    elif worker_mode == 'threaded':
+        server = threaded_state_server(address, mc_dropbox_state_server, bind_and_activate=False)
+    else:
+        server = single_state_server(address, mc_dropbox_state_server, bind_and_activate=False)
+    server.registry = registry
+    server.watch_hub = hub
+    server.metrics = mc_dropbox_metrics()
+    server.admitted = set()
+    server.admitted_lock = threading.Lock()
+    # idle_timeout, request_timeout, max_connections and request_queue_size
+    for name, value in (limits or {}).items():
+        setattr(server, name, value)
+    try:
+        server.server_bind()
+        server.server_activate()
+    except:
+        server.server_close()
+        raise
+    return server
 
 def parse_input():
     parser = OptionParser()
-    parser.add_option('-p', '--port', help='Set the listening port (default: 9000)', dest='port', type='int', default=9000)
+    parser.add_option('-p', '--port', help='Set the listening port (default: {})'.format(HOST_PORT), dest='port', type='int', default=HOST_PORT)
     parser.add_option('-f', '--server-file', help='Set the path (including name) to the status server file (default: {})'.format(DEFAULT_FILE_NAME), dest='server_file', type='string', default=DEFAULT_FILE_NAME)
     parser.add_option('-k', '--secret-key', help='Set the secret key.', dest='secret_key', type='string')
+    parser.add_option('-r', '--registry', help='Host many named servers in this process. The file is a JSON object mapping each server name to its secret key; clients reach a server at /worlds/<name>. Can be combined with -k.', dest='registry_file', type='string', default=None)
+    parser.add_option('-d', '--state-dir', help='Set the folder where the status files of the servers in the registry are kept (default: current folder)', dest='state_dir', type='string', default='.')
+    parser.add_option('-w', '--workers', help='Set the worker model: {} (default: {})'.format(', '.join(WORKER_MODES), DEFAULT_WORKER_MODE), dest='worker_mode', type='choice', choices=WORKER_MODES, default=DEFAULT_WORKER_MODE)
+    parser.add_option('-t', '--pool-size', help='Set the number of worker threads when using the pool worker model (default: {})'.format(DEFAULT_POOL_SIZE), dest='pool_size', type='int', default=DEFAULT_POOL_SIZE)
+    parser.add_option('-s', '--fsync-interval', help='Set the interval, in seconds, between batched fsyncs of the status journal. Set to 0 to fsync every state change (default: {})'.format(DEFAULT_FSYNC_INTERVAL), dest='fsync_interval', type='float', default=DEFAULT_FSYNC_INTERVAL)
+    parser.add_option('-c', '--compact-every', help='Compact the status journal into the status file after this many state changes (default: {})'.format(DEFAULT_COMPACT_EVERY), dest='compact_every', type='int', default=DEFAULT_COMPACT_EVERY)
+    parser.add_option('-i', '--idle-timeout', help='Close kept-alive connections that send no request for this many seconds (default: {})'.format(KEEP_ALIVE_TIMEOUT), dest='idle_timeout', type='float', default=KEEP_ALIVE_TIMEOUT)
+    parser.add_option('-q', '--request-timeout', help='Give each request this many seconds to arrive in full once it has started, and its reply as long to be sent (default: {})'.format(DEFAULT_REQUEST_TIMEOUT), dest='request_timeout', type='float', default=DEFAULT_REQUEST_TIMEOUT)
+    parser.add_option('-m', '--max-connections', help='Answer new connections with a quick 503 while this many are being served (default: {})'.format(DEFAULT_MAX_CONNECTIONS), dest='max_connections', type='int', default=DEFAULT_MAX_CONNECTIONS)
+    parser.add_option('-b', '--backlog', help='Set the size of the queue of connections waiting to be accepted (default: {})'.format(DEFAULT_BACKLOG), dest='backlog', type='int', default=DEFAULT_BACKLOG)
     (options, args) = parser.parse_args()
 
-    if not options.secret_key:
-        parser.error('A secret key is required! Use -k')
+    if not options.secret_key and not options.registry_file:
+        parser.error('A secret key is required! Use -k (or -r to host named servers)')
+    if options.pool_size < 1:
+        parser.error('Invalid pool size ({}). Please supply a positive integer!'.format(options.pool_size))
+    if options.fsync_interval < 0:
+        parser.error('Invalid fsync interval ({}). Please supply a non-negative number!'.format(options.fsync_interval))
+    if options.compact_every < 1:
+        parser.error('Invalid compaction threshold ({}). Please supply a positive integer!'.format(options.compact_every))
+    if options.idle_timeout <= 0 or options.request_timeout <= 0:
+        parser.error('Timeouts must be positive numbers!')
+    if options.max_connections < 1:
+        parser.error('Invalid connection limit ({}). Please supply a positive integer!'.format(options.max_connections))
+    if options.backlog < 1:
+        parser.error('Invalid backlog ({}). Please supply a positive integer!'.format(options.backlog))
+
+    if options.registry_file:
+        try:
+            registry = load_registry(options.registry_file, options.state_dir, options.fsync_interval, options.compact_every)
+        except (OSError, ValueError) as e:
+            parser.error('Could not load registry {}: {}'.format(options.registry_file, e))
+    else:
+        registry = mc_dropbox_registry()
+
+    if options.secret_key:
+        journal = mc_dropbox_journal(options.server_file, options.fsync_interval, options.compact_every)
+        registry.add('', mc_dropbox_state(journal, options.secret_key))
 
-    return options.port, options.server_file, options.secret_key
+    limits = {'idle_timeout': options.idle_timeout, 'request_timeout': options.request_timeout,
+              'max_connections': options.max_connections, 'request_queue_size': options.backlog}
+    return options.port, registry, options.worker_mode, options.pool_size, options.fsync_interval, limits
 
 def main():
-    global global_key, global_filepath
-    port, global_filepath, global_key = parse_input()
+    port, registry, worker_mode, pool_size, fsync_interval, limits = parse_input()
 
-    myServer = HTTPServer((HOST_NAME, port), mc_dropbox_state_server)
+    flusher = journal_flusher(registry.journals(), fsync_interval or DEFAULT_FSYNC_INTERVAL)
+    flusher.start()
+    hub = watch_hub()
+    for state in registry.states.values():
+        hub.watch(state)
+    hub.start()
+    myServer = create_server((HOST_NAME, port), worker_mode, pool_size, registry, hub, limits)
 
-    print(time.asctime(), "Server Starts - %s:%s" % (HOST_NAME, HOST_PORT))
+    print(time.asctime(), "Server Starts - %s:%s (%s workers)" % (HOST_NAME, port, worker_mode))
     try:
         myServer.serve_forever()
     except KeyboardInterrupt:
         pass
 
     myServer.server_close()
-    print(time.asctime(), "Server Stops - %s:%s" % (HOST_NAME, HOST_PORT))
+    hub.stop()
+    flusher.stop()
+    print(time.asctime(), "Server Stops - %s:%s" % (HOST_NAME, port))
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
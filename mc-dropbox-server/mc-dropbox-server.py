@@ -21,16 +21,22 @@
 ## You should have received a copy of the GNU General Public License
 ## along with minecraft-dropbox-server.  If not, see <http://www.gnu.org/licenses/>.
 ##
+# Only cheap modules are imported here. The ones that are just needed for some
+# code paths (subprocess, urllib, http.client, ...) are imported where they're
+# used, so joining or querying a server doesn't pay for them.
 import datetime
 from optparse import OptionParser
 import os
-import subprocess
-import urllib.request
-import urllib.parse
 import json
 from os.path import isfile
+import queue
+import random
+import re
+import sys
 import time
-from threading import Thread
+from collections import deque
+from contextlib import contextmanager
+from threading import Thread, Lock, Event
 
 __author__ = 'jorl17'
 
@@ -38,43 +44,161 @@ CENTRAL_SERVER_ADDRESS='http://localhost:9000'
 DEFAULT_JVM_OPTIONS='-Xmx3G -Xms2G'
 DEFAULT_HEARTBEAT = 60
 IP_REQUEST_TIMEOUT = 2
+IP_ADDRESSES = ['http://ipv4bot.whatismyipaddress.com', 'http://ipinfo.io/ip', 'http://www.trackip.net/ip']
+IP_CACHE_TTL = 3600
+IP_CACHE_FILE_NAME = 'public_ip.json'
+LOCAL_DATA_DIR = '.mc-dbox-server'
+STATUS_FILE_NAME = 'mc_dropbox_server_status.txt'
+# Dropbox doesn't sync files named ~*.tmp
+STATUS_TMP_FILE_NAME = '~mc_dropbox_server_status.tmp'
+STATUS_DIR_NAME = 'mc_dropbox_server_status'
+HOST_ID_FILE_NAME = 'host_id'
+MANIFEST_FILE_NAME = 'mc_dropbox_world_manifest.json'
+HASH_BLOCK_SIZE = 1024 * 1024
+DEFAULT_SYNC_WAIT = 120
+SYNC_CHECK_INTERVAL = 5
+REGION_EXTENSION = '.mca'
+REGION_SECTOR_SIZE = 4096
+REGION_CHUNKS = 1024
+CENTRAL_WATCH_TIMEOUT = 30
+CENTRAL_CONNECT_TIMEOUT = 2
+CENTRAL_READ_TIMEOUT = 5
+CENTRAL_RETRIES = 2
+CENTRAL_RETRY_DELAY = 0.5
+# Pooled connections idle for longer are not reused: the central server closes
+# them after 75s (its -i), well before the next heartbeat (120s by default)
+CENTRAL_IDLE_TIMEOUT = 60
+# A busy central server (503) is asked again after its Retry-After (this if it
+# gives none), right away if that is this short
+CENTRAL_DEFAULT_RETRY_AFTER = 1
+CENTRAL_MAX_RETRY_WAIT = 5
+HEARTBEAT_JITTER = 0.05
+CENTRAL_WORLDS_PATH = '/worlds/'
+CENTRAL_V2_UPDATES_PATH = '/v2/updates'
+SUPERVISOR_RESTART_LIMIT = 3
+DEFAULT_SYNC_INTERVAL = 300
+LOG_RING_SIZE = 1000
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+DONE_PATTERN = r'Done \(([\d.,]+)s\)!'
+TELEMETRY_FIELDS = ('cpu', 'rss', 'read', 'write', 'threads', 'tps', 'players', 'behind')
+JOIN_PATTERN = r': (\S+) joined the game'
+LEAVE_PATTERN = r': (\S+) left the game'
+LIST_PATTERN = r'There are (\d+) of a max'
+TPS_PATTERN = r'TPS from last 1m, 5m, 15m: \D*([\d.]+)'
+BEHIND_PATTERN = r"Can't keep up!.* (\d+) ticks behind"
+SAVED_PATTERN = r'Saved the (game|world)'
+IDLE_CHECK_INTERVAL = 10
+SAVE_TIMEOUT = 60
+IDLE_STOP_TIMEOUT = 120
+STANDBY_POLL_INTERVAL = 1
+DEFAULT_STANDBY_SETTLE = 5
+STANDBY_STAGGER_SLOTS = 4
+STANDBY_STAGGER_STEP = 0.5
+CDS_MIN_JAVA_VERSION = 13
+STARTUP_TIMES_FILE_NAME = 'startup_times.json'
+STARTUP_TIMES_KEPT = 10
+MIN_HEAP_MB = 1024
+BASE_HEAP_MB = 2048
+SYSTEM_RESERVED_MB = 1024
+GC_FLAGS = '-XX:+UseG1GC -XX:+ParallelRefProcEnabled -XX:MaxGCPauseMillis=200 -XX:+DisableExplicitGC'
 
 #------------------------------------------------------------------------------
 # Threading stuff, to be able to run a thread which periodically updates the
-# server status
+# server status. Runs are scheduled on fixed monotonic deadlines (so the period
+# doesn't drift by however long f() takes), optionally jittered by up to
+# +/- jitter*interval, and stop() wakes the thread up immediately. Deadlines
+# that pass while f() is still running are skipped and counted in missed.
 #------------------------------------------------------------------------------
 global_threads = []
+global_threads_lock = Lock()
 
 def stop_hanging_threads():
-    for thread in global_threads:
+    with global_threads_lock:
+        threads = list(global_threads)
+    for thread in threads:
         thread.stop()
 
 class PeriodicThread(Thread):
-    def __init__(self, f, interval):
-        self.stopped = False
+    def __init__(self, f, interval, jitter=0):
+        self.stopped = Event()
         self.f = f
         self.interval = interval
+        self.jitter = jitter
+        self.missed = 0
         Thread.__init__(self)
+    def start(self):
+        with global_threads_lock:
+            global_threads.append(self)
+        Thread.start(self)
     def run(self):
-        global global_threads
-        global_threads += [self]
-        while not self.stopped:
-            self.f()
-
-            # Sleep in ticks of 1 so we can be aborted decently
-            slept = 0
-            while slept < self.interval:
-                if self.stopped:
-                    break
-                remaining = self.interval - slept
-                time_to_sleep = min(1, remaining)
-                time.sleep(time_to_sleep)
-                slept += time_to_sleep
-        global_threads.remove(self)
+        try:
+            deadline = time.monotonic()
+            while not self.stopped.is_set():
+                self.f()
+
+                deadline += self.interval
+                now = time.monotonic()
+                if now > deadline:
+                    missed = int((now - deadline) // self.interval) + 1
+                    self.missed += missed
+                    deadline += missed * self.interval
+                    print('Periodic update took too long; skipped {} run(s)'.format(missed))
+                delay = deadline - now + random.uniform(-self.jitter, self.jitter) * self.interval
+                self.stopped.wait(max(0, delay))
+        finally:
+            with global_threads_lock:
+                global_threads.remove(self)
     def stop(self):
-        self.stopped = True
+        self.stopped.set()
 
 
+#------------------------------------------------------------------------------
+# Run a function in the background and collect its result (or exception,
+# including exit()) later on. Used to run independent startup steps at the
+# same time.
+#------------------------------------------------------------------------------
+class BackgroundTask(Thread):
+    def __init__(self, f, *args):
+        Thread.__init__(self, daemon=True)
+        self.f = f
+        self.args = args
+        self.value = None
+        self.error = None
+        self.start()
+    def run(self):
+        try:
+            self.value = self.f(*self.args)
+        except BaseException as e:
+            self.error = e
+    def result(self):
+        self.join()
+        if self.error:
+            raise self.error
+        return self.value
+
+#------------------------------------------------------------------------------
+# Time how long each startup phase takes (shown with --timings)
+#------------------------------------------------------------------------------
+class StartupTimings:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.phases = []
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+    def report(self):
+        if not self.enabled:
+            return
+        for name, seconds in self.phases:
+            print('  {:<12s} {:8.1f} ms'.format(name, seconds * 1000))
+        print('  {:<12s} {:8.1f} ms'.format('total', (time.perf_counter() - self.started) * 1000))
+
 #------------------------------------------------------------------------------
 # Dropbox folder auto-detection stuff.
 # From http://stackoverflow.com/a/12118327
@@ -117,6 +241,161 @@ def autodetect_dropbox_home():
 
     return base64.b64decode(data[1]).decode('utf-8')
 
+#------------------------------------------------------------------------------
+# The Dropbox status is a set of leases, one file per host machine in the
+# status folder, each written only by its own host, so two machines never
+# write the same file and Dropbox has nothing to turn into conflicted copies.
+# The first line of a lease is the IP of the host (empty once it stopped);
+# then come key=value lines with a sequence number, the identity of the host
+# machine, the time (epoch) when the lease expires and the time its host first
+# claimed the server (kept as the lease is renewed). Every write takes a
+# sequence number higher than any it can see.
+#
+# Readers merge the leases: the newest one of each host counts, and of the
+# unexpired claims the one made first is the host (the lowest sequence number,
+# then the smallest host id, on a tie), so a late claim never pushes out a
+# live host. If there is none, the lease with the highest sequence number
+# stands (an expired claim, or a stop). A clear (-c) hides every claim older
+# than itself. The single status file written by older versions is read as
+# one more lease (sequence number 0, never claimed before any other), but no
+# longer written.
+#
+# Files are replaced atomically so readers never see half a file, using a
+# temporary name that Dropbox ignores. A host renews its lease only when it
+# is about to run out, so a long lease (-L) means fewer writes to sync.
+#------------------------------------------------------------------------------
+host_id = None
+
+# The machine's name plus a random suffix kept locally, so two installs on
+# machines with the same name (or two users of one machine) stay apart
+def get_host_id():
+    global host_id
+    if host_id is None:
+        import socket
+        path = os.path.join(get_local_data_dir(), HOST_ID_FILE_NAME)
+        try:
+            with open(path) as f:
+                suffix = f.read().strip()
+        except OSError:
+            suffix = None
+        if not suffix:
+            suffix = '{:08x}'.format(random.getrandbits(32))
+            try:
+                write_file_atomically(path, suffix)
+            except OSError as e:
+                print('Could not save host id: ' + str(e))
+        host_id = '{}-{}'.format(socket.gethostname(), suffix)
+    return host_id
+
+def get_status_file_path(server_folder):
+    return os.path.join(server_folder, STATUS_FILE_NAME)
+
+def get_status_dir(server_folder):
+    return os.path.join(server_folder, STATUS_DIR_NAME)
+
+def get_host_status_path(server_folder, host):
+    return os.path.join(get_status_dir(server_folder), ''.join(c if c.isalnum() or c in '-_.' else '_' for c in host) + '.txt')
+
+def parse_dropbox_lease(path):
+    try:
+        with open(path) as f:
+            lines = f.read().split('\n')
+    except OSError:
+        return None
+
+    lease = {'path': path, 'ip': lines[0].strip(), 'seq': 0, 'host': None, 'expires': None, 'since': None, 'cleared': False}
+    for line in lines[1:]:
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        try:
+            if key == 'seq':
+                lease['seq'] = int(value)
+            elif key == 'expires':
+                lease['expires'] = float(value) if float(value) else None
+            elif key == 'since':
+                lease['since'] = float(value)
+            elif key == 'host':
+                lease['host'] = value.strip()
+            elif key == 'cleared':
+                lease['cleared'] = value.strip() == '1'
+        except ValueError:
+            pass
+    return lease
+
+# The newest lease of every host
+def read_dropbox_leases(server_folder):
+    paths = [get_status_file_path(server_folder)]
+    try:
+        with os.scandir(get_status_dir(server_folder)) as entries:
+            paths += [entry.path for entry in entries if entry.name.endswith('.txt') and not entry.name.startswith('~')]
+    except OSError:
+        pass
+    latest = {}
+    for path in paths:
+        lease = parse_dropbox_lease(path)
+        if not lease:
+            continue
+        key = lease['host'] or path
+        if key not in latest or lease['seq'] > latest[key]['seq']:
+            latest[key] = lease
+    return list(latest.values())
+
+# The sequence number of the last clear (-1 if there was none)
+def get_cleared_seq(leases):
+    return max([lease['seq'] for lease in leases if lease['cleared']] or [-1])
+
+def is_live_claim(lease, cleared):
+    return bool(lease['ip']) and lease['seq'] > cleared and (lease['expires'] is None or lease['expires'] > time.time())
+
+def merge_dropbox_leases(leases):
+    if not leases:
+        return None
+    cleared = get_cleared_seq(leases)
+    claims = [lease for lease in leases if is_live_claim(lease, cleared)]
+    if claims:
+        return min(claims, key=lambda lease: (lease['since'] is None, lease['since'] or 0, lease['seq'], lease['host'] or ''))
+    return min(leases, key=lambda lease: (-lease['seq'], lease['host'] or ''))
+
+def read_dropbox_lease(server_folder):
+    return merge_dropbox_leases(read_dropbox_leases(server_folder))
+
+def get_next_seq(leases):
+    return max([lease['seq'] for lease in leases] or [0]) + 1
+
+# since is when we claimed the server, if this renews a claim of ours
+def write_dropbox_lease(server_folder, ip, seq, lease_time=0, cleared=False, since=None):
+    host = get_host_id()
+    lines = [ip or '', 'seq={}'.format(seq), 'host={}'.format(host)]
+    if ip and lease_time:
+        lines.append('expires={:.3f}'.format(time.time() + lease_time))
+    if ip:
+        lines.append('since={:.3f}'.format(since or time.time()))
+    if cleared:
+        lines.append('cleared=1')
+    lines.append('written={}'.format(time.strftime('%Y/%m/%d %H:%M:%S')))
+    os.makedirs(get_status_dir(server_folder), exist_ok=True)
+    path = get_host_status_path(server_folder, host)
+    write_file_atomically(path, '\n'.join(lines) + '\n', os.path.join(get_status_dir(server_folder), '~' + os.path.basename(path) + '.tmp'))
+
+# Changes whenever any lease is written, without reading them
+def get_status_signature(server_folder):
+    signature = []
+    for path in (get_status_file_path(server_folder), get_status_dir(server_folder)):
+        try:
+            st = os.stat(path)
+            signature.append((path, st.st_mtime_ns, st.st_size, st.st_ino))
+        except OSError:
+            pass
+    try:
+        with os.scandir(get_status_dir(server_folder)) as entries:
+            for entry in entries:
+                st = entry.stat()
+                signature.append((entry.name, st.st_mtime_ns, st.st_size, st.st_ino))
+    except OSError:
+        pass
+    return sorted(signature)
+
 #------------------------------------------------------------------------------
 # Used later on to determine if a file should be considered outdated
 #------------------------------------------------------------------------------
@@ -131,16 +410,91 @@ def directory_exists(dir):
     return os.path.exists(dir) and os.path.isdir(dir)
 
 #------------------------------------------------------------------------------
-# To auto-determine the user's public IP. FIXME: We could add a time-out
+# Local (non-Dropbox) folder where we keep caches, so they are not synced
 #------------------------------------------------------------------------------
-def get_public_ip():
-    addresses = ['http://ipv4bot.whatismyipaddress.com', 'http://ipinfo.io/ip', 'http://www.trackip.net/ip']
+def get_local_data_dir():
+    path = os.path.join(os.path.expanduser('~'), LOCAL_DATA_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def write_file_atomically(path, data, tmp_path=None):
+    tmp_path = tmp_path or path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+#------------------------------------------------------------------------------
+# To auto-determine the user's public IP. All the endpoints are queried at the
+# same time and the first valid answer wins. The result is cached locally: a
+# cached IP younger than IP_CACHE_TTL is used straight away (and revalidated in
+# the background), so repeated launches don't wait for the network.
+#------------------------------------------------------------------------------
+def fetch_public_ip(address):
+    import ipaddress
+    import urllib.request
+    f = urllib.request.urlopen(address, timeout=IP_REQUEST_TIMEOUT)
+    return str(ipaddress.ip_address(f.read().decode().strip()))
+
+# Daemon threads, so the losers of the race never hold up the exit
+def race_public_ip(addresses):
+    answers = queue.Queue()
+    def fetch(address):
+        try:
+            answers.put(fetch_public_ip(address))
+        except Exception:
+            answers.put(None)
+
     for address in addresses:
+        Thread(target=fetch, args=(address,), daemon=True).start()
+
+    deadline = time.monotonic() + IP_REQUEST_TIMEOUT + 1
+    for _ in addresses:
         try:
-            f = urllib.request.urlopen(address, timeout=IP_REQUEST_TIMEOUT)
-            return f.read().decode().strip()
-        except:
-            pass
+            ip = answers.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            break
+        if ip:
+            return ip
+    return None
+
+def get_ip_cache_path():
+    return os.path.join(get_local_data_dir(), IP_CACHE_FILE_NAME)
+
+def read_ip_cache(addresses):
+    try:
+        with open(get_ip_cache_path()) as f:
+            d = json.load(f)
+        if d['endpoints'] == addresses:
+            return d['ip'], time.time() - d['time']
+    except Exception:
+        pass
+    return None, None
+
+def write_ip_cache(ip, addresses):
+    try:
+        write_file_atomically(get_ip_cache_path(), json.dumps({'ip': ip, 'time': time.time(), 'endpoints': addresses}))
+    except OSError as e:
+        print('Could not cache public IP: ' + str(e))
+
+def revalidate_public_ip(cached_ip, addresses):
+    ip = race_public_ip(addresses)
+    if ip:
+        write_ip_cache(ip, addresses)
+        if ip != cached_ip:
+            print('Your public IP changed from {} to {}. Restart if you are hosting the server.'.format(cached_ip, ip))
+
+def get_public_ip(addresses=IP_ADDRESSES, use_cache=True):
+    if use_cache:
+        cached_ip, age = read_ip_cache(addresses)
+        if cached_ip and age < IP_CACHE_TTL:
+            Thread(target=revalidate_public_ip, args=(cached_ip, addresses), daemon=True).start()
+            return cached_ip
+
+    ip = race_public_ip(addresses)
+    if ip:
+        if use_cache:
+            write_ip_cache(ip, addresses)
+        return ip
 
     exit('Cannot reliably determine your IP. Please use the -i option.')
 
@@ -151,19 +505,119 @@ def find_first_jar(full_path):
     all_jars = [f for f in os.listdir(full_path) if isfile(os.path.join(full_path, f)) and f.lower().endswith(".jar")]
     return all_jars[0] if all_jars else None
 
+#------------------------------------------------------------------------------
+# Keep-alive HTTP client for the central server. Connections are kept in a
+# small pool (one per concurrent caller, per server) and reused across
+# heartbeats, so each call doesn't pay for a new TCP (and TLS) handshake.
+# Connecting and reading have their own timeouts, and failed requests are
+# retried a couple of times with a jittered, growing delay. A connection idle
+# for longer than the server keeps it open is dropped instead of being tried,
+# and one the server has closed anyway is simply replaced.
+#------------------------------------------------------------------------------
+class CentralServerClient:
+    def __init__(self, connect_timeout=CENTRAL_CONNECT_TIMEOUT, read_timeout=CENTRAL_READ_TIMEOUT, retries=CENTRAL_RETRIES, idle_timeout=CENTRAL_IDLE_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        # (scheme, netloc) -> [(connection, when it was released)]
+        self.idle = {}
+
+    def acquire(self, scheme, netloc):
+        import http.client
+        with self.lock:
+            now = time.monotonic()
+            idle = self.idle.get((scheme, netloc), [])
+            stale = [conn for conn, released in idle if now - released > self.idle_timeout]
+            idle[:] = [(conn, released) for conn, released in idle if now - released <= self.idle_timeout]
+            conn = idle.pop()[0] if idle else None
+        for old in stale:
+            old.close()
+        if conn:
+            return conn
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=self.connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.connect_timeout)
+        conn.connect()
+        return conn
+
+    def release(self, scheme, netloc, conn):
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append((conn, time.monotonic()))
+
+    # Returns (status code, body). Raises the last error if every attempt fails.
+    def request(self, method, url, body=None, headers=None, read_timeout=None):
+        status, response_headers, data = self.exchange(method, url, body, headers, read_timeout)
+        return status, data
+
+    # Like request, but returns (status code, response headers, body)
+    def exchange(self, method, url, body=None, headers=None, read_timeout=None):
+        import http.client
+        import urllib.parse
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or {})
+
+        for attempt in range(self.retries + 1):
+            conn = None
+            try:
+                conn = self.acquire(parts.scheme, parts.netloc)
+                conn.sock.settimeout(read_timeout or self.read_timeout)
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+                if response.will_close:
+                    conn.close()
+                else:
+                    self.release(parts.scheme, parts.netloc, conn)
+                return response.status, response.headers, data
+            except (OSError, http.client.HTTPException) as e:
+                if conn:
+                    conn.close()
+                if attempt == self.retries:
+                    raise
+                # A reused connection may just have been closed by the server
+                # while idle; only back off when a fresh one fails too.
+                if attempt:
+                    time.sleep(CENTRAL_RETRY_DELAY * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn, released in conns:
+                    conn.close()
+            self.idle = {}
+
+central_client = CentralServerClient()
+
 #------------------------------------------------------------------------------
 # Ask the central server what's the current status of the Minecraft server.
 # All we need to do is a GET, passing the key. The server can be HTTPS for more
 # security.
 #------------------------------------------------------------------------------
+central_status_cache = {}
+
 def check_central_server(secret_key, server = CENTRAL_SERVER_ADDRESS):
     if not server:
         return None
+    import urllib.parse
     try:
-        req = urllib.request.Request(server + '?key=' + secret_key + '')
-        f = urllib.request.urlopen(req)
-        response = f.read().decode('utf-8')
-        d = json.loads(response)
+        url = server + '?' + urllib.parse.urlencode({'key': secret_key})
+        # Send back the ETag of the last answer; if nothing changed since, the
+        # server just says so (304) and we reuse it.
+        cached = central_status_cache.get(url)
+        code, headers, response = central_client.exchange('GET', url, headers={'If-None-Match': cached[0]} if cached else None)
+        if code == 304 and cached:
+            response = cached[1]
+        elif code != 200:
+            raise RuntimeError('{} {}'.format(code, response.decode('utf-8', 'replace')))
+        elif headers.get('ETag'):
+            central_status_cache[url] = (headers.get('ETag'), response)
+        d = json.loads(response.decode('utf-8'))
         if d['online']:
             return d['ip']
         else:
@@ -172,6 +626,40 @@ def check_central_server(secret_key, server = CENTRAL_SERVER_ADDRESS):
         print('Could not access central server: ' + str(e))
         return None
 
+#------------------------------------------------------------------------------
+# Wait for the status to change on the central server (long-poll). The server
+# answers as soon as the state differs from the version we pass (or after the
+# timeout). Returns the status (as check_central_server) and its version.
+#------------------------------------------------------------------------------
+def watch_central_server(secret_key, server, version, timeout=CENTRAL_WATCH_TIMEOUT):
+    import urllib.parse
+    try:
+        query = urllib.parse.urlencode({'key': secret_key, 'watch': version, 'timeout': timeout})
+        code, response = central_client.request('GET', server + '?' + query, read_timeout=timeout + CENTRAL_READ_TIMEOUT)
+        if code != 200:
+            raise RuntimeError('{} {}'.format(code, response.decode('utf-8', 'replace')))
+        d = json.loads(response.decode('utf-8'))
+        return (d['ip'] if d['online'] else False), d.get('version', version)
+    except Exception as e:
+        print('Could not access central server: ' + str(e))
+        return None, version
+
+def watch_status(secret_key, server):
+    last_status, version = None, -1
+    try:
+        while True:
+            status, version = watch_central_server(secret_key, server, version)
+            if status is None:
+                time.sleep(CENTRAL_RETRY_DELAY * random.uniform(2, 6))
+            elif status != last_status:
+                if status:
+                    print(time.strftime('%Y/%m/%d %H:%M:%S'), 'Server is running at {:s}'.format(status))
+                else:
+                    print(time.strftime('%Y/%m/%d %H:%M:%S'), 'Server is not running.')
+                last_status = status
+    except KeyboardInterrupt:
+        pass
+
 #------------------------------------------------------------------------------
 # Check Dropbox to see if the server is running. If there is no file, then
 # the server is not running. If there is, we check if it is within the
@@ -182,118 +670,1307 @@ def check_central_server(secret_key, server = CENTRAL_SERVER_ADDRESS):
 # regardless of their age.
 #------------------------------------------------------------------------------
 def check_dropbox_file(server_folder_path, valid_last_change_threshold):
-    path = os.path.join(server_folder_path, 'mc_dropbox_server_status.txt')
+    lease = read_dropbox_lease(server_folder_path)
+    if not lease or not lease['ip']:
+        return False
 
-    try:
-        with open(path) as f:
-            lines = f.readlines()
-            if lines:
-                ip = lines[0].strip()
-                seconds_since_heartbeat = get_seconds_since_last_file_change(path)
-                if not valid_last_change_threshold or seconds_since_heartbeat < valid_last_change_threshold:
-                    return ip
-                else:
-                    print("Dropbox reported {} was running the server, but last heartbeat was {} seconds ago! Considering nobody is running server...".format(ip, seconds_since_heartbeat))
-                    #update_dropbox_state(None, server_folder_path)
-                    return False
-            else:
-                return False
-    except:
+    ip = lease['ip']
+    if not valid_last_change_threshold:
+        return ip
+    if lease['expires'] is not None:
+        if time.time() < lease['expires']:
+            return ip
+        print("Dropbox reported {} was running the server, but its lease expired {:.0f} seconds ago! Considering nobody is running server...".format(ip, time.time() - lease['expires']))
+        return False
+
+    # Status files written by older versions have no lease, only their mtime
+    seconds_since_heartbeat = get_seconds_since_last_file_change(lease['path'])
+    if seconds_since_heartbeat < valid_last_change_threshold:
+        return ip
+    else:
+        print("Dropbox reported {} was running the server, but last heartbeat was {} seconds ago! Considering nobody is running server...".format(ip, seconds_since_heartbeat))
         return False
 
 
 #------------------------------------------------------------------------------
 # Check if someone is running the server. In most cases, this acts as a direct
 # wrapper to check_dropbox_file. However, if the central server is used, it
-# checks both (currently we prefer Dropbox if there is a disagreement)
+# checks both at the same time (currently we prefer Dropbox if there is a
+# disagreement)
 #------------------------------------------------------------------------------
 def is_someone_running_server(central_server_address, server_folder_path, secret_key, time_threshold):
-    status = check_central_server(secret_key, central_server_address)
+    if central_server_address:
+        central_check = BackgroundTask(check_central_server, secret_key, central_server_address)
     status_dropbox = check_dropbox_file(server_folder_path, time_threshold)
-    if status != None:
-        if status == status_dropbox:
-            return status
-        else:
-            print('Dropbox and server disagree. Notifying server of status update (Dropbox is probably correct)')
-            inform_central_server(status, secret_key, central_server_address)
-    else:
+    if not central_server_address:
         return status_dropbox
 
+    # Our copy of the status files may simply lag behind, so we don't tell the
+    # central server it is wrong; a host that starts claims it (host_server).
+    status = central_check.result()
+    if status is not None and (status or None) != (status_dropbox or None):
+        print('Dropbox and server disagree (Dropbox: {}, server: {}). Going by Dropbox.'.format(status_dropbox or 'stopped', status or 'stopped'))
+    return status_dropbox
+
 #------------------------------------------------------------------------------
 # Inform the central server of a change in status. This equates to a POST
 # on the address with a couple of pre-defined parameters (message and ip)
 #------------------------------------------------------------------------------
-def inform_central_server(ip, secret_key, central_server_address=CENTRAL_SERVER_ADDRESS):
+# With no ip, it is a stop, of the host at the stopping IP if given
+def inform_central_server(ip, secret_key, central_server_address=CENTRAL_SERVER_ADDRESS, telemetry=None, stopping=None):
     if not central_server_address:
         return
+    base, name = split_central_address(central_server_address)
+    try:
+        results = post_central_updates([make_central_update(name, secret_key, ip, telemetry, stopping)], base)
+    except Exception as e:
+        print('Could not inform central server: ' + str(e))
+        return None
+    if results is None:
+        inform_central_server_v1(ip, secret_key, central_server_address, stopping)
+        return
+    for result in results:
+        if result.get('code') != 200:
+            print('Central server refused the update: ' + str(result.get('message')))
+
+# The form-encoded POST every central server understands
+def inform_central_server_v1(ip, secret_key, central_server_address, stopping=None):
+    import urllib.parse
     try:
         if ip:
             data = urllib.parse.urlencode({'key': secret_key, 'message': 'started', 'ip': ip}).encode()
         else:
-            data = urllib.parse.urlencode({'key': secret_key, 'message': 'stopped'}).encode()
+            data = urllib.parse.urlencode({'key': secret_key, 'message': 'stopped', 'ip': stopping or ''}).encode()
         header = {"Content-Type": "application/x-www-form-urlencoded"}
-        req = urllib.request.Request(central_server_address, data, header)
-        f = urllib.request.urlopen(req)
+        code, response = central_client.request('POST', central_server_address, data, header)
     except Exception as e:
         print('Could not inform central server: ' + str(e))
         return None
+    # It answered this, so it is up: the v2 request it dropped was one it
+    # doesn't understand
+    base = split_central_address(central_server_address)[0]
+    if base in central_v1_suspects:
+        central_v1_suspects.discard(base)
+        central_v1_servers.add(base)
+    if code != 200:
+        print('Central server refused the update: ' + response.decode('utf-8', 'replace'))
+
+#------------------------------------------------------------------------------
+# Updates go to the central server's v2 endpoint as one JSON document, which
+# may carry the updates of many servers (registered under different names).
+# Central servers without it get the old form-encoded POSTs instead, one per
+# server; we remember which ones those are. A server has no v2 if it says the
+# endpoint doesn't exist, or if it drops the connection without a reply (as
+# older central servers do) and then answers the form POST that follows. A
+# busy server (503) or a timeout is only a failure of that one update: v2 is
+# tried again, after the Retry-After the server asked for.
+#------------------------------------------------------------------------------
+central_v1_servers = set()
+central_v1_suspects = set()
+central_v2_retry_at = {}
+
+def get_retry_after(headers):
+    try:
+        return max(0, min(float(headers.get('Retry-After')), 3600))
+    except (TypeError, ValueError):
+        return CENTRAL_DEFAULT_RETRY_AFTER
+
+def get_world_central_address(central_server_address, name):
+    return central_server_address.rstrip('/') + CENTRAL_WORLDS_PATH + name if name else central_server_address
+
+# Split http://host:port/worlds/<name> into the base address and the name
+def split_central_address(central_server_address):
+    import urllib.parse
+    parts = urllib.parse.urlsplit(central_server_address)
+    prefix, worlds, name = parts.path.partition(CENTRAL_WORLDS_PATH)
+    base = urllib.parse.urlunsplit((parts.scheme, parts.netloc, prefix.rstrip('/'), '', ''))
+    return base, urllib.parse.unquote(name.strip('/')) if worlds else ''
+
+def make_central_update(name, secret_key, ip, telemetry=None, stopping=None):
+    update = {'server': name, 'key': secret_key, 'message': 'started' if ip else 'stopped'}
+    if ip:
+        update['ip'] = ip
+        if telemetry:
+            update['telemetry'] = telemetry
+    elif stopping:
+        update['ip'] = stopping
+    return update
+
+# Returns the result of every update, or None if the server (may) have no v2
+# endpoint. Raises if the updates could not be delivered.
+def post_central_updates(updates, central_base):
+    import http.client
+    if central_base in central_v1_servers:
+        return None
+    wait = central_v2_retry_at.get(central_base, 0) - time.monotonic()
+    if wait > 0:
+        raise RuntimeError('central server is busy, trying again in {:.0f}s'.format(wait))
+    body = json.dumps({'updates': updates}).encode('utf-8')
+    for attempt in range(2):
+        try:
+            code, headers, response = central_client.exchange('POST', central_base + CENTRAL_V2_UPDATES_PATH, body, {"Content-Type": "application/json"})
+        except http.client.RemoteDisconnected:
+            central_v1_suspects.add(central_base)
+            return None
+        if code != 503:
+            break
+        retry_after = get_retry_after(headers)
+        if attempt or retry_after > CENTRAL_MAX_RETRY_WAIT:
+            central_v2_retry_at[central_base] = time.monotonic() + retry_after
+            raise RuntimeError('central server is busy, trying again in {:.0f}s'.format(retry_after))
+        time.sleep(retry_after)
+    if code in (404, 405, 501):
+        central_v1_servers.add(central_base)
+        return None
+    try:
+        if code == 200:
+            return json.loads(response.decode('utf-8'))['results']
+    except (ValueError, KeyError, TypeError):
+        pass
+    raise RuntimeError('{} {}'.format(code, response[:200].decode('utf-8', 'replace')))
+
+# updates is a list of (name, secret key, ip, telemetry), with no ip for
+# stopped servers
+def inform_central_server_bulk(updates, central_server_address):
+    try:
+        results = post_central_updates([make_central_update(*update) for update in updates], central_server_address.rstrip('/'))
+    except Exception as e:
+        print('Could not inform central server: ' + str(e))
+        return
+    if results is None:
+        for name, secret_key, ip, telemetry in updates:
+            inform_central_server_v1(ip, secret_key, get_world_central_address(central_server_address, name))
+        return
+    for result in results:
+        if result.get('code') != 200:
+            print('Central server refused the update for {}: {}'.format(result.get('server') or '(default)', result.get('message')))
+
+#------------------------------------------------------------------------------
+# Ask the central server to hand us the server, replacing a previous host whose
+# lease lapsed. Returns True if we got it, False if someone else did first and
+# None if the central server could not be asked.
+#------------------------------------------------------------------------------
+def take_over_central_server(ip, previous_ip, secret_key, central_server_address, lease_time=0):
+    import urllib.parse
+    try:
+        data = urllib.parse.urlencode({'key': secret_key, 'message': 'takeover', 'ip': ip, 'previous': previous_ip or '', 'lease': lease_time}).encode()
+        header = {"Content-Type": "application/x-www-form-urlencoded"}
+        code, response = central_client.request('POST', central_server_address, data, header)
+        if code == 200:
+            return True
+        response = response.decode('utf-8', 'replace')
+        if response.startswith('Server already running'):
+            return False
+        print('Central server refused the takeover: ' + response)
+    except Exception as e:
+        print('Could not access central server: ' + str(e))
+    return None
 
 #------------------------------------------------------------------------------
 # Update the status of the Dropbox file. We either log the IP or delete the
 # file if the server is not running.
 #------------------------------------------------------------------------------
-def update_dropbox_state(ip, server_folder):
-    path = os.path.join(server_folder, 'mc_dropbox_server_status.txt')
+def update_dropbox_state(ip, server_folder, lease_time=0, heartbeat_time=0):
+    leases = read_dropbox_leases(server_folder)
+    lease = merge_dropbox_leases(leases)
+    host = get_host_id()
+    if ip and lease and lease['ip'] and lease['host'] != host and is_live_claim(lease, get_cleared_seq(leases)):
+        print('Warning: the status files say {} claimed the server before us and is still hosting it.'.format(lease['ip']))
+    if ip and lease_time and lease and lease['ip'] == ip and lease['host'] == host and lease['expires']:
+        # Our lease is still good for more than the next heartbeat (plus one
+        # for slack): leave the file alone so Dropbox has nothing to sync.
+        if lease['expires'] - time.time() > 2 * heartbeat_time:
+            return False
+    # Renewing our own live claim keeps the time we made it
+    own = [own for own in leases if own['host'] == host and own['ip'] == ip and is_live_claim(own, get_cleared_seq(leases))]
+    write_dropbox_lease(server_folder, ip, get_next_seq(leases), lease_time, since=own[0]['since'] if ip and own else None)
+    return True
 
-    if ip:
-        with open(path, 'w') as f:
-            f.write(ip + "\n")
-            f.write(time.strftime('%Y/%m/%d %H:%M:%S'))
-    else:
+#------------------------------------------------------------------------------
+# Only one update to the central server is in flight at a time. Heartbeats
+# send theirs in the background (and skip it if the previous one is still
+# going), so a slow central server never delays the Dropbox heartbeat. Other
+# updates wait for the one in flight, so they can't be overtaken by it.
+#------------------------------------------------------------------------------
+central_update_lock = Lock()
+
+def send_central_update_in_background(f, *args):
+    if not central_update_lock.acquire(blocking=False):
+        print('Previous central server update still running. Skipping this one.')
+        return
+    def inform():
         try:
-            os.remove(path)
-        except:
-            pass
+            f(*args)
+        finally:
+            central_update_lock.release()
+    Thread(target=inform, daemon=True).start()
+
+def inform_central_server_in_background(ip, secret_key, central_server_address, telemetry=None):
+    if not central_server_address:
+        return
+    send_central_update_in_background(inform_central_server, ip, secret_key, central_server_address, telemetry)
+
+def inform_central_server_now(ip, secret_key, central_server_address, telemetry=None, stopping=None):
+    with central_update_lock:
+        inform_central_server(ip, secret_key, central_server_address, telemetry, stopping)
 
 #------------------------------------------------------------------------------
 # Mark the server as running. This usually just results in updating the
-# Dropbox state. However, if the central server is used, it is also notified.
+# Dropbox state. However, if the central server is used, it is also notified
+# (in the background for heartbeats), along with a telemetry sample if we are
+# given a ServerTelemetry.
 #------------------------------------------------------------------------------
-def mark_server_as_running(ip, central_server, server_folder, secret_key):
-    inform_central_server(ip, secret_key, central_server)
-    update_dropbox_state(ip, server_folder)
+def mark_server_as_running(ip, central_server, server_folder, secret_key, background=False, lease_time=0, heartbeat_time=0, telemetry=None):
+    sample = telemetry.sample() if telemetry and central_server else None
+    if background:
+        inform_central_server_in_background(ip, secret_key, central_server, sample)
+    else:
+        inform_central_server_now(ip, secret_key, central_server, sample)
+    update_dropbox_state(ip, server_folder, lease_time, heartbeat_time)
 
 #------------------------------------------------------------------------------
 # Mark the server as stopped. This usually just results in updating the
 # Dropbox state. However, if the central server is used, it is also notified.
-# It is equivalent to
-# mark_server_as_running(None, central_server, server_folder, secret_key)
+# Given the IP we hosted it at, the central server only takes the stop if it
+# still has us as the host, so a late stop never clears whoever took over.
 #------------------------------------------------------------------------------
-def mark_server_as_stopped(central_server, server_folder, secret_key):
-    mark_server_as_running(None, central_server, server_folder, secret_key)
+def mark_server_as_stopped(central_server, server_folder, secret_key, ip=None):
+    inform_central_server_now(None, secret_key, central_server, stopping=ip)
+    update_dropbox_state(None, server_folder)
+
+# Unlike stopping, which only ends our own lease, a clear ends everyone's
+def clear_server_status(central_server, server_folder, secret_key):
+    inform_central_server_now(None, secret_key, central_server)
+    write_dropbox_lease(server_folder, None, get_next_seq(read_dropbox_leases(server_folder)), cleared=True)
 
 #------------------------------------------------------------------------------
-# Start the local server with the givem JVM arguments. Once it is started,
-# keep updating the state of the Dropbox file (if a heartbeat time is given).
-# If no heartbeat time is given, update it only when starting and when
-# quitting.
+# Read the server's output as it is produced (so the JVM never blocks on a full
+# pipe) and tee it to the console and to a rotating log file. The most recent
+# lines are kept in memory, and hooks can be registered to react to lines
+# matching a regular expression (e.g. the "Done (Xs)!" line).
 #------------------------------------------------------------------------------
-def start_local_server(server_folder, jvm_flags, server_jar, ip, remote_server_address, full_path_to_server, secret_key, heartbeat_time):
-    os.chdir(server_folder)
+class ServerLogPump(Thread):
+    def __init__(self, stream, log_path=None, ring_size=LOG_RING_SIZE, echo=True, prefix=''):
+        Thread.__init__(self, daemon=True)
+        self.stream = stream
+        self.echo = echo
+        self.prefix = prefix
+        self.lines = deque(maxlen=ring_size)
+        self.lock = Lock()
+        self.hooks = []
+        self.log = None
+        if log_path:
+            import logging.handlers
+            try:
+                self.log = logging.handlers.RotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+                self.log.setFormatter(logging.Formatter('%(message)s'))
+            except OSError as e:
+                print('Could not open log file {}: {}'.format(log_path, e))
+
+    def add_hook(self, pattern, callback):
+        self.hooks.append((re.compile(pattern), callback))
+
+    def recent(self, count=None, pattern=None):
+        with self.lock:
+            lines = list(self.lines)
+        if pattern:
+            lines = [line for line in lines if re.search(pattern, line)]
+        return lines[-count:] if count else lines
+
+    def run(self):
+        import logging
+        for raw in iter(self.stream.readline, b''):
+            line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+            with self.lock:
+                self.lines.append(line)
+            if self.echo:
+                try:
+                    sys.stdout.write(self.prefix + line + '\n')
+                    sys.stdout.flush()
+                except OSError:
+                    # Keep draining the JVM even if the console went away
+                    self.echo = False
+            if self.log:
+                self.log.emit(logging.makeLogRecord({'msg': line}))
+            for regex, callback in self.hooks:
+                match = regex.search(line)
+                if match:
+                    try:
+                        callback(match, line)
+                    except Exception as e:
+                        print('Log hook failed: ' + str(e))
+        if self.log:
+            self.log.close()
+
+def get_default_log_path(server_folder):
+    log_dir = os.path.join(get_local_data_dir(), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, os.path.basename(os.path.normpath(server_folder)) + '.log')
+
+def report_startup_time(launched_at, startup_cache=None, prefix=''):
+    def hook(match, line):
+        elapsed = time.monotonic() - launched_at
+        print(prefix + 'Server ready after {:.1f}s (Minecraft reports {}s)'.format(elapsed, match.group(1)))
+        if startup_cache:
+            startup_cache.record(elapsed)
+    return hook
+
+#------------------------------------------------------------------------------
+# Telemetry sent along with the heartbeats, so the central server can tell how
+# each host copes. Every sample is a list in TELEMETRY_FIELDS order: CPU use of
+# the JVM's process tree since the last sample (percent of one core), its RSS
+# (MB), bytes it read and wrote since the last sample, its thread count, the
+# last TPS the server reported, the number of players online and how many
+# ticks the server said it fell behind since the last sample. Process figures
+# come from /proc (so only on Linux); the rest is parsed from the server log.
+# Anything we can't tell is None.
+#------------------------------------------------------------------------------
+def get_process_tree(root_pid):
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                # The command name may contain spaces, but it is in parentheses
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    tree, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        tree.append(pid)
+        pending.extend(children.get(pid, []))
+    return tree
+
+def read_process_stats(pid):
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # Fields after the command name, starting at 3 (state) in proc(5) numbering
+    stats = {'cpu': int(fields[11]) + int(fields[12]), 'threads': int(fields[17]), 'rss': int(fields[21]), 'read': 0, 'write': 0}
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == 'read_bytes':
+                    stats['read'] = int(value)
+                elif key == 'write_bytes':
+                    stats['write'] = int(value)
+    except OSError:
+        pass
+    return stats
+
+class ServerTelemetry:
+    def __init__(self, pid):
+        self.pid = pid
+        self.lock = Lock()
+        self.players = set()
+        self.player_count = None
+        self.tps = None
+        self.behind = 0
+        self.last = None
+        self.has_proc = os.path.isdir('/proc/{}'.format(pid))
+
+    # Track players and TPS from the server output
+    def attach(self, pump):
+        pump.add_hook(JOIN_PATTERN, self.on_join)
+        pump.add_hook(LEAVE_PATTERN, self.on_leave)
+        pump.add_hook(LIST_PATTERN, self.on_list)
+        pump.add_hook(TPS_PATTERN, self.on_tps)
+        pump.add_hook(BEHIND_PATTERN, self.on_behind)
+
+    def on_join(self, match, line):
+        with self.lock:
+            self.players.add(match.group(1))
+            self.player_count = len(self.players)
+
+    def on_leave(self, match, line):
+        with self.lock:
+            self.players.discard(match.group(1))
+            self.player_count = len(self.players)
+
+    def on_list(self, match, line):
+        with self.lock:
+            self.player_count = int(match.group(1))
+
+    def on_tps(self, match, line):
+        with self.lock:
+            self.tps = float(match.group(1))
+
+    def on_behind(self, match, line):
+        with self.lock:
+            self.behind += int(match.group(1))
+
+    def sample_process(self):
+        totals = {'cpu': 0, 'threads': 0, 'rss': 0, 'read': 0, 'write': 0}
+        for pid in get_process_tree(self.pid):
+            try:
+                stats = read_process_stats(pid)
+            except (OSError, IndexError, ValueError):
+                # It exited while we looked
+                continue
+            for key in totals:
+                totals[key] += stats[key]
+        now, last = time.monotonic(), self.last
+        self.last = (now, totals)
+        page_mb = os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+        cpu = read = write = None
+        if last:
+            elapsed = max(now - last[0], 1e-6)
+            cpu = round(max(totals['cpu'] - last[1]['cpu'], 0) / os.sysconf('SC_CLK_TCK') / elapsed * 100, 1)
+            read = max(totals['read'] - last[1]['read'], 0)
+            write = max(totals['write'] - last[1]['write'], 0)
+        return [cpu, round(totals['rss'] * page_mb, 1), read, write, totals['threads']]
+
+    def sample(self):
+        process = [None] * 5
+        if self.has_proc:
+            try:
+                process = self.sample_process()
+            except OSError:
+                self.has_proc = False
+        with self.lock:
+            behind, self.behind = self.behind, 0
+            return process + [self.tps, self.player_count, behind]
+
+#------------------------------------------------------------------------------
+# The server's console, when we need to type into it ourselves (to save the
+# world, hold its saves while a staged world is copied back, or stop the
+# server). It is then a pipe (launch_server's piped_console), so whatever is
+# typed in ours is passed on to it. save() waits for the server to say the
+# world was saved.
+#------------------------------------------------------------------------------
+class ServerConsole:
+    def __init__(self, process, pump):
+        self.process = process
+        self.lock = Lock()
+        self.save_lock = Lock()
+        self.saved = Event()
+        pump.add_hook(SAVED_PATTERN, lambda match, line: self.saved.set())
+
+    def running(self):
+        return self.process.poll() is None
+
+    def send(self, command):
+        with self.lock:
+            try:
+                self.process.stdin.write((command + '\n').encode('utf-8'))
+                self.process.stdin.flush()
+                return True
+            except (OSError, ValueError):
+                return False
+
+    def forward(self):
+        def forward():
+            for line in sys.stdin:
+                if not self.send(line.rstrip('\r\n')):
+                    break
+        Thread(target=forward, daemon=True).start()
+
+    # Returns True once the server confirmed the save
+    def save(self, flush=False, timeout=SAVE_TIMEOUT):
+        with self.save_lock:
+            self.saved.clear()
+            return self.send('save-all flush' if flush else 'save-all') and self.saved.wait(timeout)
+
+#------------------------------------------------------------------------------
+# Idle stop. The players joining and leaving (tracked by the telemetry) tell us
+# when the server is empty. Once it has been empty for the idle time, the world
+# is saved and the server stopped through its console, and the usual shutdown
+# path then releases the lease.
+#------------------------------------------------------------------------------
+class IdleMonitor:
+    def __init__(self, console, telemetry, idle_time, prefix=''):
+        self.console = console
+        self.process = console.process
+        self.telemetry = telemetry
+        self.idle_time = idle_time
+        self.prefix = prefix
+        self.empty_since = time.monotonic()
+        self.stopping = False
+        self.checker = PeriodicThread(self.check, min(IDLE_CHECK_INTERVAL, idle_time))
+
+    def start(self):
+        self.checker.start()
+
+    def stop(self):
+        self.checker.stop()
+
+    def check(self):
+        if self.stopping or self.process.poll() is not None:
+            return
+        if self.telemetry.player_count:
+            self.empty_since = None
+        elif self.empty_since is None:
+            self.empty_since = time.monotonic()
+        elif time.monotonic() - self.empty_since >= self.idle_time:
+            self.stopping = True
+            self.checker.stop()
+            Thread(target=self.stop_server, daemon=True).start()
+
+    def stop_server(self):
+        import subprocess
+        print(self.prefix + 'Nobody has been online for {}s. Saving the world and stopping the server...'.format(self.idle_time))
+        if not self.console.save():
+            print(self.prefix + 'The server did not confirm the save. Stopping it anyway (it saves again when stopping).')
+        self.console.send('stop')
+        try:
+            self.process.wait(IDLE_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            print(self.prefix + 'The server did not stop within {}s. Terminating it...'.format(IDLE_STOP_TIMEOUT))
+            self.process.terminate()
+
+#------------------------------------------------------------------------------
+# Staging. Instead of running the server straight from the Dropbox folder
+# (where every chunk save gets indexed and uploaded while people play), the
+# server folder is copied to a local directory (tmpfs, SSD...) and run from
+# there. Changed files are copied back every sync interval and when the server
+# stops. Each file is copied to a temporary name Dropbox ignores and then
+# renamed over the original, so peers never see a half-written region file.
+# While the server runs, its saves are turned off (save-off) and the world
+# flushed to disk (save-all flush) before copying, and turned back on after,
+# so neither do we copy a region file the server is halfway through writing.
+#------------------------------------------------------------------------------
+def is_staged_file(relative_path):
+    name = os.path.basename(relative_path)
+    return name not in (STATUS_FILE_NAME, STATUS_TMP_FILE_NAME, MANIFEST_FILE_NAME) and not (name.startswith('~') and name.endswith('.tmp')) and \
+           relative_path.split(os.sep, 1)[0] != STATUS_DIR_NAME
+
+def scan_tree(root):
+    index = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            relative_path = os.path.relpath(path, root)
+            if not is_staged_file(relative_path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            index[relative_path] = (st.st_size, st.st_mtime_ns)
+    return index
+
+def copy_file_atomically(src, dst):
+    import shutil
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(dst), '~' + os.path.basename(dst) + '.tmp')
+    shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+# Make dst look like src, copying only files whose size or mtime differ.
+# Returns the number of files and bytes copied.
+def sync_tree(src, dst, delete=True):
+    src_index = scan_tree(src)
+    dst_index = scan_tree(dst)
+    files, copied = 0, 0
+    for relative_path, (size, mtime) in src_index.items():
+        if dst_index.get(relative_path) == (size, mtime):
+            continue
+        try:
+            copy_file_atomically(os.path.join(src, relative_path), os.path.join(dst, relative_path))
+        except FileNotFoundError:
+            # Deleted by the server while we were syncing
+            continue
+        files += 1
+        copied += size
+    if delete:
+        for relative_path in dst_index.keys() - src_index.keys():
+            try:
+                os.remove(os.path.join(dst, relative_path))
+            except OSError:
+                pass
+    return files, copied
+
+class WorldStage:
+    def __init__(self, server_folder, stage_dir, sync_interval):
+        self.server_folder = server_folder
+        self.path = os.path.join(stage_dir, os.path.basename(os.path.normpath(server_folder)))
+        self.sync_interval = sync_interval
+        self.lock = Lock()
+        self.thread = None
+        self.console = None
+
+    def prepare(self):
+        start = time.monotonic()
+        os.makedirs(self.path, exist_ok=True)
+        files, copied = sync_tree(self.server_folder, self.path)
+        print('Staged server in {} ({} files, {:.1f} MB copied in {:.1f}s)'.format(self.path, files, copied / 1e6, time.monotonic() - start))
+        return self.path
+
+    def sync_back(self):
+        with self.lock:
+            console = self.console
+            paused = bool(console) and console.running()
+            if paused:
+                console.send('save-off')
+                if not console.save(flush=True):
+                    console.send('save-on')
+                    print('The server did not confirm the save. Not syncing back this time.')
+                    return
+            try:
+                start = time.monotonic()
+                files, copied = sync_tree(self.path, self.server_folder)
+            finally:
+                if paused:
+                    console.send('save-on')
+            if files:
+                print('Synced {} changed files ({:.1f} MB) back to {} in {:.1f}s'.format(files, copied / 1e6, self.server_folder, time.monotonic() - start))
+
+    # Periodic syncs need the server's console (a ServerConsole)
+    def start_syncing(self, console):
+        if self.sync_interval:
+            self.console = console
+            self.thread = PeriodicThread(self.sync_back, self.sync_interval)
+            self.thread.start()
+
+    def stop_syncing(self):
+        if self.thread:
+            self.thread.stop()
+            self.thread.join()
+            self.thread = None
+        self.console = None
+
+    # Once the server has stopped
+    def finish(self):
+        self.stop_syncing()
+        self.sync_back()
+
+#------------------------------------------------------------------------------
+# World manifest. When a host stops, it writes the path, size, mtime and
+# SHA-256 of every file in the server folder. Before the next host launches
+# the server, it checks its copy against the manifest, so nobody starts from a
+# world Dropbox hasn't finished downloading. A host removes the manifest as it
+# starts the server, since the world is about to change under it; if that host
+# then crashes, there is no stale manifest left for the next one to wait on.
+# Hashes are remembered in a local index keyed by size and mtime, so only new
+# or changed files are hashed again, and those are hashed in parallel.
+#------------------------------------------------------------------------------
+def hash_file(path):
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def get_hash_index_path(server_folder):
+    import hashlib
+    index_dir = os.path.join(get_local_data_dir(), 'hash_index')
+    os.makedirs(index_dir, exist_ok=True)
+    key = hashlib.sha1(os.path.abspath(server_folder).encode('utf-8')).hexdigest()
+    return os.path.join(index_dir, key + '.json')
+
+# Returns {relative path: (size, mtime_ns, sha256)} for the given files (or
+# all of them), hashing only what the local index doesn't already know.
+def hash_tree(server_folder, index=None, only=None):
+    from concurrent.futures import ThreadPoolExecutor
+    index = scan_tree(server_folder) if index is None else index
+    if only is not None:
+        index = {path: index[path] for path in only if path in index}
+
+    index_path = get_hash_index_path(server_folder)
+    try:
+        with open(index_path) as f:
+            known = json.load(f)
+    except (OSError, ValueError):
+        known = {}
+
+    hashes, to_hash = {}, []
+    for relative_path, (size, mtime) in index.items():
+        entry = known.get(relative_path)
+        if entry and entry[0] == size and entry[1] == mtime:
+            hashes[relative_path] = (size, mtime, entry[2])
+        else:
+            to_hash.append(relative_path)
+
+    def hash_one(relative_path):
+        try:
+            return relative_path, hash_file(os.path.join(server_folder, relative_path))
+        except OSError:
+            return relative_path, None
+
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4)) as pool:
+        for relative_path, digest in pool.map(hash_one, to_hash):
+            if digest:
+                size, mtime = index[relative_path]
+                hashes[relative_path] = (size, mtime, digest)
+
+    if to_hash:
+        known.update({path: list(entry) for path, entry in hashes.items()})
+        try:
+            write_file_atomically(index_path, json.dumps(known))
+        except OSError as e:
+            print('Could not save hash index: ' + str(e))
+    return hashes
+
+def write_world_manifest(server_folder):
+    start = time.monotonic()
+    hashes = hash_tree(server_folder)
+    files = {path: {'size': size, 'mtime': mtime / 1e9, 'sha256': digest} for path, (size, mtime, digest) in hashes.items()}
+    manifest = {'host': get_host_id(), 'written': time.time(), 'files': files}
+    write_file_atomically(os.path.join(server_folder, MANIFEST_FILE_NAME), json.dumps(manifest, indent=0, sort_keys=True), os.path.join(server_folder, '~' + MANIFEST_FILE_NAME + '.tmp'))
+    print('Wrote world manifest ({} files) in {:.1f}s'.format(len(files), time.monotonic() - start))
+
+def remove_world_manifest(server_folder):
+    try:
+        os.remove(os.path.join(server_folder, MANIFEST_FILE_NAME))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print('Could not remove the world manifest: ' + str(e))
+
+def read_world_manifest(server_folder):
+    try:
+        with open(os.path.join(server_folder, MANIFEST_FILE_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Returns the files that don't match the manifest yet (empty if all is synced)
+def find_unsynced_files(server_folder, manifest):
+    index = scan_tree(server_folder)
+    unsynced, candidates = [], []
+    for relative_path, entry in manifest['files'].items():
+        local = index.get(relative_path)
+        if not local or local[0] != entry['size']:
+            unsynced.append(relative_path)
+        else:
+            candidates.append(relative_path)
+    hashes = hash_tree(server_folder, index, candidates)
+    for relative_path in candidates:
+        if relative_path not in hashes or hashes[relative_path][2] != manifest['files'][relative_path]['sha256']:
+            unsynced.append(relative_path)
+    return unsynced
+
+def wait_for_world_sync(server_folder, max_wait):
+    manifest = read_world_manifest(server_folder)
+    if not manifest:
+        return True
+    deadline = time.monotonic() + max_wait
+    while True:
+        start = time.monotonic()
+        unsynced = find_unsynced_files(server_folder, manifest)
+        if not unsynced:
+            print('World matches the manifest written by {} ({} files checked in {:.1f}s)'.format(manifest.get('host'), len(manifest['files']), time.monotonic() - start))
+            return True
+        if time.monotonic() >= deadline:
+            print('{} files still differ from the manifest written by {}, e.g. {}'.format(len(unsynced), manifest.get('host'), ', '.join(sorted(unsynced)[:5])))
+            return False
+        print('Waiting for Dropbox to finish syncing {} files...'.format(len(unsynced)))
+        time.sleep(min(SYNC_CHECK_INTERVAL, max(0, deadline - time.monotonic())))
+        manifest = read_world_manifest(server_folder) or manifest
+
+#------------------------------------------------------------------------------
+# Chunk-level deduplicating snapshots. A snapshot store has two folders:
+# objects/, where blobs are kept under their SHA-256 (so each distinct blob is
+# stored once), and snapshots/, with one JSON file per snapshot mapping each
+# file of the server folder to its blobs. Region files (.mca) are split into
+# their chunks, so a region where a handful of chunks changed only adds those
+# chunks (plus a small "recipe" listing where every chunk goes). Files whose
+# size and mtime match the previous snapshot are not even read, so taking a
+# snapshot costs about as much as the data that changed.
+#------------------------------------------------------------------------------
+class SnapshotStore:
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.snapshots = os.path.join(path, 'snapshots')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.snapshots, exist_ok=True)
+        self.stored_bytes = 0
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def put(self, data):
+        import hashlib
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self.stored_bytes += len(data)
+        return digest
+
+    def get(self, digest):
+        with open(self.object_path(digest), 'rb') as f:
+            return f.read()
+
+    def list(self):
+        return sorted(name[:-len('.json')] for name in os.listdir(self.snapshots) if name.endswith('.json'))
+
+    def load(self, snapshot_id):
+        with open(os.path.join(self.snapshots, snapshot_id + '.json')) as f:
+            return json.load(f)
+
+    def save(self, snapshot):
+        write_file_atomically(os.path.join(self.snapshots, snapshot['id'] + '.json'), json.dumps(snapshot))
+
+# Split a region file into its header timestamps and chunks. Each chunk is
+# (sector offset, sector count, payload), the payload being the chunk's length
+# field, compression type and data. Returns None if it doesn't look like a
+# valid region file (it is then stored as a plain blob).
+def split_region(data):
+    if len(data) < 2 * REGION_SECTOR_SIZE:
+        return None
+    chunks = []
+    for i in range(REGION_CHUNKS):
+        offset = int.from_bytes(data[i * 4:i * 4 + 3], 'big')
+        count = data[i * 4 + 3]
+        if not offset and not count:
+            chunks.append(None)
+            continue
+        start = offset * REGION_SECTOR_SIZE
+        if offset < 2 or start + 5 > len(data):
+            return None
+        end = start + 4 + int.from_bytes(data[start:start + 4], 'big')
+        if end > len(data):
+            return None
+        chunks.append((offset, count, data[start:end]))
+    return data[REGION_SECTOR_SIZE:2 * REGION_SECTOR_SIZE], chunks
+
+def join_region(size, timestamps, chunks):
+    data = bytearray(size)
+    data[REGION_SECTOR_SIZE:2 * REGION_SECTOR_SIZE] = timestamps
+    for i, chunk in enumerate(chunks):
+        if chunk:
+            offset, count, payload = chunk
+            data[i * 4:i * 4 + 4] = offset.to_bytes(3, 'big') + bytes([count])
+            data[offset * REGION_SECTOR_SIZE:offset * REGION_SECTOR_SIZE + len(payload)] = payload
+    return bytes(data)
+
+def store_file(store, path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    region = split_region(data) if path.endswith(REGION_EXTENSION) else None
+    if region:
+        timestamps, chunks = region
+        recipe = {'timestamps': store.put(timestamps),
+                  'chunks': [[chunk[0], chunk[1], store.put(chunk[2])] if chunk else None for chunk in chunks]}
+        return {'region': store.put(json.dumps(recipe).encode('utf-8'))}, len(data)
+    return {'blob': store.put(data)}, len(data)
+
+def restore_file(store, entry, path):
+    if 'region' in entry:
+        recipe = json.loads(store.get(entry['region']).decode('utf-8'))
+        chunks = [(chunk[0], chunk[1], store.get(chunk[2])) if chunk else None for chunk in recipe['chunks']]
+        data = join_region(entry['size'], store.get(recipe['timestamps']), chunks)
+    else:
+        data = store.get(entry['blob'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path), '~' + os.path.basename(path) + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    os.utime(path, ns=(entry['mtime'], entry['mtime']))
+
+# The files of the server folder that go into a snapshot (skipping the
+# snapshot folder itself, should it live inside the server folder).
+def scan_snapshot_files(server_folder, snapshot_dir):
+    prefix = os.path.relpath(os.path.abspath(snapshot_dir), os.path.abspath(server_folder)) + os.sep
+    return {relative_path: stat for relative_path, stat in scan_tree(server_folder).items() if not relative_path.startswith(prefix)}
+
+def take_snapshot(server_folder, snapshot_dir):
+    store = SnapshotStore(snapshot_dir)
+    previous = store.list()
+    previous_files = store.load(previous[-1])['files'] if previous else {}
+
+    start = time.monotonic()
+    files, total, read = {}, 0, 0
+    for relative_path, (size, mtime) in scan_snapshot_files(server_folder, snapshot_dir).items():
+        total += size
+        entry = previous_files.get(relative_path)
+        if entry and entry['size'] == size and entry['mtime'] == mtime:
+            files[relative_path] = entry
+            continue
+        try:
+            entry, size = store_file(store, os.path.join(server_folder, relative_path))
+        except OSError as e:
+            print('Could not snapshot {}: {}'.format(relative_path, e))
+            continue
+        entry.update({'size': size, 'mtime': mtime})
+        files[relative_path] = entry
+        read += size
+
+    snapshot_id = time.strftime('%Y%m%d-%H%M%S')
+    while snapshot_id in previous:
+        snapshot_id += '+'
+    store.save({'id': snapshot_id, 'host': get_host_id(), 'created': time.time(), 'files': files})
+    elapsed = max(time.monotonic() - start, 1e-6)
+    print('Snapshot {}: {} files, {:.1f} MB in world, {:.1f} MB read, {:.1f} MB new, {:.1f}s ({:.1f} MB/s)'.format(
+        snapshot_id, len(files), total / 1e6, read / 1e6, store.stored_bytes / 1e6, elapsed, total / 1e6 / elapsed))
+    return snapshot_id
+
+def restore_snapshot(server_folder, snapshot_dir, snapshot_id):
+    store = SnapshotStore(snapshot_dir)
+    snapshot = store.load(snapshot_id)
+    start = time.monotonic()
+    current = scan_snapshot_files(server_folder, snapshot_dir)
+    restored = 0
+    for relative_path, entry in snapshot['files'].items():
+        if current.get(relative_path) == (entry['size'], entry['mtime']):
+            continue
+        restore_file(store, entry, os.path.join(server_folder, relative_path))
+        restored += entry['size']
+    for relative_path in current.keys() - snapshot['files'].keys():
+        os.remove(os.path.join(server_folder, relative_path))
+    elapsed = max(time.monotonic() - start, 1e-6)
+    print('Restored snapshot {} ({:.1f} MB written in {:.1f}s, {:.1f} MB/s)'.format(snapshot_id, restored / 1e6, elapsed, restored / 1e6 / elapsed))
+
+def prune_snapshots(snapshot_dir, keep):
+    store = SnapshotStore(snapshot_dir)
+    snapshots = store.list()
+    for snapshot_id in snapshots[:max(0, len(snapshots) - keep)]:
+        os.remove(os.path.join(store.snapshots, snapshot_id + '.json'))
+
+    referenced = set()
+    for snapshot_id in store.list():
+        for entry in store.load(snapshot_id)['files'].values():
+            if 'region' in entry:
+                referenced.add(entry['region'])
+                recipe = json.loads(store.get(entry['region']).decode('utf-8'))
+                referenced.add(recipe['timestamps'])
+                referenced.update(chunk[2] for chunk in recipe['chunks'] if chunk)
+            else:
+                referenced.add(entry['blob'])
+
+    removed, freed = 0, 0
+    for dirpath, dirnames, filenames in os.walk(store.objects):
+        for name in filenames:
+            if os.path.basename(dirpath) + name not in referenced:
+                path = os.path.join(dirpath, name)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                removed += 1
+    print('Pruned {} snapshots and {} objects ({:.1f} MB freed)'.format(max(0, len(snapshots) - keep), removed, freed / 1e6))
+
+def list_snapshots(snapshot_dir):
+    store = SnapshotStore(snapshot_dir)
+    for snapshot_id in store.list():
+        snapshot = store.load(snapshot_id)
+        size = sum(entry['size'] for entry in snapshot['files'].values())
+        print('{}  {}  {} files  {:.1f} MB  (by {})'.format(snapshot_id, time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(snapshot['created'])), len(snapshot['files']), size / 1e6, snapshot.get('host')))
+
+#------------------------------------------------------------------------------
+# Startup optimisation (-O). Most of the JVM's startup goes into loading and
+# verifying the same classes on every launch. The first optimised launch dumps
+# them into a Class Data Sharing (AppCDS) archive when the server exits, and
+# later launches map that archive instead. The archive is only valid for one
+# jar and one Java build, so it is kept locally under a name made of both.
+# Unless -o is given, the heap size and GC flags are also chosen from the
+# memory available and the size of the world, instead of a fixed 3G.
+#------------------------------------------------------------------------------
+def get_java_version():
+    import subprocess
+    try:
+        output = subprocess.run(['java', '-version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30).stdout.decode('utf-8', 'replace')
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = re.search(r'version "([^"]+)"', output)
+    return match.group(1) if match else None
+
+def get_java_major_version(version):
+    parts = version.split('.')
+    # Java 8 and older report themselves as 1.x
+    major = parts[1] if parts[0] == '1' and len(parts) > 1 else parts[0]
+    match = re.match(r'\d+', major)
+    return int(match.group(0)) if match else 0
+
+def get_available_memory_mb():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# Bigger worlds keep more chunks and entities around, so start from a base heap
+# and add the size of the world, without eating into what the system needs.
+def derive_jvm_flags(available_mb, world_size):
+    heap = BASE_HEAP_MB + world_size // (1024 * 1024)
+    if available_mb:
+        heap = min(heap, available_mb - SYSTEM_RESERVED_MB)
+    heap = max(heap, MIN_HEAP_MB)
+    return '-Xms{0}M -Xmx{0}M {1}'.format(heap, GC_FLAGS)
+
+class StartupCache:
+    def __init__(self, jar_path, java_version):
+        key = '{}-{}'.format(hash_file(jar_path)[:16], re.sub(r'[^\w.-]', '_', java_version))
+        cds_dir = os.path.join(get_local_data_dir(), 'cds')
+        os.makedirs(cds_dir, exist_ok=True)
+        self.key = key
+        self.archive = os.path.join(cds_dir, key + '.jsa')
+        self.tmp_archive = self.archive + '.tmp'
+        self.has_archive = os.path.exists(self.archive)
+        self.label = 'with CDS archive' if self.has_archive else 'without CDS archive'
+
+    def flags(self):
+        if self.has_archive:
+            return '-XX:SharedArchiveFile="{}" -Xshare:auto'.format(self.archive)
+        return '-XX:ArchiveClassesAtExit="{}"'.format(self.tmp_archive)
+
+    # The JVM writes the archive as it exits; only keep it if it got that far
+    def finish(self):
+        if not self.has_archive and os.path.exists(self.tmp_archive):
+            os.replace(self.tmp_archive, self.archive)
+            print('Saved CDS archive for the next launches ({:.1f} MB)'.format(os.path.getsize(self.archive) / 1e6))
+
+    def record(self, elapsed):
+        path = os.path.join(get_local_data_dir(), STARTUP_TIMES_FILE_NAME)
+        try:
+            with open(path) as f:
+                times = json.load(f)
+        except (OSError, ValueError):
+            times = {}
+        runs = times.setdefault(self.key, {}).setdefault(self.label, [])
+        runs.append(round(elapsed, 3))
+        del runs[:-STARTUP_TIMES_KEPT]
+        try:
+            write_file_atomically(path, json.dumps(times))
+        except OSError:
+            pass
+        for label, runs in sorted(times[self.key].items()):
+            print('Time to Done {}: {:.1f}s (median of {} launches)'.format(label, sorted(runs)[len(runs) // 2], len(runs)))
+
+def get_jvm_options(options, server_folder, jar_name, timings):
+    if not options.optimize_startup:
+        return options.jvm_options or DEFAULT_JVM_OPTIONS, None
+    with timings.phase('jvm'):
+        flags = options.jvm_options
+        if not flags:
+            world_size = sum(size for size, mtime in scan_tree(server_folder).values())
+            flags = derive_jvm_flags(get_available_memory_mb(), world_size)
+        java_version = get_java_version()
+        if not java_version:
+            print('Could not find out the Java version. Not using a CDS archive.')
+            return flags, None
+        if get_java_major_version(java_version) < CDS_MIN_JAVA_VERSION:
+            print('Java {} cannot create CDS archives (Java {}+ needed). Not using one.'.format(java_version, CDS_MIN_JAVA_VERSION))
+            return flags, None
+        cache = StartupCache(os.path.join(server_folder, jar_name), java_version)
+    print('JVM options: {} ({})'.format(flags, cache.label))
+    return '{} {}'.format(flags, cache.flags()), cache
+
+#------------------------------------------------------------------------------
+# Hot standby (-S). Instead of giving up when someone else is hosting, wait
+# with everything needed to host already resolved, and take over as soon as
+# the host stops or its lease lapses. Waiting is cheap: the status files are
+# only stat()ed, and read again only when one of them changes. With a central server, a
+# long-poll watch also wakes us up the moment the host reports it stopped.
+#
+# When a host dies several standbys may notice at once, so they claim the
+# server before starting it. With a central server the claim is a single
+# atomic takeover there. Otherwise each standby waits a few slots (picked from
+# its identity, so standbys rarely pick the same one), writes its own lease and
+# waits for Dropbox to settle; whoever's lease the merge picks then has won.
+#------------------------------------------------------------------------------
+def get_lease_deadline(lease, heartbeat_time):
+    if lease['expires'] is not None:
+        return lease['expires']
+    if heartbeat_time:
+        return os.path.getmtime(lease['path']) + 2 * heartbeat_time
+    return None
+
+# Returns the lease that lapsed (or None if there was no status file at all).
+# A lease we already lost the claim for is ignored until the file changes.
+def wait_for_lease_to_lapse(server_folder, heartbeat_time, lease_time, wake, ignore=None, ignore_until=0):
+    last_signature, lease, deadline, reported, empty_since = None, None, None, None, None
+    while True:
+        signature = get_status_signature(server_folder)
+        # Ignoring a lease we already failed to claim, for a while
+        ignoring = ignore is not None and time.time() < ignore_until
+        if signature:
+            empty_since = None
+        elif not ignoring:
+            # No status files may just mean Dropbox hasn't brought them yet:
+            # give them a full lease to show up before taking over
+            if empty_since is None:
+                empty_since = time.time()
+                print(time.strftime('%Y/%m/%d %H:%M:%S'), 'No lease found. Standing by for {:.0f}s in case one shows up...'.format(lease_time))
+            if time.time() - empty_since >= lease_time:
+                return None
+        if signature and signature != last_signature:
+            last_signature = signature
+            lease = read_dropbox_lease(server_folder)
+            if not lease:
+                continue
+            deadline = get_lease_deadline(lease, heartbeat_time) if lease['ip'] else time.time()
+        if lease and deadline is not None and time.time() >= deadline and not (ignoring and is_same_lease(lease, ignore)):
+            if lease['ip']:
+                print(time.strftime('%Y/%m/%d %H:%M:%S'), 'Lease of {} lapsed {:.1f}s ago'.format(lease['ip'], time.time() - deadline))
+            return lease
+        if lease and lease['ip'] and reported != (lease['ip'], lease['seq']):
+            reported = (lease['ip'], lease['seq'])
+            print(time.strftime('%Y/%m/%d %H:%M:%S'), 'Standing by. Server is running at {}'.format(lease['ip']) + (' (lease ends in {:.0f}s)'.format(deadline - time.time()) if deadline else ''))
+        timeout = STANDBY_POLL_INTERVAL if deadline is None else min(STANDBY_POLL_INTERVAL, max(deadline - time.time(), 0))
+        if empty_since is not None:
+            timeout = min(timeout, max(empty_since + lease_time - time.time(), 0))
+        if wake.wait(timeout):
+            wake.clear()
+            last_signature = None
+
+def watch_for_standby(secret_key, server, wake):
+    version = -1
+    while True:
+        status, new_version = watch_central_server(secret_key, server, version)
+        if status is None:
+            time.sleep(CENTRAL_RETRY_DELAY * random.uniform(2, 6))
+        elif new_version != version:
+            version = new_version
+            wake.set()
+
+def get_standby_stagger(ip, lease):
+    import hashlib
+    seed = '{}|{}|{}'.format(get_host_id(), ip, lease['seq'] if lease else 0).encode('utf-8')
+    return int(hashlib.sha1(seed).hexdigest(), 16) % STANDBY_STAGGER_SLOTS * STANDBY_STAGGER_STEP
+
+def is_same_lease(a, b):
+    if not a or not b:
+        return a is b
+    return (a['ip'], a['seq'], a['host']) == (b['ip'], b['seq'], b['host'])
+
+def claim_server(ip, lapsed, options, server_folder):
+    previous_ip = lapsed['ip'] if lapsed else ''
+    if options.server_address:
+        claimed = take_over_central_server(ip, previous_ip, options.secret_key, options.server_address, options.lease_time or 2 * options.heartbeat_time)
+        if claimed is not None:
+            return claimed
+
+    time.sleep(get_standby_stagger(ip, lapsed))
+    # Someone else claimed it while we waited our turn
+    if not is_same_lease(read_dropbox_lease(server_folder), lapsed):
+        return False
+    seq = get_next_seq(read_dropbox_leases(server_folder))
+    write_dropbox_lease(server_folder, ip, seq, options.lease_time or 2 * options.heartbeat_time)
+    time.sleep(options.standby_settle)
+    lease = read_dropbox_lease(server_folder)
+    return bool(lease) and (lease['ip'], lease['seq'], lease['host']) == (ip, seq, get_host_id())
+
+def stand_by(ip, options, server_folder):
+    wake = Event()
+    if options.server_address:
+        Thread(target=watch_for_standby, args=(options.secret_key, options.server_address, wake), daemon=True).start()
+    lease_time = options.lease_time or 2 * options.heartbeat_time
+    lost, lost_until = None, 0
+    while True:
+        lapsed = wait_for_lease_to_lapse(server_folder, options.heartbeat_time, lease_time, wake, lost, lost_until)
+        lapsed_at = time.monotonic()
+        if claim_server(ip, lapsed, options, server_folder):
+            print(time.strftime('%Y/%m/%d %H:%M:%S'), 'Claimed the server in {:.1f}s. Taking over...'.format(time.monotonic() - lapsed_at))
+            # The host we replace crashed, so the manifest is older than the world
+            return not lapsed or not lapsed['ip']
+        # Another standby got it, or the host turned out to be alive. Unless
+        # the lease changes, try again only once another lease has gone by.
+        print(time.strftime('%Y/%m/%d %H:%M:%S'), 'Could not claim the server. Standing by...')
+        lost, lost_until = lapsed, time.time() + lease_time
+        wake.wait(STANDBY_POLL_INTERVAL)
+
+#------------------------------------------------------------------------------
+# Our lease on the server while we host it. It is renewed every heartbeat (if
+# a heartbeat time is given; otherwise the server is only marked as running
+# once) from the moment we claim the server until we are done with the world:
+# after the server stops, a staged world still has to be copied back and the
+# manifest written, and nobody may take over before. Releasing it marks the
+# server as stopped, by us. While the server runs, heartbeats carry its
+# telemetry.
+#------------------------------------------------------------------------------
+class HostLease:
+    def __init__(self, ip, options, server_folder):
+        self.ip = ip
+        self.options = options
+        self.server_folder = server_folder
+        self.telemetry = None
+        self.thread = None
+        self.started = False
+        self.released = False
+
+    def renew(self):
+        options = self.options
+        mark_server_as_running(self.ip, options.server_address, self.server_folder, options.secret_key, True, options.lease_time, options.heartbeat_time, self.telemetry)
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        if self.options.heartbeat_time:
+            self.thread = PeriodicThread(self.renew, self.options.heartbeat_time, HEARTBEAT_JITTER)
+            self.thread.start()
+        else:
+            mark_server_as_running(self.ip, self.options.server_address, self.server_folder, self.options.secret_key)
+
+    def release(self):
+        if not self.started or self.released:
+            return
+        self.released = True
+        if self.thread:
+            self.thread.stop()
+            self.thread.join()
+        mark_server_as_stopped(self.options.server_address, self.server_folder, self.options.secret_key, self.ip)
+
+#------------------------------------------------------------------------------
+# Start the local server with the givem JVM arguments, and wait for it to
+# finish. The lease is kept by the caller.
+#------------------------------------------------------------------------------
+# Launch the JVM with its output going through a log pump (which the caller
+# starts, once it has added its own hooks). With piped_console, its console is
+# process.stdin rather than ours.
+def launch_server(server_folder, jvm_flags, server_jar, log_path=None, startup_cache=None, prefix='', piped_console=False):
+    import subprocess
     command = 'java {:s} -jar {:s} '.format(jvm_flags, server_jar)
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+    launched_at = time.monotonic()
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE if piped_console else None, cwd=server_folder)
+    pump = ServerLogPump(process.stdout, log_path, prefix=prefix)
+    pump.add_hook(DONE_PATTERN, report_startup_time(launched_at, startup_cache, prefix))
+    return process, pump
+
+def start_local_server(server_folder, jvm_flags, server_jar, lease, log_path=None, startup_cache=None, idle_time=0, stage=None):
+    os.chdir(server_folder)
+    syncing = bool(stage and stage.sync_interval)
+    process, pump = launch_server(server_folder, jvm_flags, server_jar, log_path, startup_cache, piped_console=bool(idle_time) or syncing)
+    telemetry = ServerTelemetry(process.pid)
+    telemetry.attach(pump)
+    lease.telemetry = telemetry
+    console, idle_monitor = None, None
+    if idle_time or syncing:
+        console = ServerConsole(process, pump)
+        console.forward()
+    if idle_time:
+        idle_monitor = IdleMonitor(console, telemetry, idle_time)
     print('Server process started. Waiting for it to finish...')
-    if heartbeat_time:
-        updaterThread = PeriodicThread(lambda: mark_server_as_running(ip, remote_server_address, full_path_to_server, secret_key), heartbeat_time)
-        updaterThread.start()
+    pump.start()
+    if idle_monitor:
+        idle_monitor.start()
+    if syncing:
+        stage.start_syncing(console)
+    try:
         process.wait()
-        updaterThread.stop()
-    else:
-        mark_server_as_running(ip, remote_server_address, full_path_to_server, secret_key)
+    except KeyboardInterrupt:
+        # The server got the interrupt too; let it save and exit before
+        # anything (such as a staged world) is copied
         process.wait()
+        raise
+    finally:
+        lease.telemetry = None
+        if idle_monitor:
+            idle_monitor.stop()
+        if stage:
+            stage.stop_syncing()
+    pump.join()
+    if startup_cache:
+        startup_cache.finish()
 
 
-def parse_input():
+def parse_input(timings):
     parser = OptionParser()
     parser.add_option('-s', '--server', help='Set the remote/central server address (default: http://a.server.com:9000; default: None). If no remote server is supplied, only Dropbox backend will be used.', dest='server_address', type='string', default=None)
     parser.add_option('-k', '--secret-key', help='Set the secret key.', dest='secret_key', type='string')
@@ -301,14 +1978,37 @@ def parse_input():
     parser.add_option('-n', '--name',help='Set the server name. This should match the shared folder in Dropbox. E.g., if server is named DEI, then a folder with that name (and with the jar in it) should be at the root of your Dropbox folder.',dest='server_name', type='string', default=None)
     parser.add_option('-p', '--path',help='Manually supply the full path to the server, bypassing dropbox altogether. Cannot use -p with -d and -n.',dest='server_path', type='string', default=None)
     parser.add_option('-j', '--jar',help='Server jar name. By default, the first jar found in the server folder will be used.',dest='jar_name', type='string', default=None)
-    parser.add_option('-o', '--jvm-options',help='JVM options to use when starting the server (Default: "{}")'.format(DEFAULT_JVM_OPTIONS),dest='jvm_options', type='string', default=DEFAULT_JVM_OPTIONS)
+    parser.add_option('-o', '--jvm-options',help='JVM options to use when starting the server (Default: "{}", or derived from the available memory and world size with -O)'.format(DEFAULT_JVM_OPTIONS),dest='jvm_options', type='string', default=None)
+    parser.add_option('-O', '--optimize-startup',help='Speed up the server startup with a cached Class Data Sharing archive (Java 13+), created on the first launch. Unless -o is given, heap and GC flags are chosen from the available memory and the world size.',dest='optimize_startup', action='store_true', default=False)
     parser.add_option('-i', '--ip',help='Set the IP to report in case a server is started. By default, the public facing IP is auto-detected.',dest='ip', type='string', default=None)
+    parser.add_option('-e', '--ip-endpoint',help='Query this URL for the public IP (instead of the built-in list). Can be given many times; all of them are queried at the same time.',dest='ip_endpoints', action='append', default=None)
+    parser.add_option('-x', '--no-ip-cache',help='Do not use (or update) the locally cached public IP.',dest='ip_cache', action='store_false', default=True)
     parser.add_option('-b', '--heartbeat',help="Set the heartbeat time (interval, in seconds, between successive updates of server status to Dropbox). If the Dropbox status hasn't been updated in 2*[heartbeat time], the server is considered to be stopped. Set to 0 if you want to disable heartbeats. By disabling them, the server status is updated only once and the modification time is ignored when querying for time. (Default: {})".format(DEFAULT_HEARTBEAT), dest='heartbeat_time', type='int', default=2*DEFAULT_HEARTBEAT)
+    parser.add_option('-L', '--lease-time',help="Set how long (in seconds) each heartbeat keeps us registered as the host. The status file is only rewritten when the lease is about to run out, so a long lease means far fewer writes for Dropbox to sync, but a crash takes longer to notice. (Default: 2*[heartbeat time])", dest='lease_time', type='int', default=None)
     parser.add_option('-q', '--query-status',help='Just query the status of the server (is it running, and who is running it?)',dest='query_status', action='store_true', default=False)
+    parser.add_option('-w', '--watch',help='Keep watching the central server and print every change of who is running the server. Requires -s.',dest='watch', action='store_true', default=False)
+    parser.add_option('-g', '--stage-dir',help='Copy the server to this local folder (e.g. on tmpfs or an SSD) and run it from there, syncing changed files back to the Dropbox folder periodically and when the server stops.',dest='stage_dir', type='string', default=None)
+    parser.add_option('-y', '--sync-interval',help='Set the interval, in seconds, between syncs of a staged server back to the Dropbox folder. Set to 0 to only sync when the server stops. (Default: {})'.format(DEFAULT_SYNC_INTERVAL),dest='sync_interval', type='int', default=DEFAULT_SYNC_INTERVAL)
+    parser.add_option('-W', '--sync-wait',help='Before starting the server, wait up to this many seconds for Dropbox to finish syncing the world written by the last host. (Default: {})'.format(DEFAULT_SYNC_WAIT),dest='sync_wait', type='int', default=DEFAULT_SYNC_WAIT)
+    parser.add_option('-z', '--skip-sync-check',help='Start the server even if the world does not match the manifest written by the last host.',dest='sync_check', action='store_false', default=True)
+    parser.add_option('-l', '--log-file',help='Also write the server output to this file, rotated every {} MB (default: ~/{}/logs/[server folder name].log)'.format(LOG_MAX_BYTES // (1024 * 1024), LOCAL_DATA_DIR),dest='log_file', type='string', default=None)
+    parser.add_option('-t', '--timings',help='Print how long each startup phase took.',dest='timings', action='store_true', default=False)
+    parser.add_option('-B', '--snapshot-dir',help='Keep chunk-level deduplicated snapshots of the server in this folder. A snapshot is taken every time the server stops.',dest='snapshot_dir', type='string', default=None)
+    parser.add_option('-u', '--list-snapshots',help='List the snapshots in the snapshot folder (requires -B).',dest='list_snapshots', action='store_true', default=False)
+    parser.add_option('-r', '--restore-snapshot',help='Restore the server folder to the given snapshot (requires -B). Only possible while nobody is running the server.',dest='restore_snapshot', type='string', default=None)
+    parser.add_option('-P', '--prune-snapshots',help='Delete all but the given number of most recent snapshots, and the data only they used (requires -B).',dest='prune_snapshots', type='int', default=None)
+    parser.add_option('-S', '--standby',help='Hot standby: if someone else is hosting, wait with everything ready and take over as soon as they stop or their lease lapses. Standbys claim the server before starting it, so only one of them takes over.',dest='standby', action='store_true', default=False)
+    parser.add_option('-X', '--standby-settle',help='Without a central server, how many seconds a standby waits for its claim to reach Dropbox before trusting it (Default: {})'.format(DEFAULT_STANDBY_SETTLE),dest='standby_settle', type='float', default=DEFAULT_STANDBY_SETTLE)
+    parser.add_option('-I', '--idle-stop',help='Save the world and stop the server once nobody has been online for this many seconds, so someone else can host right away. Commands typed into the server console are then passed on to it. (Default: 0, never)',dest='idle_time', type='int', default=0)
+    parser.add_option('-M', '--supervise',help='Run every world listed in the given JSON config file from this one process, with shared heartbeats and a total memory budget (see the README).',dest='supervise', type='string', default=None)
     parser.add_option('-c', '--clear',help='DEPRECATED: Should not be needed if appropriate heartbeat values are chosen. Clear the saved state of the current server session. USE WITH CARE. This notifies everyone that the server isn\'t actually running. If it _is_ running, it is a very bad idea to do this. Use only after a system crash or similar accident.',dest='clear', action='store_true', default=False)
 
     (options, args) = parser.parse_args()
+    timings.enabled = options.timings
 
+    if options.supervise:
+        # Everything else comes from the config file
+        return options, None
     if options.server_address and not options.secret_key:
         parser.error('A secret key is required when using a central server! Use -k')
     if (options.dropbox_path or options.server_name) and options.server_path:
@@ -327,6 +2027,12 @@ def parse_input():
 
     if options.clear and options.query_status:
         parser.error("Can't use both the -c and -q options. Choose one of them!")
+    if options.watch and not options.server_address:
+        parser.error('Watching requires a central server! Use -s')
+    if (options.list_snapshots or options.restore_snapshot or options.prune_snapshots is not None) and not options.snapshot_dir:
+        parser.error('A snapshot folder is required to manage snapshots! Use -B')
+    if options.prune_snapshots is not None and options.prune_snapshots < 0:
+        parser.error('Invalid number of snapshots to keep ({}). Please supply a non-negative integer!'.format(options.prune_snapshots))
 
     if not directory_exists(full_path):
         parser.error("Directory {} does not exist.".format(full_path))
@@ -337,11 +2043,29 @@ def parse_input():
     elif options.heartbeat_time == 0:
         print('Disabling heartbeat...')
 
+    if options.stage_dir and not directory_exists(options.stage_dir):
+        parser.error("Staging directory {} does not exist.".format(options.stage_dir))
+    if options.sync_wait < 0:
+        parser.error('Invalid sync wait ({}). Please supply a non-negative integer!'.format(options.sync_wait))
+    if options.sync_interval < 0:
+        parser.error('Invalid sync interval ({}). Please supply a non-negative integer!'.format(options.sync_interval))
+    if options.standby_settle < 0:
+        parser.error('Invalid standby settle time ({}). Please supply a non-negative number!'.format(options.standby_settle))
+    if options.idle_time < 0:
+        parser.error('Invalid idle time ({}). Please supply a non-negative integer!'.format(options.idle_time))
+    if options.standby and not options.heartbeat_time:
+        print('Heartbeat is disabled, so a standby can only take over when the host stops cleanly.')
+
+    if options.lease_time is None:
+        options.lease_time = 2*options.heartbeat_time
+    elif options.lease_time < 2*options.heartbeat_time:
+        parser.error('The lease time ({}) must be at least twice the heartbeat time ({}).'.format(options.lease_time, options.heartbeat_time))
+
     if options.clear:
         print('ARE YOU SURE THAT THE SERVER REALLY IS STOPPED? (y/n) ')
         choice = input().lower()
         if choice in ['y', 'yes', 'ye', 's']:
-            mark_server_as_stopped(options.server_address, full_path, options.secret_key, 2*options.heartbeat_time)
+            clear_server_status(options.server_address, full_path, options.secret_key)
             exit("Done. All status cleared. Don't come complaining if you mess up someone's game!")
         else:
             exit('Status clear aborted.')
@@ -351,48 +2075,367 @@ def parse_input():
             exit('Server is running at {:s}'.format(status))
         else:
             exit('Server is not running.')
+    elif options.watch:
+        watch_status(options.secret_key, options.server_address)
+        exit()
+    elif options.list_snapshots:
+        list_snapshots(options.snapshot_dir)
+        exit()
+    elif options.prune_snapshots is not None:
+        prune_snapshots(options.snapshot_dir, options.prune_snapshots)
+        exit()
+    elif options.restore_snapshot:
+        status = is_someone_running_server(options.server_address, full_path, options.secret_key, 2*options.heartbeat_time)
+        if status:
+            exit('Server is running at {:s}. Cannot restore a snapshot now!'.format(status))
+        try:
+            restore_snapshot(full_path, options.snapshot_dir, options.restore_snapshot)
+        except FileNotFoundError as e:
+            exit('Could not restore snapshot {}: {}'.format(options.restore_snapshot, e))
+        write_world_manifest(full_path)
+        exit()
 
-    if options.jar_name:
-        jar_name = options.jar_name
-    else:
-        jar_name = find_first_jar(full_path)
-        if not jar_name:
-            parser.error('No jar files were found in server folder ({}) and no jar name supplied!'.format(full_path))
+    return options, full_path
 
+#------------------------------------------------------------------------------
+# Things only needed to host the server: the jar and our IP. They are resolved
+# only once we know nobody else is hosting, and at the same time.
+#------------------------------------------------------------------------------
+def resolve_jar(options, full_path):
+    if options.jar_name:
+        return options.jar_name
+    jar_name = find_first_jar(full_path)
+    if not jar_name:
+        exit('No jar files were found in server folder ({}) and no jar name supplied!'.format(full_path))
+    return jar_name
 
+def resolve_ip(options, timings):
     if options.ip:
-        ip = options.ip
-    else:
-        ip = get_public_ip()
+        return options.ip
+    with timings.phase('ip'):
+        return get_public_ip(options.ip_endpoints or IP_ADDRESSES, options.ip_cache)
+
+def prepare_hosting(options, full_path, timings):
+    ip_task = BackgroundTask(resolve_ip, options, timings)
+    with timings.phase('jar'):
+        jar_name = resolve_jar(options, full_path)
+    return jar_name, ip_task.result()
+
+#------------------------------------------------------------------------------
+# Supervisor (-M). Runs many worlds from a single process, as listed in a JSON
+# config file:
+#
+#   {"server": "http://a.server.com:9000", "memory_budget": 12288,
+#    "worlds": [{"name": "DEI", "path": "~/Dropbox/DEI", "key": "secret1"},
+#               {"name": "Friends", "path": "~/Dropbox/Friends", "key": "secret2",
+#                "memory": 4096, "restart": true}]}
+#
+# Worlds may also set "jar", "jvm_options", "log_file" and their own "server"
+# address; the top level may set "ip", "heartbeat" and "lease_time". Each world
+# is claimed through the central server before it starts, as a single host
+# claims its server (see claim_central_server). The IP is detected once, one
+# periodic thread does the heartbeats of every world, and the central server
+# gets them all in one bulk request over the shared connection (worlds are
+# registered there under their names). The heaps of all the JVMs must fit in
+# the memory budget (in MB; by default the memory available when the
+# supervisor starts), "jvm_options" without an -Xmx getting the heap planned
+# for them.
+#------------------------------------------------------------------------------
+def parse_heap_mb(jvm_options):
+    match = re.search(r'-Xmx(\d+)([kKmMgG]?)', jvm_options or '')
+    if not match:
+        return None
+    value, unit = int(match.group(1)), match.group(2).lower()
+    return {'k': value // 1024, 'm': value, 'g': value * 1024}.get(unit, value // (1024 * 1024))
+
+class SupervisedWorld:
+    def __init__(self, config, central_server_address):
+        self.name = config['name']
+        self.path = os.path.abspath(os.path.expanduser(config['path']))
+        self.key = config.get('key')
+        self.own_central = config.get('server')
+        self.central = self.own_central or (get_world_central_address(central_server_address, self.name) if central_server_address else None)
+        self.jar = config.get('jar')
+        self.jvm_options = config.get('jvm_options')
+        self.memory = config.get('memory') or parse_heap_mb(self.jvm_options)
+        self.log_path = config.get('log_file')
+        self.restart = config.get('restart', False)
+        self.idle_time = config.get('idle_stop', 0)
+        self.restarts = 0
+        self.heap = 0
+        self.process = None
+        self.telemetry = None
+        self.prefix = '[{}] '.format(self.name)
+
+    # jvm_options without an -Xmx get the planned heap as theirs, or the JVM
+    # would take a share of the machine's memory that nobody budgeted for
+    def get_jvm_flags(self):
+        if not self.jvm_options:
+            return '-Xms{0}M -Xmx{0}M {1}'.format(self.heap, GC_FLAGS)
+        if parse_heap_mb(self.jvm_options) is None:
+            return '{} -Xmx{}M'.format(self.jvm_options, self.heap)
+        return self.jvm_options
+
+class WorldSupervisor:
+    def __init__(self, config_path):
+        try:
+            with open(config_path) as f:
+                config = json.load(f)
+            self.central = config.get('server')
+            self.ip = config.get('ip')
+            # The same default as -b
+            self.heartbeat_time = config.get('heartbeat', 2 * DEFAULT_HEARTBEAT)
+            self.lease_time = config.get('lease_time', 2 * self.heartbeat_time)
+            self.memory_budget = config.get('memory_budget')
+            self.sync_check = config.get('sync_check', True)
+            self.worlds = [SupervisedWorld(world, self.central) for world in config['worlds']]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            exit('Invalid supervisor config {}: {}'.format(config_path, e))
+        names = [world.name for world in self.worlds]
+        if len(set(names)) != len(names):
+            exit('Invalid supervisor config {}: world names must be unique'.format(config_path))
+        for world in self.worlds:
+            if not directory_exists(world.path):
+                exit('Directory {} of world {} does not exist.'.format(world.path, world.name))
+            if world.central and not world.key:
+                exit('World {} needs a secret key to use a central server.'.format(world.name))
+            if not isinstance(world.idle_time, int) or world.idle_time < 0:
+                exit('Invalid idle_stop for world {}: it must be a non-negative number of seconds.'.format(world.name))
+        self.running = {}
+        self.lock = Lock()
+        self.exited = queue.Queue()
+
+    # Explicit heaps are reserved first, in config order. Whatever is left is
+    # shared by the other worlds in proportion to what they'd get alone.
+    def plan_memory(self, worlds):
+        budget = self.memory_budget or (get_available_memory_mb() or 0) - SYSTEM_RESERVED_MB
+        planned, left = [], budget
+        for world in worlds:
+            if world.memory:
+                if world.memory > left:
+                    print(world.prefix + 'Not starting: its {} MB heap does not fit in the {} MB left of the memory budget.'.format(world.memory, left))
+                    continue
+                world.heap = world.memory
+                left -= world.memory
+                planned.append(world)
+        wanted = {world: BASE_HEAP_MB + sum(size for size, mtime in scan_tree(world.path).values()) // (1024 * 1024) for world in worlds if not world.memory}
+        scale = min(1.0, left / sum(wanted.values())) if wanted else 1.0
+        for world, heap in wanted.items():
+            world.heap = int(heap * scale)
+            if world.heap < MIN_HEAP_MB:
+                print(world.prefix + 'Not starting: only {} MB of the memory budget left for it.'.format(world.heap))
+                continue
+            planned.append(world)
+        print('Memory budget: {} MB, planned: {}'.format(budget, ', '.join('{} {} MB'.format(world.name, world.heap) for world in planned) or 'nothing'))
+        return planned
+
+    def start_world(self, world):
+        jar = world.jar or find_first_jar(world.path)
+        if not jar:
+            print(world.prefix + 'No jar files were found in ' + world.path)
+            return False
+        refusal = claim_central_server(self.ip, world.central, world.key, self.lease_time)
+        if refusal:
+            print(world.prefix + refusal)
+            return False
+        mark_server_as_running(self.ip, world.central, world.path, world.key, False, self.lease_time, self.heartbeat_time)
+        remove_world_manifest(world.path)
+        log_path = world.log_path or get_default_log_path(world.path)
+        world.process, pump = launch_server(world.path, world.get_jvm_flags(), jar, log_path, prefix=world.prefix, piped_console=bool(world.idle_time))
+        world.telemetry = ServerTelemetry(world.process.pid)
+        world.telemetry.attach(pump)
+        idle_monitor = IdleMonitor(ServerConsole(world.process, pump), world.telemetry, world.idle_time, world.prefix) if world.idle_time else None
+        print(world.prefix + 'Server process started ({})'.format(world.get_jvm_flags()))
+        pump.start()
+        if idle_monitor:
+            idle_monitor.start()
+        with self.lock:
+            self.running[world.name] = world
+        def wait():
+            world.process.wait()
+            if idle_monitor:
+                idle_monitor.stop()
+            pump.join()
+            self.exited.put(world)
+        Thread(target=wait, daemon=True).start()
+        return True
+
+    def stop_world(self, world):
+        with self.lock:
+            self.running.pop(world.name, None)
+        write_world_manifest(world.path)
+        mark_server_as_stopped(world.central, world.path, world.key, self.ip)
+
+    # Every world's heartbeat, from one thread. The Dropbox leases are local
+    # writes; the central server updates go out together, in the background,
+    # one request per central server (worlds with a server of their own get
+    # theirs in the same go), so none is skipped for being in flight with
+    # another world's.
+    def heartbeat(self):
+        with self.lock:
+            worlds = list(self.running.values())
+        batches = {}
+        for world in worlds:
+            update_dropbox_state(self.ip, world.path, self.lease_time, self.heartbeat_time)
+            if world.central:
+                base, name = split_central_address(world.central)
+                batches.setdefault(base, []).append((name, world.key, self.ip, world.telemetry.sample()))
+        if batches:
+            send_central_update_in_background(self.inform_central, batches)
+
+    # batches is {central server base address: updates for it}
+    def inform_central(self, batches):
+        for base, updates in batches.items():
+            inform_central_server_bulk(updates, base)
+
+    def run(self):
+        if not self.ip:
+            self.ip = get_public_ip()
+        worlds = []
+        for world in self.worlds:
+            status = is_someone_running_server(world.central, world.path, world.key, 2 * self.heartbeat_time)
+            if status:
+                print(world.prefix + 'Server is running at {:s}'.format(status))
+            elif self.sync_check and not wait_for_world_sync(world.path, DEFAULT_SYNC_WAIT):
+                print(world.prefix + 'The world is not fully synced yet. Not starting it.')
+            else:
+                worlds.append(world)
+        for world in self.plan_memory(worlds):
+            self.start_world(world)
+
+        updater = None
+        if self.heartbeat_time:
+            updater = PeriodicThread(self.heartbeat, self.heartbeat_time, HEARTBEAT_JITTER)
+            updater.start()
+        try:
+            while self.running:
+                world = self.exited.get()
+                code = world.process.returncode
+                self.stop_world(world)
+                if code and world.restart and world.restarts < SUPERVISOR_RESTART_LIMIT:
+                    world.restarts += 1
+                    print(world.prefix + 'Server exited with code {}. Restarting ({}/{})...'.format(code, world.restarts, SUPERVISOR_RESTART_LIMIT))
+                    self.start_world(world)
+                else:
+                    print(world.prefix + 'Server stopped (exit code {}).'.format(code))
+        except KeyboardInterrupt:
+            # The JVMs got the interrupt too; wait for them to save and exit
+            print('Caught interrupt. Waiting for every server to stop...')
+            with self.lock:
+                worlds = list(self.running.values())
+            for world in worlds:
+                world.process.wait()
+                self.stop_world(world)
+        finally:
+            if updater:
+                updater.stop()
+        print('Done!')
 
+# Dropbox says nobody is hosting. Claim the server through the central server
+# (if there is one), which only lets the first of several players starting at
+# once have it. If it still names a host, that host is replaced only if it
+# hasn't sent a heartbeat within the lease time (it crashed, or stopped
+# without telling the central server). Returns why we may not start, or None
+# if we may.
+def claim_central_server(ip, central_server_address, secret_key, lease_time):
+    current = check_central_server(secret_key, central_server_address)
+    if current is None or current == ip:
+        return None
+    if take_over_central_server(ip, current, secret_key, central_server_address, lease_time) is False:
+        if current:
+            return 'The central server says the server is running at {} and heard from it recently. Not starting.'.format(current)
+        return 'Someone else started the server just now, says the central server. Not starting.'
+    return None
+
+# lease is the HostLease of a standby that already claimed the server
+def host_server(options, full_path_to_server, jar_name, ip, jvm_flags, startup_cache, lease=None):
+        lease = lease or HostLease(ip, options, full_path_to_server)
+        stage = None
+        try:
+            print('Server is not running. Starting...')
+            refusal = claim_central_server(ip, options.server_address, options.secret_key, options.lease_time or 2 * options.heartbeat_time)
+            if refusal:
+                exit(refusal)
+            lease.start()
+            remove_world_manifest(full_path_to_server)
+            run_folder = full_path_to_server
+            if options.stage_dir:
+                stage = WorldStage(full_path_to_server, options.stage_dir, options.sync_interval)
+                run_folder = stage.prepare()
+            log_path = options.log_file or get_default_log_path(full_path_to_server)
+            start_local_server(run_folder, jvm_flags, jar_name, lease, log_path, startup_cache, options.idle_time, stage)
+            if stage:
+                stage.finish()
+            write_world_manifest(full_path_to_server)
+            if options.snapshot_dir:
+                take_snapshot(run_folder, options.snapshot_dir)
+            print('Server stopped. Updating server and Dropbox...')
+            lease.release()
+            print('Done!')
+        except KeyboardInterrupt:
+            print('Caught interrupt. Terminating and marking as stopped.')
+            if stage:
+                stage.finish()
+                write_world_manifest(full_path_to_server)
+        finally:
+            # Also when we give up (or fail) before the server even started
+            lease.release()
 
-    return options.server_address, options.secret_key, full_path, jar_name, options.jvm_options, ip, options.heartbeat_time
+def check_world_sync(options, full_path_to_server, timings):
+        if options.sync_check:
+            with timings.phase('sync check'):
+                synced = wait_for_world_sync(full_path_to_server, options.sync_wait)
+            if not synced:
+                exit('The world is not fully synced yet. Try again later, or use -z if you are sure it is.')
 
 def go():
-        remote_server_address, secret_key, full_path_to_server, jar_name, jvm_options, ip, heartbeat_time = parse_input()
-        status = is_someone_running_server(remote_server_address, full_path_to_server, secret_key, 2*heartbeat_time)
-        if status:
-            print('Server is running at {:s}'.format(status))
-        else:
+        timings = StartupTimings()
+        with timings.phase('parse'):
+            options, full_path_to_server = parse_input(timings)
+        if options.supervise:
+            WorldSupervisor(options.supervise).run()
+            return
+        remote_server_address, secret_key, heartbeat_time = options.server_address, options.secret_key, options.heartbeat_time
+
+        with timings.phase('status'):
+            status = is_someone_running_server(remote_server_address, full_path_to_server, secret_key, 2*heartbeat_time)
+        if options.standby:
+            # Resolve everything now, so taking over only means starting the JVM
+            jar_name, ip = prepare_hosting(options, full_path_to_server, timings)
+            jvm_flags, startup_cache = get_jvm_options(options, full_path_to_server, jar_name, timings)
+            timings.report()
             try:
-                print('Server is not running. Starting...')
-                start_local_server(full_path_to_server, jvm_options, jar_name, ip, remote_server_address, full_path_to_server, secret_key, heartbeat_time)
-                print('Server stopped. Updating server and Dropbox...')
-                mark_server_as_stopped(remote_server_address, full_path_to_server, secret_key)
-                print('Done!')
+                clean_stop = stand_by(ip, options, full_path_to_server)
             except KeyboardInterrupt:
-                print('Caught interrupt. Terminating and marking as stopped if we were the server.')
-                # Pass no heartbeat time because we don't care about that now! We just want to clear the state if we
-                # were the last ones reported to be hosting the server
-                status = is_someone_running_server(remote_server_address, full_path_to_server, secret_key, None)
-                if status and status == ip:
-                    print('We were the server! Marking as stopped')
-                    mark_server_as_stopped(remote_server_address, full_path_to_server, secret_key)
+                print('Stopped standing by.')
+                return
+            # Keep our claim alive while the world syncs, and give it up if it doesn't
+            lease = HostLease(ip, options, full_path_to_server)
+            lease.start()
+            try:
+                if clean_stop:
+                    check_world_sync(options, full_path_to_server, timings)
+                else:
+                    print('The previous host did not stop cleanly. Not waiting for the world to match its last manifest.')
+            except BaseException:
+                lease.release()
+                raise
+            host_server(options, full_path_to_server, jar_name, ip, jvm_flags, startup_cache, lease)
+        elif status:
+            print('Server is running at {:s}'.format(status))
+            timings.report()
+        else:
+            jar_name, ip = prepare_hosting(options, full_path_to_server, timings)
+            check_world_sync(options, full_path_to_server, timings)
+            jvm_flags, startup_cache = get_jvm_options(options, full_path_to_server, jar_name, timings)
+            timings.report()
+            host_server(options, full_path_to_server, jar_name, ip, jvm_flags, startup_cache)
 
 def main():
     orig_dir = os.getcwd()
     go()
     os.chdir(orig_dir)
 
-main()
-stop_hanging_threads()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
+    stop_hanging_threads()
\ No newline at end of file